@@ -0,0 +1,336 @@
+"""
+非流式响应缓存
+
+相同的请求（同一API Key、方法、路径、模型和规范化后的请求体）直接返回缓存的响应，不再请求上游。
+缓存分为进程内按字节数限制的LRU内存层，以及可选的磁盘层；磁盘层在多进程之间共享，
+内存未命中时读取磁盘并放回内存。只缓存状态码200的非流式响应。
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Mapping, Optional
+
+from config import (
+    RESPONSE_CACHE_MODE, RESPONSE_CACHE_PATHS, RESPONSE_CACHE_TTL, RESPONSE_CACHE_MEMORY_BYTES,
+    RESPONSE_CACHE_MAX_ENTRY_BYTES, RESPONSE_CACHE_DIR, RESPONSE_CACHE_DISK_BYTES, RESPONSE_CACHE_SHARED
+)
+
+logger = logging.getLogger(__name__)
+
+CACHE_HEADER = 'X-Proxy-Cache'      # 响应头: HIT / MISS / BYPASS
+MODE_HEADER = 'X-Proxy-Cache-Mode'  # 请求头: on 缓存该请求 / off 不使用缓存 / refresh 重新请求并更新缓存
+TTL_HEADER = 'X-Proxy-Cache-TTL'    # 请求头: 缓存时间(秒)，不超过 RESPONSE_CACHE_TTL
+
+CACHE_MODES = ('off', 'opt-in', 'auto')
+
+# 不随缓存的响应返回的头部，响应体已解码并由服务器重新计算长度
+_SKIP_HEADERS = frozenset(('content-length', 'content-encoding', 'transfer-encoding', 'connection',
+                           'keep-alive', 'date'))
+
+_META_LENGTH = struct.Struct('>I')
+
+class CacheDecision:
+    """一个请求的缓存处理方式"""
+
+    __slots__ = ('key', 'ttl', 'lookup', 'store')
+
+    def __init__(self, key: Optional[str], ttl: float, lookup: bool, store: bool):
+        self.key = key
+        self.ttl = ttl
+        self.lookup = lookup  # 是否查找已缓存的响应
+        self.store = store    # 是否缓存上游的响应
+
+    @property
+    def status(self) -> str:
+        """未命中时的响应头取值"""
+        return 'MISS' if self.lookup or self.store else 'BYPASS'
+
+class CachedResponse:
+    """缓存的响应"""
+
+    __slots__ = ('status', 'headers', 'body', 'usage', 'created_at', 'expires_at', 'timeline')
+
+    def __init__(self, status: int, headers: Dict[str, str], body: bytes, usage: Dict[str, Any],
+                 created_at: float, expires_at: float, timeline: Optional[Dict[str, Any]] = None):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.usage = usage
+        self.created_at = created_at
+        self.expires_at = expires_at
+        self.timeline = timeline  # 录制的流式响应中各事件的时间，见 replay.py
+
+    @classmethod
+    def create(cls, status: int, headers: Mapping[str, str], body: bytes, usage: Dict[str, Any],
+               ttl: float, timeline: Optional[Dict[str, Any]] = None) -> 'CachedResponse':
+        """从上游响应创建缓存项"""
+        now = time.time()
+        kept = {name: value for name, value in headers.items() if name.lower() not in _SKIP_HEADERS}
+        return cls(status, kept, body, usage, now, now + ttl, timeline)
+
+    @property
+    def size(self) -> int:
+        """占用的近似字节数"""
+        size = len(self.body) + sum(len(name) + len(value) for name, value in self.headers.items())
+        if self.timeline is not None:
+            size += 16 * len(self.timeline['events'])
+        return size
+
+    def age(self) -> int:
+        return max(0, int(time.time() - self.created_at))
+
+    def to_bytes(self) -> bytes:
+        """磁盘格式：元数据长度 + 元数据JSON + 响应体"""
+        meta = {
+            'status': self.status,
+            'headers': self.headers,
+            'usage': self.usage,
+            'created_at': self.created_at,
+            'expires_at': self.expires_at,
+        }
+        if self.timeline is not None:
+            meta['timeline'] = self.timeline
+        meta = json.dumps(meta).encode()
+        return _META_LENGTH.pack(len(meta)) + meta + self.body
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'CachedResponse':
+        (length,) = _META_LENGTH.unpack_from(data)
+        meta = json.loads(data[_META_LENGTH.size:_META_LENGTH.size + length])
+        return cls(meta['status'], meta['headers'], data[_META_LENGTH.size + length:], meta['usage'],
+                   meta['created_at'], meta['expires_at'], meta.get('timeline'))
+
+def is_deterministic(data: Dict[str, Any]) -> bool:
+    """auto 模式下自动缓存的请求：temperature 为0且只生成一个结果，或不含采样参数的嵌入请求"""
+    if 'messages' in data or 'prompt' in data:
+        return data.get('temperature') == 0 and data.get('n', 1) == 1
+    return 'input' in data
+
+class ResponseCache:
+    """两级响应缓存"""
+
+    def __init__(self, mode: str = RESPONSE_CACHE_MODE, ttl: float = RESPONSE_CACHE_TTL,
+                 memory_bytes: int = RESPONSE_CACHE_MEMORY_BYTES,
+                 max_entry_bytes: int = RESPONSE_CACHE_MAX_ENTRY_BYTES,
+                 disk_dir: str = RESPONSE_CACHE_DIR, disk_bytes: int = RESPONSE_CACHE_DISK_BYTES,
+                 paths: str = RESPONSE_CACHE_PATHS, shared: bool = RESPONSE_CACHE_SHARED):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Unknown response cache mode: {mode}")
+        self.mode = mode
+        self.ttl = ttl
+        self.memory_limit = memory_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.disk_dir = disk_dir or None
+        self.disk_limit = disk_bytes
+        self.paths = frozenset(path.strip() for path in paths.split(',') if path.strip())
+        self.shared = shared
+        self._memory: 'OrderedDict[str, CachedResponse]' = OrderedDict()
+        self.memory_bytes = 0
+        self._disk_lock = threading.Lock()
+        self.disk_bytes = self._scan_disk() if self.disk_dir else 0
+        self.results = {'hit': 0, 'miss': 0, 'bypass': 0}
+        self.hits_by_tier = {'memory': 0, 'disk': 0}
+        self.stores = 0
+        self.evictions = 0
+
+    def decide(self, method: str, path: str, headers: Mapping[str, str], body: Optional[bytes]) -> Optional[CacheDecision]:
+        """判断请求是否使用缓存，不适用时返回 None"""
+        if self.mode == 'off' or method != 'POST' or path not in self.paths or not body:
+            return None
+        requested = headers.get(MODE_HEADER, '').strip().lower()
+        if requested == 'off':
+            self.results['bypass'] += 1
+            return CacheDecision(None, 0, lookup=False, store=False)
+        explicit = requested in ('on', 'refresh')
+        if not explicit and self.mode != 'auto':
+            return None
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return None
+        if not isinstance(data, dict) or data.get('stream'):
+            return None
+        if not explicit and not is_deterministic(data):
+            return None
+
+        ttl = self.ttl
+        try:
+            ttl = min(ttl, float(headers[TTL_HEADER]))
+        except (KeyError, ValueError):
+            pass
+        authorization = headers.get('Authorization', '')
+        key = self.make_key(method, path, '' if self.shared else authorization, data)
+        return CacheDecision(key, ttl, lookup=requested != 'refresh', store=ttl > 0)
+
+    @staticmethod
+    def make_key(method: str, path: str, scope: str, data: Dict[str, Any]) -> str:
+        """缓存键：方法、路径、API Key、模型和规范化请求体（键排序、去除空白）的哈希"""
+        digest = hashlib.sha256()
+        canonical = json.dumps(data, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+        for part in (method, path, scope, str(data.get('model') or ''), canonical):
+            digest.update(part.encode('utf-8', errors='replace'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    async def get(self, key: str) -> Optional[CachedResponse]:
+        """查找未过期的缓存项，磁盘命中的项放回内存"""
+        entry = self._memory.get(key)
+        if entry is not None:
+            if entry.expires_at > time.time():
+                self._memory.move_to_end(key)
+                self.results['hit'] += 1
+                self.hits_by_tier['memory'] += 1
+                return entry
+            self._discard(key)
+        if self.disk_dir:
+            try:
+                entry = await asyncio.get_running_loop().run_in_executor(None, self._read_disk, key)
+            except Exception as e:
+                logger.warning(f"Failed to read disk cache entry: {e}")
+                entry = None
+            if entry is not None:
+                self._remember(key, entry)
+                self.results['hit'] += 1
+                self.hits_by_tier['disk'] += 1
+                return entry
+        self.results['miss'] += 1
+        return None
+
+    def put(self, key: str, entry: CachedResponse):
+        """缓存响应，磁盘写入在后台线程中进行，不阻塞响应"""
+        if entry.size > self.max_entry_bytes:
+            return
+        self.stores += 1
+        self._remember(key, entry)
+        if self.disk_dir:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                self._write_disk(key, entry)  # 命令行工具中没有事件循环，直接写入
+                return
+            future = loop.run_in_executor(None, self._write_disk, key, entry)
+            future.add_done_callback(self._log_disk_error)
+
+    def _remember(self, key: str, entry: CachedResponse):
+        """放入内存层，超出字节数上限时淘汰最久未使用的项"""
+        self._discard(key)
+        if entry.size > self.memory_limit:
+            return
+        self._memory[key] = entry
+        self.memory_bytes += entry.size
+        while self.memory_bytes > self.memory_limit:
+            _, evicted = self._memory.popitem(last=False)
+            self.memory_bytes -= evicted.size
+            self.evictions += 1
+
+    def _discard(self, key: str):
+        entry = self._memory.pop(key, None)
+        if entry is not None:
+            self.memory_bytes -= entry.size
+
+    @staticmethod
+    def _log_disk_error(future: asyncio.Future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.warning(f"Failed to write response cache entry: {future.exception()}")
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], key)
+
+    def _scan_disk(self) -> int:
+        """统计磁盘缓存占用的字节数"""
+        total = 0
+        for root, _, files in os.walk(self.disk_dir):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        return total
+
+    def _read_disk(self, key: str) -> Optional[CachedResponse]:
+        """读取磁盘缓存项，过期或损坏的项直接删除"""
+        path = self._disk_path(key)
+        try:
+            with open(path, 'rb') as f:
+                entry = CachedResponse.from_bytes(f.read())
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, struct.error):
+            entry = None
+        if entry is None or entry.expires_at <= time.time():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        try:
+            os.utime(path)  # 修改时间用于淘汰最久未使用的项
+        except OSError:
+            return None  # 读取后被其他进程淘汰，按未命中处理
+        return entry
+
+    def _write_disk(self, key: str, entry: CachedResponse):
+        """原子地写入磁盘缓存项，超出上限时淘汰最久未使用的项"""
+        path = self._disk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = entry.to_bytes()
+        temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        with self._disk_lock:
+            # 替换已有的缓存项时只计入大小的差值
+            try:
+                replaced = os.stat(path).st_size
+            except OSError:
+                replaced = 0
+            os.replace(temp_path, path)
+            self.disk_bytes += len(data) - replaced
+            if self.disk_bytes > self.disk_limit:
+                self._evict_disk()
+
+    def _evict_disk(self):
+        """删除最久未使用的磁盘缓存项，直到占用低于上限的90%（多个进程共享目录，按实际文件统计）"""
+        files = []
+        for root, _, names in os.walk(self.disk_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        target = self.disk_limit * 0.9
+        for _, size, path in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self.evictions += 1
+        self.disk_bytes = total
+
+    def stats(self) -> Dict[str, Any]:
+        """缓存统计"""
+        lookups = self.results['hit'] + self.results['miss']
+        return {
+            'mode': self.mode,
+            **self.results,
+            'hit_ratio': round(self.results['hit'] / lookups, 4) if lookups else None,
+            'hits_memory': self.hits_by_tier['memory'],
+            'hits_disk': self.hits_by_tier['disk'],
+            'stores': self.stores,
+            'evictions': self.evictions,
+            'memory_entries': len(self._memory),
+            'memory_bytes': self.memory_bytes,
+            'disk_bytes': self.disk_bytes if self.disk_dir else None,
+        }
@@ -0,0 +1,214 @@
+"""
+目录接口缓存
+
+客户端SDK启动时通常会请求模型列表等目录接口（GET /api/v1/models 等），响应较大且变化很少。
+配置的路径（完整路径匹配）由代理按API Key分别缓存：缓存未过期时直接返回，存在时间超过
+TTL 的一定比例后在后台提前刷新，过期后的一段时间内先返回旧内容并在后台刷新；刷新时携带上游
+返回的 ETag / Last-Modified 发送条件请求，上游返回304时只延长缓存时间。客户端携带匹配的
+If-None-Match 时返回304。
+
+同一URL同时只有一个刷新请求，缓存为空时并发的请求等待同一个上游响应。
+上游标记为 private / no-store 或按 Authorization 变化（Vary）的响应不缓存。
+"""
+import asyncio
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Mapping, Optional, Tuple
+
+from cache import CachedResponse
+from config import (
+    CATALOG_CACHE_PATHS, CATALOG_CACHE_TTL, CATALOG_CACHE_REFRESH_RATIO, CATALOG_CACHE_STALE_TTL,
+    CATALOG_CACHE_MAX_ENTRIES, CATALOG_CACHE_STORAGE, CATALOG_CACHE_SHARED
+)
+
+logger = logging.getLogger(__name__)
+
+CATALOG_STORAGE_MODES = ('full', 'summary', 'skip')
+
+# 客户端的条件请求头，向上游请求完整响应时不转发
+CONDITIONAL_HEADERS = frozenset(('if-none-match', 'if-modified-since'))
+
+# fetch(条件请求头) -> (状态码, 响应头, 响应体)
+Fetch = Callable[[Dict[str, str]], Awaitable[Tuple[int, Mapping[str, str], bytes]]]
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match 是否与 ETag 匹配（弱比较）"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    bare = etag[2:] if etag.startswith('W/') else etag
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == bare:
+            return True
+    return False
+
+def is_cacheable(headers: Mapping[str, str]) -> bool:
+    """上游响应是否可以缓存：不是 private / no-store，也不按 Authorization 变化"""
+    cache_control = headers.get('Cache-Control', '').lower()
+    if 'private' in cache_control or 'no-store' in cache_control:
+        return False
+    vary = {value.strip().lower() for value in headers.get('Vary', '').split(',')}
+    return not vary & {'*', 'authorization'}
+
+class CatalogEntry:
+    """一个目录接口的缓存项"""
+
+    __slots__ = ('response', 'etag', 'validators')
+
+    def __init__(self, response: CachedResponse, etag: str, validators: Dict[str, str]):
+        self.response = response
+        self.etag = etag                # 返回给客户端的 ETag，上游没有提供时按响应体计算
+        self.validators = validators    # 向上游发送条件请求使用的请求头
+
+    @classmethod
+    def create(cls, headers: Mapping[str, str], body: bytes, ttl: float) -> 'CatalogEntry':
+        response = CachedResponse.create(200, headers, body, {}, ttl)
+        validators = {}
+        if headers.get('ETag'):
+            validators['If-None-Match'] = headers['ETag']
+        if headers.get('Last-Modified'):
+            validators['If-Modified-Since'] = headers['Last-Modified']
+        etag = headers.get('ETag') or f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+        response.headers = {name: value for name, value in response.headers.items() if name.lower() != 'etag'}
+        response.headers['ETag'] = etag
+        return cls(response, etag, validators)
+
+    def age(self) -> float:
+        return time.time() - self.response.created_at
+
+    def renew(self, ttl: float):
+        """上游确认内容未变化，重新开始计算缓存时间"""
+        self.response.created_at = time.time()
+        self.response.expires_at = self.response.created_at + ttl
+
+class CatalogCache:
+    """目录接口的缓存"""
+
+    def __init__(self, paths: str = CATALOG_CACHE_PATHS, ttl: float = CATALOG_CACHE_TTL,
+                 refresh_ratio: float = CATALOG_CACHE_REFRESH_RATIO, stale_ttl: float = CATALOG_CACHE_STALE_TTL,
+                 max_entries: int = CATALOG_CACHE_MAX_ENTRIES, storage: str = CATALOG_CACHE_STORAGE,
+                 shared: bool = CATALOG_CACHE_SHARED):
+        if storage not in CATALOG_STORAGE_MODES:
+            raise ValueError(f"Unknown catalog storage mode: {storage}")
+        self.paths = frozenset(path.strip() for path in paths.split(',') if path.strip())
+        self.ttl = ttl
+        self.refresh_after = ttl * refresh_ratio
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.storage = storage
+        self.shared = shared
+        self._entries: 'OrderedDict[str, CatalogEntry]' = OrderedDict()
+        self._refreshing: Dict[str, asyncio.Future] = {}
+        self.results = {'hit': 0, 'stale': 0, 'miss': 0, 'bypass': 0}
+        self.not_modified = 0    # 返回给客户端的304数
+        self.refreshes = 0       # 向上游发出的请求数
+        self.revalidated = 0     # 上游返回304的次数
+        self.refresh_errors = 0
+
+    def matches(self, method: str, path: str) -> bool:
+        return method == 'GET' and path in self.paths
+
+    def make_key(self, path_qs: str, authorization: str) -> str:
+        """缓存键：URL（含查询参数），不共享时加上API Key的哈希"""
+        if self.shared:
+            return path_qs
+        return f"{path_qs}#{hashlib.sha256(authorization.encode()).hexdigest()[:16]}"
+
+    def record_body(self, result: str) -> Tuple[bool, bool]:
+        """请求的记录方式: (是否记录, 是否记录响应体)，只对命中缓存的请求生效"""
+        if result in ('miss', 'bypass') or self.storage == 'full':
+            return True, True
+        return self.storage == 'summary', False
+
+    async def get(self, key: str, fetch: Fetch) -> Tuple[CatalogEntry, str]:
+        """返回缓存项和处理结果 hit / stale / miss / bypass
+
+        上游返回200以外的状态码或不可缓存的响应时结果为 bypass，返回的缓存项不会被保存；缓存为空时上游请求的异常直接抛出。
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            age = entry.age()
+            if age < self.ttl + self.stale_ttl:
+                self._entries.move_to_end(key)
+                if age >= self.refresh_after:
+                    self._refresh(key, fetch)
+                result = 'hit' if age < self.ttl else 'stale'
+                self.results[result] += 1
+                return entry, result
+            self._discard(key)
+        # 客户端断开时不取消上游请求，其他等待的请求仍然需要它
+        entry, stored = await asyncio.shield(self._refresh(key, fetch))
+        result = 'miss' if stored else 'bypass'
+        self.results[result] += 1
+        return entry, result
+
+    def _refresh(self, key: str, fetch: Fetch) -> asyncio.Future:
+        """启动刷新，同一URL已有进行中的刷新时返回该刷新"""
+        future = self._refreshing.get(key)
+        if future is None:
+            future = self._refreshing[key] = asyncio.ensure_future(self._fetch(key, fetch))
+            future.add_done_callback(lambda done: self._finish_refresh(key, done))
+        return future
+
+    def _finish_refresh(self, key: str, future: asyncio.Future):
+        if self._refreshing.get(key) is future:
+            del self._refreshing[key]
+        if not future.cancelled() and future.exception() is not None:
+            self.refresh_errors += 1
+            logger.warning(f"Failed to refresh catalog {key}: {future.exception()}")
+
+    async def _fetch(self, key: str, fetch: Fetch) -> Tuple[CatalogEntry, bool]:
+        """请求上游，返回 (缓存项, 是否已保存)；已有缓存时发送条件请求"""
+        current = self._entries.get(key)
+        self.refreshes += 1
+        try:
+            status, headers, body = await fetch(current.validators if current is not None else {})
+        except Exception:
+            if current is None:
+                raise
+            # 后台刷新失败时继续使用旧内容
+            self.refresh_errors += 1
+            logger.warning(f"Failed to refresh catalog {key}, keeping cached response", exc_info=True)
+            return current, True
+        if status == 304 and current is not None:
+            current.renew(self.ttl)
+            self.revalidated += 1
+            return current, True
+        if status == 200 and not is_cacheable(headers):
+            self._discard(key)
+            return CatalogEntry(CachedResponse.create(status, headers, body, {}, 0), '', {}), False
+        if status != 200:
+            if current is not None:
+                self.refresh_errors += 1
+                logger.warning(f"Catalog refresh for {key} returned {status}, keeping cached response")
+                return current, True
+            return CatalogEntry(CachedResponse.create(status, headers, body, {}, 0), '', {}), False
+        entry = CatalogEntry.create(headers, body, self.ttl)
+        self._discard(key)
+        self._entries[key] = entry
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return entry, True
+
+    def _discard(self, key: str):
+        self._entries.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        """缓存统计"""
+        return {
+            **self.results,
+            'not_modified': self.not_modified,
+            'refreshes': self.refreshes,
+            'revalidated': self.revalidated,
+            'refresh_errors': self.refresh_errors,
+            'entries': len(self._entries),
+            'bytes': sum(entry.response.size for entry in self._entries.values()),
+            'storage': self.storage,
+            'shared': self.shared,
+        }
@@ -0,0 +1,252 @@
+"""
+相同请求合并(singleflight)
+
+同一API Key同时发出的相同请求（方法、路径和规范化后的请求体相同）只向上游发送一次。
+第一个请求创建 Flight，由独立的任务读取上游响应并保留已收到的数据；之后到达的相同请求加入
+该 Flight，先重放已收到的数据，再继续接收新到达的数据。非流式请求因此共享同一个完整响应，
+流式请求共享同一个事件流。
+
+上游请求不属于任何一个客户端：某个客户端断开只影响它自己，所有客户端都断开后才中止上游请求。
+合并只在单个代理进程内进行。
+"""
+import asyncio
+import json
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Mapping, Optional, Set
+
+from cache import ResponseCache, is_deterministic
+from config import COALESCE_MODE, COALESCE_PATHS, COALESCE_MAX_BUFFER_BYTES
+from upstream import PhaseTimeouts, ReadWatchdog
+
+logger = logging.getLogger(__name__)
+
+COALESCE_HEADER = 'X-Proxy-Coalesce'  # 请求头: on 合并该请求 / off 不合并
+
+COALESCE_MODES = ('off', 'auto', 'all')
+
+class Flight:
+    """一次共享的上游请求，保存响应头和已收到的数据块"""
+
+    def __init__(self, key: str, max_buffer_bytes: int, on_close: Callable[['Flight'], None]):
+        self.key = key
+        self.max_buffer_bytes = max_buffer_bytes
+        self.status: Optional[int] = None
+        self.headers: Optional[Mapping[str, str]] = None
+        self.error: Optional[BaseException] = None
+        self.done = False
+        self.joinable = True  # 是否还接受新的请求加入
+        self.followers = 0    # 加入的请求数，不含第一个请求
+        self._on_close = on_close
+        self._chunks: List[bytes] = []
+        self._offset = 0      # 已从缓冲区丢弃的块数
+        self._buffered = 0
+        self._readers: Set['FlightReader'] = set()
+        self._changed = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, open_response: Callable[[], Awaitable], timeouts: PhaseTimeouts, started_at: float):
+        """在后台任务中发送上游请求并读取响应"""
+        self._task = asyncio.ensure_future(self._run(open_response, timeouts, started_at))
+
+    def add_reader(self, leader: bool = False) -> 'FlightReader':
+        reader = FlightReader(self, leader)
+        if not leader:
+            self.followers += 1
+        self._readers.add(reader)
+        return reader
+
+    async def _run(self, open_response: Callable[[], Awaitable], timeouts: PhaseTimeouts, started_at: float):
+        response = None
+        try:
+            response = await open_response()
+            watchdog = ReadWatchdog(response, timeouts, started_at)
+            try:
+                async with response:
+                    self.status = response.status
+                    self.headers = response.headers
+                    self._wake()
+                    while True:
+                        chunk = await response.content.readany()
+                        if not chunk:
+                            break
+                        watchdog.touch()
+                        self._feed(chunk)
+            finally:
+                watchdog.stop()
+        except asyncio.CancelledError:
+            # 所有客户端都已断开，关闭上游连接而不是放回连接池
+            if response is not None:
+                response.close()
+            self._finish(asyncio.CancelledError())
+            raise
+        except Exception as e:
+            self._finish(e)
+        else:
+            self._finish(None)
+
+    def _feed(self, chunk: bytes):
+        self._chunks.append(chunk)
+        self._buffered += len(chunk)
+        if self.joinable and self._buffered > self.max_buffer_bytes:
+            # 不再接受新的请求加入，已读取的数据可以丢弃
+            self._close()
+        self._trim()
+        self._wake()
+
+    def _finish(self, error: Optional[BaseException]):
+        self.error = error
+        self.done = True
+        self._close()
+        self._wake()
+
+    def _close(self):
+        """停止接受新的请求加入"""
+        if self.joinable:
+            self.joinable = False
+            self._on_close(self)
+
+    def _wake(self):
+        """唤醒所有等待新数据的读取者"""
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _trim(self):
+        """不再接受新的请求加入后，丢弃所有读取者都已读取的数据块"""
+        if self.joinable or not self._readers:
+            return
+        count = min(reader.index for reader in self._readers) - self._offset
+        if count > 0:
+            self._buffered -= sum(len(chunk) for chunk in self._chunks[:count])
+            del self._chunks[:count]
+            self._offset += count
+
+    def _release(self, reader: 'FlightReader'):
+        """读取者结束，所有读取者都断开时中止上游请求"""
+        self._readers.discard(reader)
+        if self._readers:
+            self._trim()
+        elif not self.done:
+            logger.info("All clients of a coalesced request disconnected, aborting upstream request")
+            self._close()
+            if self._task is not None:
+                self._task.cancel()
+
+class FlightReader:
+    """Flight 的一个读取者
+
+    提供代理处理上游响应时用到的接口（status、headers、content.readany()、close()），
+    可以代替上游响应交给相同的处理函数。
+    """
+
+    def __init__(self, flight: Flight, leader: bool):
+        self.flight = flight
+        self.leader = leader  # 是否为发起上游请求的第一个请求
+        self.index = flight._offset  # 下一个要读取的数据块序号
+        self.content = self
+        self._closed = False
+
+    @property
+    def status(self) -> int:
+        return self.flight.status
+
+    @property
+    def headers(self) -> Mapping[str, str]:
+        return self.flight.headers
+
+    def record_fields(self) -> Dict[str, Any]:
+        """记录中的合并信息：第一个请求记录加入的请求数，其余请求标记为合并"""
+        if self.leader:
+            return {'coalesced': self.flight.followers or None}
+        return {'cache_status': 'coalesced'}
+
+    async def wait_response(self):
+        """等待上游响应头，上游请求失败时抛出同样的异常"""
+        flight = self.flight
+        while flight.status is None:
+            if flight.done:
+                raise flight.error
+            await flight._changed.wait()
+
+    async def readany(self) -> bytes:
+        """读取下一个数据块，先重放已收到的数据，结束时返回空字节串"""
+        flight = self.flight
+        while True:
+            position = self.index - flight._offset
+            if position < len(flight._chunks):
+                self.index += 1
+                return flight._chunks[position]
+            if flight.done:
+                if flight.error is not None:
+                    raise flight.error
+                return b''
+            await flight._changed.wait()
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self.flight._release(self)
+
+class Coalescer:
+    """按请求键管理进行中的 Flight"""
+
+    def __init__(self, mode: str = COALESCE_MODE, paths: str = COALESCE_PATHS,
+                 max_buffer_bytes: int = COALESCE_MAX_BUFFER_BYTES):
+        if mode not in COALESCE_MODES:
+            raise ValueError(f"Unknown coalesce mode: {mode}")
+        self.mode = mode
+        self.paths = frozenset(path.strip() for path in paths.split(',') if path.strip())
+        self.max_buffer_bytes = max_buffer_bytes
+        self._flights: Dict[str, Flight] = {}
+        self.upstream_requests = 0  # 合并后实际发往上游的请求数
+        self.followers = 0          # 加入已有请求、未发往上游的请求数
+
+    def key_for(self, method: str, path: str, headers: Mapping[str, str], body: Optional[bytes]) -> Optional[str]:
+        """返回可以合并的请求的键，不适用时返回 None"""
+        if self.mode == 'off' or method != 'POST' or path not in self.paths or not body:
+            return None
+        requested = headers.get(COALESCE_HEADER, '').strip().lower()
+        if requested == 'off':
+            return None
+        auto = requested != 'on' and self.mode == 'auto'
+        if auto and b'"temperature"' not in body and b'"input"' not in body:
+            return None  # 不可能是确定性的请求，不必解析请求体
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return None
+        if not isinstance(data, dict):
+            return None
+        if auto and not is_deterministic(data):
+            return None
+        # 请求是否流式也是请求体的一部分，流式和非流式请求不会合并
+        return ResponseCache.make_key(method, path, headers.get('Authorization', ''), data)
+
+    def join(self, key: str, open_response: Callable[[], Awaitable], timeouts: PhaseTimeouts,
+             started_at: float) -> FlightReader:
+        """加入进行中的相同请求，没有时发起新的上游请求"""
+        flight = self._flights.get(key)
+        if flight is not None:
+            self.followers += 1
+            return flight.add_reader()
+        flight = self._flights[key] = Flight(key, self.max_buffer_bytes, self._remove)
+        reader = flight.add_reader(leader=True)
+        flight.start(open_response, timeouts, started_at)
+        self.upstream_requests += 1
+        return reader
+
+    def _remove(self, flight: Flight):
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+    @property
+    def in_progress(self) -> int:
+        return len(self._flights)
+
+    def stats(self) -> Dict[str, Any]:
+        """合并统计"""
+        return {
+            'mode': self.mode,
+            'upstream_requests': self.upstream_requests,
+            'followers': self.followers,
+            'in_progress': self.in_progress,
+        }
@@ -1,6 +1,7 @@
 """
 OpenAI代理配置文件
 """
+import json
 import os
 
 # 服务器配置
@@ -8,17 +9,126 @@ PROXY_HOST = os.getenv("PROXY_HOST", "127.0.0.1")
 PROXY_PORT = int(os.getenv("PROXY_PORT", "8080"))
 WEB_HOST = os.getenv("WEB_HOST", "127.0.0.1")
 WEB_PORT = int(os.getenv("WEB_PORT", "8081"))
+PROXY_WORKERS = int(os.getenv("PROXY_WORKERS", "0"))  # 代理工作进程数，0为单进程模式（代理和Web界面共用事件循环）
+WORKER_HEARTBEAT_INTERVAL = float(os.getenv("WORKER_HEARTBEAT_INTERVAL", "1"))  # 子进程心跳间隔(秒)
+WORKER_HEARTBEAT_TIMEOUT = float(os.getenv("WORKER_HEARTBEAT_TIMEOUT", "30"))  # 超过该时间无心跳的子进程被重启(秒)
 
 # OpenAI API配置
 OPENAI_API_BASE = "https://openrouter.ai"
 
+# 上游连接池配置
+UPSTREAM_LIMIT = int(os.getenv("UPSTREAM_LIMIT", "100"))  # 最大并发连接数，0为不限制
+UPSTREAM_LIMIT_PER_HOST = int(os.getenv("UPSTREAM_LIMIT_PER_HOST", "0"))  # 每个主机的最大连接数，0为不限制
+UPSTREAM_KEEPALIVE_TIMEOUT = float(os.getenv("UPSTREAM_KEEPALIVE_TIMEOUT", "60"))  # 空闲连接保持时间(秒)
+UPSTREAM_DNS_CACHE_TTL = int(os.getenv("UPSTREAM_DNS_CACHE_TTL", "300"))  # DNS缓存时间(秒)，-1为永久缓存，0为不缓存
+UPSTREAM_WARMUP_CONNECTIONS = int(os.getenv("UPSTREAM_WARMUP_CONNECTIONS", "2"))  # 启动时预先建立的连接数
+
+# 上游超时配置(秒)，0为不限制
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "10"))  # 建立连接
+UPSTREAM_FIRST_BYTE_TIMEOUT = float(os.getenv("UPSTREAM_FIRST_BYTE_TIMEOUT", "120"))  # 从发出请求到收到第一块响应数据
+UPSTREAM_IDLE_TIMEOUT = float(os.getenv("UPSTREAM_IDLE_TIMEOUT", "60"))  # 两块响应数据之间的最长间隔
+UPSTREAM_TOTAL_TIMEOUT = float(os.getenv("UPSTREAM_TOTAL_TIMEOUT", "1800"))  # 整个请求
+# 按路径前缀或模型覆盖超时，JSON格式，以/开头的键为路径前缀，其余为模型名（支持*通配），例如
+# {"/api/v1/embeddings": {"total": 30}, "openai/o1*": {"first_byte": 600}}
+TIMEOUT_OVERRIDES = json.loads(os.getenv("TIMEOUT_OVERRIDES", "{}"))
+
+# 数据库配置
+DB_PATH = os.getenv("DB_PATH", "proxy_requests.db")  # SQLite数据库文件路径
+
 # 日志配置
 LOG_LEVEL = "INFO"
 MAX_REQUESTS_HISTORY = 1000  # 最大保存的请求历史数量
 
 # 界面配置
 PAGE_SIZE = 20  # 每页显示的请求数量
+DETAIL_CACHE_SIZE = int(os.getenv("DETAIL_CACHE_SIZE", "64"))  # 缓存最近查看的格式化请求详情数量
 
 # 默认APIKEY配置
 DEFAULT_APIKEY = os.getenv("DEFAULT_APIKEY","")  # 默认APIKEY
 SUPER_ADMIN_APIKEY = os.getenv("SUPER_ADMIN_APIKEY","")  # 管理员APIKEY
+
+# 存储写入队列配置
+STORAGE_QUEUE_SIZE = int(os.getenv("STORAGE_QUEUE_SIZE", "10000"))  # 写入队列最大长度
+STORAGE_BATCH_SIZE = int(os.getenv("STORAGE_BATCH_SIZE", "200"))  # 每个事务批量写入的最大条数
+STORAGE_FLUSH_INTERVAL = float(os.getenv("STORAGE_FLUSH_INTERVAL", "0.5"))  # 批量写入最长等待时间(秒)
+STORAGE_OVERFLOW_POLICY = os.getenv("STORAGE_OVERFLOW_POLICY", "drop_bodies")  # 队列满时的策略: block / drop_bodies / drop_records
+STORAGE_WRITE_RETRIES = int(os.getenv("STORAGE_WRITE_RETRIES", "3"))  # 数据库忙等临时错误时批量写入的重试次数
+STORAGE_RETRY_BACKOFF = float(os.getenv("STORAGE_RETRY_BACKOFF", "0.1"))  # 首次重试前的等待时间(秒)，之后每次翻倍
+
+# SQLite连接配置
+SQLITE_READ_POOL_SIZE = int(os.getenv("SQLITE_READ_POOL_SIZE", "4"))  # 只读连接池大小
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")  # 同步模式: OFF / NORMAL / FULL
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "20000"))  # 每个连接的页缓存大小(KB)
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))  # 内存映射大小(字节)，0为关闭
+SQLITE_STATEMENT_CACHE = int(os.getenv("SQLITE_STATEMENT_CACHE", "128"))  # 每个连接缓存的预编译语句数
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))  # 数据库忙等待超时(毫秒)
+
+# 请求/响应体压缩配置
+STORAGE_COMPRESSION = os.getenv("STORAGE_COMPRESSION", "zlib")  # 压缩算法: zlib / zstd(需安装zstandard) / none
+STORAGE_COMPRESSION_LEVEL = int(os.getenv("STORAGE_COMPRESSION_LEVEL", "6"))  # 压缩级别
+
+# 请求体去重配置
+STORAGE_DEDUP = os.getenv("STORAGE_DEDUP", "true").lower() == "true"  # 对重复的消息/工具定义只存储一次
+DEDUP_MIN_SEGMENT_SIZE = int(os.getenv("DEDUP_MIN_SEGMENT_SIZE", "256"))  # 参与去重的片段最小字符数
+
+# 流式响应记录配置
+STREAM_CAPTURE_MODE = os.getenv("STREAM_CAPTURE_MODE", "raw")  # raw: 记录原始SSE数据 / assembled: 只记录重组后的完整响应
+STREAM_CAPTURE_MAX_BYTES = int(os.getenv("STREAM_CAPTURE_MAX_BYTES", str(1024 * 1024)))  # 每个流式响应最多记录的原始字节数（assembled 模式下为重组文本的字符数）
+
+# 流式转发写入合并配置
+STREAM_FLUSH_BYTES = int(os.getenv("STREAM_FLUSH_BYTES", "16384"))  # 缓冲达到该字节数立即写出
+STREAM_FLUSH_LATENCY_MS = float(os.getenv("STREAM_FLUSH_LATENCY_MS", "3"))  # 数据最多缓冲的时间(毫秒)，0为每块立即写出
+STREAM_FLUSH_ON_EVENT = os.getenv("STREAM_FLUSH_ON_EVENT", "true").lower() == "true"  # 缓冲以完整SSE事件结尾时立即写出
+
+# 指标配置
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 单独的指标端口，多进程模式下第N个代理进程使用 METRICS_PORT+N，0为不启用
+METRICS_MAX_SERIES = int(os.getenv("METRICS_MAX_SERIES", "500"))  # 每个指标最多的标签组合数，超出的归入 other
+METRICS_ROUTES = os.getenv("METRICS_ROUTES", "/api/v1/chat/completions,/api/v1/completions,/api/v1/embeddings,/api/v1/models,/api/v1/models/{author}/{slug}/endpoints,/api/v1/providers,/api/v1/generation,/api/v1/credits,/api/v1/key")  # 指标中单独统计的路由，逗号分隔，{name} 匹配一段路径，其他路径归入 other
+METRICS_MAX_MODELS = int(os.getenv("METRICS_MAX_MODELS", "100"))  # 指标中最多单独统计的模型数，超出的和不合法的模型名归入 other
+
+# 统计汇总配置
+STATS_WINDOW_HOURS = float(os.getenv("STATS_WINDOW_HOURS", "24"))  # 界面成功率和延迟统计的默认时间范围(小时)
+STATS_MINUTE_RETENTION_HOURS = float(os.getenv("STATS_MINUTE_RETENTION_HOURS", "48"))  # 按分钟汇总的数据保留时间(小时)，更早的按小时统计
+
+# 实时事件配置
+EVENTS_QUEUE_SIZE = int(os.getenv("EVENTS_QUEUE_SIZE", "10000"))  # 多进程模式下代理进程发往Web进程的事件队列长度，满时丢弃事件
+EVENTS_CLIENT_QUEUE_SIZE = int(os.getenv("EVENTS_CLIENT_QUEUE_SIZE", "256"))  # 每个页面连接待发送的最大事件数，超出时通知页面重新同步
+EVENTS_STATS_INTERVAL = float(os.getenv("EVENTS_STATS_INTERVAL", "1"))  # 合并发送统计增量的间隔(秒)
+EVENTS_KEEPALIVE_INTERVAL = float(os.getenv("EVENTS_KEEPALIVE_INTERVAL", "15"))  # 没有事件时发送心跳注释的间隔(秒)
+
+# 响应缓存配置
+RESPONSE_CACHE_MODE = os.getenv("RESPONSE_CACHE_MODE", "opt-in")  # off: 不缓存; opt-in: 只缓存带 X-Proxy-Cache-Mode: on 的请求; auto: 同时缓存 temperature 为0的请求
+RESPONSE_CACHE_PATHS = os.getenv("RESPONSE_CACHE_PATHS", "/api/v1/chat/completions,/api/v1/completions,/api/v1/embeddings")  # 可以缓存的路径，逗号分隔
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))  # 默认缓存时间(秒)，可用 X-Proxy-Cache-TTL 请求头缩短
+RESPONSE_CACHE_MEMORY_BYTES = int(os.getenv("RESPONSE_CACHE_MEMORY_BYTES", str(64 * 1024 * 1024)))  # 内存缓存的最大字节数
+RESPONSE_CACHE_MAX_ENTRY_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRY_BYTES", str(1024 * 1024)))  # 单个响应的最大字节数，超出的不缓存
+RESPONSE_CACHE_DIR = os.getenv("RESPONSE_CACHE_DIR", "")  # 磁盘缓存目录，为空时只使用内存缓存
+RESPONSE_CACHE_DISK_BYTES = int(os.getenv("RESPONSE_CACHE_DISK_BYTES", str(1024 * 1024 * 1024)))  # 磁盘缓存的最大字节数
+RESPONSE_CACHE_SHARED = os.getenv("RESPONSE_CACHE_SHARED", "false").lower() == "true"  # 不同API Key之间共享缓存，默认按Key隔离
+
+# 请求合并配置
+COALESCE_MODE = os.getenv("COALESCE_MODE", "off")  # off: 不合并（默认）; auto: 只合并 temperature 为0的请求和带 X-Proxy-Coalesce: on 的请求; all: 合并所有相同的请求
+COALESCE_PATHS = os.getenv("COALESCE_PATHS", "/api/v1/chat/completions,/api/v1/completions,/api/v1/embeddings")  # 可以合并的路径，逗号分隔
+COALESCE_MAX_BUFFER_BYTES = int(os.getenv("COALESCE_MAX_BUFFER_BYTES", str(8 * 1024 * 1024)))  # 为后加入的请求保留的最大响应字节数，超出后不再接受新的请求加入
+
+# 流式响应录制回放配置
+STREAM_REPLAY_MODE = os.getenv("STREAM_REPLAY_MODE", "off")  # off: 不录制不回放; record: 录制流式响应; replay: 有录制时回放，没有时转发上游并录制
+STREAM_REPLAY_SPEED = float(os.getenv("STREAM_REPLAY_SPEED", "1"))  # 回放倍速: 1为原速，2为两倍速，0为不等待
+# 按路径前缀或模型设置 mode 和 speed，JSON格式，键的规则同 TIMEOUT_OVERRIDES，例如
+# {"/api/v1/chat/completions": {"mode": "replay"}, "openai/*": {"speed": 0}}
+STREAM_REPLAY_RULES = json.loads(os.getenv("STREAM_REPLAY_RULES", "{}"))
+STREAM_REPLAY_TTL = float(os.getenv("STREAM_REPLAY_TTL", str(7 * 24 * 3600)))  # 录制的保留时间(秒)
+STREAM_REPLAY_MEMORY_BYTES = int(os.getenv("STREAM_REPLAY_MEMORY_BYTES", str(64 * 1024 * 1024)))  # 内存中保存录制的最大字节数
+STREAM_REPLAY_MAX_BYTES = int(os.getenv("STREAM_REPLAY_MAX_BYTES", str(4 * 1024 * 1024)))  # 单个流式响应的最大字节数，超出的不录制
+STREAM_REPLAY_DIR = os.getenv("STREAM_REPLAY_DIR", "")  # 录制保存目录，多个代理进程共享；为空时只保存在内存中
+STREAM_REPLAY_DISK_BYTES = int(os.getenv("STREAM_REPLAY_DISK_BYTES", str(1024 * 1024 * 1024)))  # 磁盘上录制的最大字节数
+STREAM_REPLAY_PRELOAD = int(os.getenv("STREAM_REPLAY_PRELOAD", "0"))  # 启动时从请求记录中导入的最近流式响应数
+
+# 目录接口缓存配置
+CATALOG_CACHE_PATHS = os.getenv("CATALOG_CACHE_PATHS", "/api/v1/models,/api/v1/providers")  # 缓存的GET接口路径，逗号分隔，按完整路径匹配，为空时不缓存
+CATALOG_CACHE_SHARED = os.getenv("CATALOG_CACHE_SHARED", "false").lower() == "true"  # 不同API Key之间共享缓存，默认按Key隔离；只应在上述接口的内容与Key无关时开启
+CATALOG_CACHE_TTL = float(os.getenv("CATALOG_CACHE_TTL", "300"))  # 缓存时间(秒)
+CATALOG_CACHE_REFRESH_RATIO = float(os.getenv("CATALOG_CACHE_REFRESH_RATIO", "0.8"))  # 缓存存在时间超过 TTL 的该比例后，收到请求时在后台提前刷新
+CATALOG_CACHE_STALE_TTL = float(os.getenv("CATALOG_CACHE_STALE_TTL", "3600"))  # 过期后仍可返回旧内容（同时后台刷新）的时间(秒)
+CATALOG_CACHE_MAX_ENTRIES = int(os.getenv("CATALOG_CACHE_MAX_ENTRIES", "256"))  # 最多缓存的不同URL数（含查询参数）
+CATALOG_CACHE_STORAGE = os.getenv("CATALOG_CACHE_STORAGE", "summary")  # 命中缓存的请求的记录方式: full 完整记录 / summary 不记录响应体 / skip 不记录
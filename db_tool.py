@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+数据库维护工具
+"""
+import argparse
+import os
+import sys
+from datetime import datetime, timedelta
+
+from config import DB_PATH, STREAM_REPLAY_DIR
+from models import RequestStorage, request_storage
+from replay import StreamReplayer
+
+
+def format_bytes(size: int) -> str:
+    """格式化字节数"""
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+
+def get_storage(db_path: str) -> RequestStorage:
+    """获取指定数据库的存储实例"""
+    if os.path.abspath(db_path) == os.path.abspath(request_storage.db_path):
+        return request_storage
+    return RequestStorage(db_path)
+
+
+def cmd_stats(storage: RequestStorage, args):
+    """显示存储统计"""
+    stats = storage.get_storage_stats()
+    print(f"📊 数据库: {storage.db_path}")
+    print(f"   记录总数: {stats['total_rows']}")
+    print(f"   已压缩记录: {stats['compressed_rows']}")
+    print(f"   未压缩旧记录: {stats['legacy_rows']}")
+    print(f"   原始大小: {format_bytes(stats['raw_bytes'])}")
+    print(f"   压缩后大小: {format_bytes(stats['stored_bytes'])}")
+    print(f"   压缩率: {stats['compression_ratio'] or '-'}")
+    print(f"   去重片段: {stats['unique_segments']} 个，被引用 {stats['segment_references']} 次"
+          f"（{format_bytes(stats['segment_raw_bytes'])} -> {format_bytes(stats['segment_stored_bytes'])}）")
+    print(f"   数据库文件: {format_bytes(stats['database_bytes'])}（可回收 {format_bytes(stats['free_bytes'])}）")
+    print(f"   压缩算法: {stats['compression']}")
+
+
+def cmd_compress(storage: RequestStorage, args):
+    """压缩旧记录"""
+    def progress(totals):
+        print(f"   已处理 {totals['rows']} 条记录...", end='\r')
+
+    totals = storage.compress_legacy_rows(batch_size=args.batch_size, progress=progress)
+    print(f"✅ 已压缩 {totals['rows']} 条记录: "
+          f"{format_bytes(totals['raw_bytes'])} -> {format_bytes(totals['stored_bytes'])}，"
+          f"耗时 {totals['cpu_seconds']:.2f}s CPU")
+    if args.vacuum:
+        print("🧹 正在整理数据库文件...")
+        storage.vacuum()
+        print("✅ 整理完成")
+
+
+def cmd_prune(storage: RequestStorage, args):
+    """删除旧记录"""
+    cutoff = datetime.now() - timedelta(days=args.days)
+    deleted = storage.delete_requests_before(cutoff, batch_size=args.batch_size)
+    print(f"✅ 已删除 {cutoff.strftime('%Y-%m-%d %H:%M:%S')} 之前的 {deleted} 条记录")
+    if args.vacuum:
+        print("🧹 正在整理数据库文件...")
+        storage.vacuum()
+        print("✅ 整理完成")
+
+
+def cmd_backfill_usage(storage: RequestStorage, args):
+    """回填旧记录的模型和用量"""
+    def progress(totals):
+        print(f"   已检查 {totals['rows']} 条记录...", end='\r')
+
+    totals = storage.backfill_usage(batch_size=args.batch_size, progress=progress)
+    print(f"✅ 已检查 {totals['rows']} 条记录，回填 {totals['updated']} 条")
+
+
+def cmd_usage(storage: RequestStorage, args):
+    """显示用量汇总"""
+    since = datetime.now() - timedelta(days=args.days) if args.days else None
+    group_by = [group.strip() for group in args.group_by.split(',') if group.strip()]
+    rows = storage.get_usage_totals(group_by, since=since)
+    print(f"📊 用量汇总（{'最近 %g 天' % args.days if args.days else '全部记录'}）")
+    for row in rows:
+        name = ' / '.join(str(row[group]) if row[group] is not None else '-' for group in group_by) or '合计'
+        cost = f"${row['cost']:.4f}" if row['cost'] is not None else '-'
+        print(f"   {name}: {row['requests']} 次请求，"
+              f"{row['prompt_tokens'] or 0} + {row['completion_tokens'] or 0} = {row['total_tokens'] or 0} tokens，"
+              f"费用 {cost}")
+
+
+def cmd_replay_import(storage: RequestStorage, args):
+    """将已保存的流式响应导入为回放录制"""
+    if not STREAM_REPLAY_DIR:
+        raise RuntimeError("请先设置 STREAM_REPLAY_DIR，录制保存在该目录中供代理进程读取")
+    records = storage.get_streamed_records(limit=args.limit, model=args.model, path=args.path)
+    count = StreamReplayer().import_records(records)
+    print(f"✅ 已检查 {len(records)} 条流式记录，导入 {count} 条录制到 {STREAM_REPLAY_DIR}")
+
+
+def cmd_train_dict(storage: RequestStorage, args):
+    """训练zstd压缩字典"""
+    dict_id = storage.train_compression_dictionary(samples=args.samples, dict_size=args.size)
+    print(f"✅ 已保存压缩字典 #{dict_id}，重启服务后生效")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI 代理数据库维护工具")
+    parser.add_argument('--db', default=DB_PATH, help="数据库文件路径")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('stats', help="显示存储统计")
+
+    compress_parser = subparsers.add_parser('compress', help="压缩旧格式的记录")
+    compress_parser.add_argument('--batch-size', type=int, default=500, help="每个事务处理的记录数")
+    compress_parser.add_argument('--vacuum', action='store_true', help="完成后整理数据库文件")
+
+    prune_parser = subparsers.add_parser('prune', help="删除旧记录并回收不再引用的片段")
+    prune_parser.add_argument('--days', type=float, required=True, help="保留最近多少天的记录")
+    prune_parser.add_argument('--batch-size', type=int, default=500, help="每个事务删除的记录数")
+    prune_parser.add_argument('--vacuum', action='store_true', help="完成后整理数据库文件")
+
+    backfill_parser = subparsers.add_parser('backfill-usage', help="从请求/响应体中回填旧记录的模型和用量")
+    backfill_parser.add_argument('--batch-size', type=int, default=500, help="每批处理的记录数")
+
+    usage_parser = subparsers.add_parser('usage', help="显示用量汇总")
+    usage_parser.add_argument('--group-by', default='model', help="分组，逗号分隔: model, key, provider, day")
+    usage_parser.add_argument('--days', type=float, help="只统计最近多少天")
+
+    replay_parser = subparsers.add_parser('replay-import', help="将最近的流式响应导入为回放录制")
+    replay_parser.add_argument('--limit', type=int, default=1000, help="最多导入的记录数")
+    replay_parser.add_argument('--model', help="只导入该模型的记录，支持*通配")
+    replay_parser.add_argument('--path', help="只导入该路径前缀的记录")
+
+    train_parser = subparsers.add_parser('train-dict', help="训练zstd压缩字典")
+    train_parser.add_argument('--samples', type=int, default=2000, help="样本记录数")
+    train_parser.add_argument('--size', type=int, default=112640, help="字典大小（字节）")
+
+    args = parser.parse_args()
+    commands = {
+        'stats': cmd_stats,
+        'compress': cmd_compress,
+        'prune': cmd_prune,
+        'backfill-usage': cmd_backfill_usage,
+        'usage': cmd_usage,
+        'replay-import': cmd_replay_import,
+        'train-dict': cmd_train_dict,
+    }
+
+    storage = get_storage(args.db)
+    try:
+        commands[args.command](storage, args)
+    except (RuntimeError, ValueError) as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+    finally:
+        storage.close()
+
+
+if __name__ == '__main__':
+    main()
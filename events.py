@@ -0,0 +1,173 @@
+"""
+仪表盘实时事件
+
+代理在请求开始和完成时发布事件，Web界面通过 /api/events (SSE) 推送给已打开的页面，
+页面据此增量更新列表和统计，不再定时轮询数据库。
+
+单进程模式下代理直接向同一进程的 EventBus 发布；多进程模式下代理进程把事件放入进程间队列，
+由Web进程转发到本进程的 EventBus。没有页面订阅时代理不生成事件。
+"""
+import asyncio
+import queue
+import threading
+from typing import Any, Callable, Dict, Optional, Set
+
+from config import EVENTS_CLIENT_QUEUE_SIZE, EVENTS_STATS_INTERVAL
+from models import RequestRecord, RequestStorage, RequestSummary
+
+def record_event(kind: str, record: RequestRecord) -> Dict[str, Any]:
+    """将请求的开始(started)或完成(completed)转换为事件"""
+    return {
+        'type': 'request',
+        'apikey': RequestStorage._extract_bearer(record.headers),
+        'state': kind,
+        'request': RequestSummary.from_record(record).to_dict(),
+    }
+
+def storage_listener(publish: Callable[[Dict[str, Any]], None],
+                     active: Callable[[], bool]) -> Callable[[str, RequestRecord], None]:
+    """创建 RequestStorage 的监听函数，有页面订阅时才生成事件"""
+    def listener(kind: str, record: RequestRecord):
+        if active():
+            publish(record_event(kind, record))
+    return listener
+
+def queue_publisher(event_queue) -> Callable[[Dict[str, Any]], None]:
+    """代理进程使用：将事件放入发往Web进程的队列，队列满时丢弃"""
+    def publish(event: Dict[str, Any]):
+        try:
+            event_queue.put_nowait(event)
+        except queue.Full:
+            pass
+    return publish
+
+class Subscription:
+    """一个页面连接的待发送事件"""
+
+    def __init__(self, max_pending: int):
+        self.queue: asyncio.Queue = asyncio.Queue(max_pending)
+        self.dropped = 0  # 因积压被丢弃的事件数，非0时页面需要重新同步
+
+    def offer(self, event: Dict[str, Any]):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def get(self) -> Optional[Dict[str, Any]]:
+        """等待下一个事件，连接需要关闭时返回 None"""
+        return await self.queue.get()
+
+    def close(self):
+        """通知连接结束，必要时丢弃一个积压的事件以放入结束标记"""
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+class EventBus:
+    """进程内的事件总线，publish 只在事件循环线程中调用"""
+
+    def __init__(self, max_pending: int = EVENTS_CLIENT_QUEUE_SIZE,
+                 stats_interval: float = EVENTS_STATS_INTERVAL):
+        self.max_pending = max_pending
+        self.stats_interval = stats_interval
+        self._subscribers: Set[Subscription] = set()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stats_task: Optional[asyncio.Task] = None
+        self._shared_count = None  # 多进程模式下与代理进程共享的订阅数
+        # 按API Key累计的统计增量，定期合并为一个事件
+        self._pending_stats: Dict[Optional[str], Dict[str, float]] = {}
+
+    def has_subscribers(self) -> bool:
+        return bool(self._subscribers)
+
+    def share_subscriber_count(self, shared_count):
+        """将订阅数写入共享内存，代理进程据此决定是否发送事件"""
+        self._shared_count = shared_count
+        shared_count.value = len(self._subscribers)
+
+    def _update_shared_count(self):
+        if self._shared_count is not None:
+            self._shared_count.value = len(self._subscribers)
+
+    def start(self):
+        """在事件循环中启动总线"""
+        self._loop = asyncio.get_running_loop()
+        if self._stats_task is None or self._stats_task.done():
+            self._stats_task = asyncio.ensure_future(self._emit_stats())
+
+    async def stop(self):
+        """停止总线并结束所有页面连接，避免服务关闭时等待长连接超时"""
+        for subscription in list(self._subscribers):
+            subscription.close()
+        if self._stats_task is not None:
+            self._stats_task.cancel()
+            try:
+                await self._stats_task
+            except asyncio.CancelledError:
+                pass
+            self._stats_task = None
+
+    def subscribe(self) -> Subscription:
+        subscription = Subscription(self.max_pending)
+        self._subscribers.add(subscription)
+        self._update_shared_count()
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        self._subscribers.discard(subscription)
+        self._update_shared_count()
+
+    def publish(self, event: Dict[str, Any]):
+        """发布事件给所有订阅者，完成的请求同时计入统计增量"""
+        if event.get('type') == 'request' and event.get('state') == 'completed':
+            self._add_stats(event)
+        for subscription in self._subscribers:
+            subscription.offer(event)
+
+    def publish_threadsafe(self, event: Dict[str, Any]):
+        """从其他线程发布事件"""
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self.publish, event)
+
+    def consume(self, event_queue):
+        """在后台线程中读取代理进程发来的事件并发布"""
+        def run():
+            while True:
+                try:
+                    event = event_queue.get()
+                except (EOFError, OSError):
+                    return
+                self.publish_threadsafe(event)
+
+        threading.Thread(target=run, name='event-consumer', daemon=True).start()
+
+    def _add_stats(self, event: Dict[str, Any]):
+        request = event['request']
+        status = request.get('response_status')
+        stats = self._pending_stats.get(event.get('apikey'))
+        if stats is None:
+            stats = self._pending_stats[event.get('apikey')] = {
+                'requests': 0, 'errors': 0, 'latency_count': 0, 'latency_sum': 0.0
+            }
+        stats['requests'] += 1
+        # 与统计汇总表的错误定义一致
+        stats['errors'] += request.get('error') is not None or not status or status >= 400
+        if request.get('duration_ms') is not None:
+            stats['latency_count'] += 1
+            stats['latency_sum'] += request['duration_ms']
+
+    async def _emit_stats(self):
+        """定期发送合并后的统计增量，没有请求完成时不发送"""
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            if not self._pending_stats:
+                continue
+            pending, self._pending_stats = self._pending_stats, {}
+            for apikey, delta in pending.items():
+                event = {'type': 'stats', 'apikey': apikey, 'delta': delta}
+                for subscription in self._subscribers:
+                    subscription.offer(event)
+
+# 全局事件总线
+event_bus = EventBus()
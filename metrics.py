@@ -0,0 +1,266 @@
+"""
+Prometheus文本格式的指标注册表
+
+记录操作只修改预先分配的数值：每组标签的子对象在首次使用时创建并缓存，
+直方图的桶计数是固定长度的列表，通过二分查找定位桶。
+"""
+import math
+import re
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence, Set, Tuple, Union
+
+from config import METRICS_MAX_SERIES, METRICS_ROUTES, METRICS_MAX_MODELS
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# 默认的延迟桶(秒)，覆盖从毫秒级到数分钟的请求
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+# 标签组合超出上限后统一归入该值，避免路径或模型名导致序列无限增长
+OVERFLOW_LABEL = 'other'
+
+# 可以作为标签值的模型名
+MODEL_LABEL_PATTERN = re.compile(r'[\w.:/@+-]{1,128}')
+
+FunctionResult = Union[Optional[float], Dict[Tuple[str, ...], float]]
+
+def _escape(value: str) -> str:
+    """转义标签值"""
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_value(value: float) -> str:
+    """格式化样本值"""
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    """格式化标签集合"""
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+class RouteLabels:
+    """把请求路径归并为已知的路由模板，其他路径记为 other
+
+    路径由客户端决定，直接作为标签会让序列数量失控；模板中的 {name} 匹配任意一段路径。
+    """
+
+    def __init__(self, routes: str = METRICS_ROUTES):
+        self.exact: Set[str] = set()
+        self.templates: List[Tuple[str, Tuple[str, ...]]] = []
+        for route in (route.strip() for route in routes.split(',')):
+            if not route:
+                continue
+            parts = tuple(route.strip('/').split('/'))
+            if any(part.startswith('{') and part.endswith('}') for part in parts):
+                self.templates.append((route, parts))
+            else:
+                self.exact.add(route)
+
+    def label(self, path: str) -> str:
+        if path in self.exact:
+            return path
+        parts = path.strip('/').split('/')
+        for route, template in self.templates:
+            if len(parts) == len(template) and all(
+                    part == expected or (expected.startswith('{') and part)
+                    for part, expected in zip(parts, template)):
+                return route
+        return OVERFLOW_LABEL
+
+class ModelLabels:
+    """限制作为标签的模型名：格式不合法或超过数量上限的模型记为 other"""
+
+    def __init__(self, max_models: int = METRICS_MAX_MODELS):
+        self.max_models = max_models
+        self._seen: Set[str] = set()
+
+    def label(self, model: Optional[str]) -> str:
+        if not model:
+            return ''
+        if model in self._seen:
+            return model
+        if len(self._seen) >= self.max_models or not MODEL_LABEL_PATTERN.fullmatch(model):
+            return OVERFLOW_LABEL
+        self._seen.add(model)
+        return model
+
+class _CounterChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+class _GaugeChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+    def dec(self, amount: float = 1.0):
+        self.value -= amount
+
+class _HistogramChild:
+    __slots__ = ('upper_bounds', 'counts', 'sum')
+
+    def __init__(self, upper_bounds: Tuple[float, ...]):
+        self.upper_bounds = upper_bounds
+        self.counts = [0] * (len(upper_bounds) + 1)  # 最后一个为 +Inf 桶
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.upper_bounds, value)] += 1
+        self.sum += value
+
+class _Metric:
+    """指标基类，按标签值缓存子对象"""
+
+    TYPE = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 function: Optional[Callable[[], FunctionResult]] = None,
+                 max_series: int = METRICS_MAX_SERIES):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.function = function  # 抓取时计算数值，用于读取已有的统计信息
+        self.max_series = max_series
+        self._children: Dict[Tuple[str, ...], object] = {}
+        self._default = None if self.labelnames or function else self.labels()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values: str):
+        """获取一组标签值对应的子对象"""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}")
+            if len(self._children) >= self.max_series:
+                values = (OVERFLOW_LABEL,) * len(values)
+                child = self._children.get(values)
+            if child is None:
+                child = self._children[values] = self._new_child()
+        return child
+
+    def _values(self) -> List[Tuple[Tuple[str, ...], float]]:
+        """当前的 (标签值, 数值) 列表"""
+        if self.function is not None:
+            result = self.function()
+            if result is None:
+                return []
+            if isinstance(result, dict):
+                return list(result.items())
+            return [((), float(result))]
+        return [(values, child.value) for values, child in self._children.items()]
+
+    def render(self) -> List[str]:
+        """生成文本格式的样本行"""
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.TYPE}']
+        for values, value in self._values():
+            lines.append(f'{self.name}{_format_labels(self.labelnames, values)} {_format_value(value)}')
+        return lines
+
+class Counter(_Metric):
+    """只增不减的计数器"""
+
+    TYPE = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1.0):
+        self._default.inc(amount)
+
+class Gauge(_Metric):
+    """可增可减的数值"""
+
+    TYPE = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value: float):
+        self._default.set(value)
+
+    def inc(self, amount: float = 1.0):
+        self._default.inc(amount)
+
+    def dec(self, amount: float = 1.0):
+        self._default.dec(amount)
+
+class Histogram(_Metric):
+    """固定桶的直方图"""
+
+    TYPE = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS, max_series: int = METRICS_MAX_SERIES):
+        self.upper_bounds = tuple(sorted(float(bound) for bound in buckets if bound != math.inf))
+        super().__init__(name, documentation, labelnames, max_series=max_series)
+
+    def _new_child(self):
+        return _HistogramChild(self.upper_bounds)
+
+    def observe(self, value: float):
+        self._default.observe(value)
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.TYPE}']
+        names = self.labelnames + ('le',)
+        for values, child in self._children.items():
+            cumulative = 0
+            for bound, count in zip(self.upper_bounds + (math.inf,), child.counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_format_labels(names, values + (_format_value(bound),))} '
+                             f'{cumulative}')
+            labels = _format_labels(self.labelnames, values)
+            lines.append(f'{self.name}_sum{labels} {_format_value(child.sum)}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+class Registry:
+    """指标注册表"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        """注册指标，名称不能重复"""
+        if metric.name in self._metrics:
+            raise ValueError(f"Duplicate metric: {metric.name}")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, *args, **kwargs) -> Counter:
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs) -> Gauge:
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs) -> Histogram:
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self) -> str:
+        """生成Prometheus文本格式的全部指标"""
+        lines = []
+        for metric in self._metrics.values():
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                # 统计回调出错不影响其他指标
+                lines.append(f'# {metric.name} unavailable: {e!r}')
+        return '\n'.join(lines) + '\n'
@@ -2,13 +2,263 @@
 数据模型和存储
 """
 import json
+import re
 import uuid
+import time
+import zlib
+import hashlib
+import struct
+import atexit
 import sqlite3
-from datetime import datetime
-from typing import Dict, List, Optional, Any
-from dataclasses import dataclass, asdict
+from bisect import bisect_left
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Any, Callable, Sequence, Tuple
+from dataclasses import dataclass, asdict, replace
 import threading
+import queue
 import os
+from contextlib import contextmanager
+from pathlib import Path
+from urllib.parse import urlsplit
+
+from config import (
+    STORAGE_QUEUE_SIZE, STORAGE_BATCH_SIZE, STORAGE_FLUSH_INTERVAL, STORAGE_OVERFLOW_POLICY,
+    STORAGE_WRITE_RETRIES, STORAGE_RETRY_BACKOFF,
+    SQLITE_READ_POOL_SIZE, SQLITE_SYNCHRONOUS, SQLITE_CACHE_SIZE_KB, SQLITE_MMAP_SIZE,
+    SQLITE_STATEMENT_CACHE, SQLITE_BUSY_TIMEOUT_MS, STORAGE_COMPRESSION, STORAGE_COMPRESSION_LEVEL,
+    DB_PATH, STORAGE_DEDUP, DEDUP_MIN_SEGMENT_SIZE, STATS_MINUTE_RETENTION_HOURS
+)
+
+from sse import extract_usage
+
+try:
+    import zstandard
+except ImportError:  # zstd为可选依赖
+    zstandard = None
+
+# 队列溢出时替代被丢弃内容的占位文本
+BODY_DROPPED_PLACEHOLDER = "[body dropped: storage queue full]"
+
+# 分页游标: (timestamp, id)
+Cursor = Tuple[str, str]
+
+def encode_cursor(record: 'RequestRecord') -> str:
+    """将记录编码为分页游标"""
+    return f"{record.timestamp.isoformat()},{record.id}"
+
+def decode_cursor(value: str) -> Cursor:
+    """解析分页游标，格式为 <timestamp>,<id>"""
+    timestamp, sep, request_id = value.partition(',')
+    if not sep or not request_id:
+        raise ValueError(f"Invalid cursor: {value}")
+    datetime.fromisoformat(timestamp)
+    return timestamp, request_id
+
+# 全文检索中可以按字段限定的列，例如 model:gpt-4 status:200
+FTS_FIELDS = {
+    'url': 'url',
+    'method': 'method',
+    'model': 'model',
+    'status': 'status',
+    'body': 'body',
+    'request': 'body',
+    'response': 'response_body',
+}
+_FTS_TOKEN_RE = re.compile(r'(?:(\w+):)?("[^"]*"?|\S+)')
+_MODEL_RE = re.compile(r'"model"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+def extract_model(body: Optional[str]) -> Optional[str]:
+    """从JSON请求体中提取模型名称"""
+    if not body:
+        return None
+    match = _MODEL_RE.search(body)
+    return match.group(1) if match else None
+
+PREVIEW_LENGTH = 120  # 列表预览的最大字符数
+
+def make_preview(body: Optional[str], length: int = PREVIEW_LENGTH) -> Optional[str]:
+    """生成请求体的简短预览，聊天请求取最后一条消息的文本"""
+    if not body:
+        return None
+    text = body
+    try:
+        data = json.loads(body)
+        if isinstance(data, dict):
+            messages = data.get('messages')
+            if isinstance(messages, list) and messages and isinstance(messages[-1], dict):
+                content = messages[-1].get('content')
+                if isinstance(content, list):
+                    content = ' '.join(part.get('text', '') for part in content if isinstance(part, dict))
+                if isinstance(content, str):
+                    text = content
+            elif isinstance(data.get('prompt'), str):
+                text = data['prompt']
+            elif isinstance(data.get('input'), str):
+                text = data['input']
+    except (ValueError, TypeError):
+        pass
+    text = ' '.join(text.split())
+    return text[:length] + '…' if len(text) > length else text
+
+def text_size(text: Optional[str]) -> Optional[int]:
+    """文本的UTF-8字节数"""
+    return len(text.encode('utf-8')) if text is not None else None
+
+def build_fts_query(query: str) -> str:
+    """将搜索框输入转换为FTS5查询
+
+    支持 "短语"、前缀匹配 foo*、字段限定 model:xxx / status:200，
+    以及大写的 AND / OR / NOT 运算符，其余内容都按普通词处理。
+    """
+    parts = []
+    for field, term in _FTS_TOKEN_RE.findall(query):
+        if not field and term in ('AND', 'OR', 'NOT'):
+            parts.append(term)
+            continue
+        column = FTS_FIELDS.get(field.lower()) if field else None
+        if field and not column:
+            term = f"{field}:{term}"
+        prefix = term.endswith('*') and not term.startswith('"')
+        text = term.rstrip('*') if prefix else term
+        if text.startswith('"'):
+            text = text[1:-1] if len(text) > 1 and text.endswith('"') else text[1:]
+        if not text:
+            continue
+        phrase = '"' + text.replace('"', '""') + '"' + ('*' if prefix else '')
+        parts.append(f"{column} : {phrase}" if column else phrase)
+    # 去掉首尾多余的运算符，避免语法错误
+    while parts and parts[0] in ('AND', 'OR', 'NOT'):
+        parts.pop(0)
+    while parts and parts[-1] in ('AND', 'OR', 'NOT'):
+        parts.pop()
+    return ' '.join(parts)
+
+# 参与去重的请求体字段：其中每个数组元素作为一个片段单独存储
+SEGMENT_FIELDS = ('messages', 'tools', 'functions')
+_JSON_DECODER = json.JSONDecoder()
+_JSON_WS_RE = re.compile(r'[ \t\n\r]*')
+
+def segment_hash(text: str) -> str:
+    """片段内容的哈希，作为去重表的主键"""
+    return hashlib.sha256(text.encode('utf-8', errors='replace')).hexdigest()
+
+def split_segments(body: Optional[str], min_size: int = DEDUP_MIN_SEGMENT_SIZE) -> Optional[Tuple[List[str], List[str]]]:
+    """将聊天请求体拆分为模板文本和可去重的片段
+
+    返回 (parts, segments)，原文为 parts[0] + segments[0] + parts[1] + ... + parts[-1]，
+    按原始文本的位置切分，保证能逐字节还原。不是JSON对象或没有足够大的片段时返回None。
+    """
+    if not body or not any(f'"{field}"' in body for field in SEGMENT_FIELDS):
+        return None
+    spans = []
+    try:
+        index = _JSON_WS_RE.match(body, 0).end()
+        if body[index:index + 1] != '{':
+            return None
+        index = _JSON_WS_RE.match(body, index + 1).end()
+        while body[index:index + 1] != '}':
+            key, index = _JSON_DECODER.raw_decode(body, index)
+            index = _JSON_WS_RE.match(body, index).end()
+            if body[index:index + 1] != ':':
+                return None
+            index = _JSON_WS_RE.match(body, index + 1).end()
+            if key in SEGMENT_FIELDS and body[index:index + 1] == '[':
+                index = _JSON_WS_RE.match(body, index + 1).end()
+                while body[index:index + 1] != ']':
+                    _, end = _JSON_DECODER.raw_decode(body, index)
+                    if end - index >= min_size:
+                        spans.append((index, end))
+                    index = _JSON_WS_RE.match(body, end).end()
+                    if body[index:index + 1] == ',':
+                        index = _JSON_WS_RE.match(body, index + 1).end()
+                    elif body[index:index + 1] != ']':
+                        return None
+                index += 1
+            else:
+                _, index = _JSON_DECODER.raw_decode(body, index)
+            index = _JSON_WS_RE.match(body, index).end()
+            if body[index:index + 1] == ',':
+                index = _JSON_WS_RE.match(body, index + 1).end()
+            elif body[index:index + 1] != '}':
+                return None
+    except ValueError:
+        return None
+    if not spans:
+        return None
+    
+    parts, segments, position = [], [], 0
+    for start, end in spans:
+        parts.append(body[position:start])
+        segments.append(body[start:end])
+        position = end
+    parts.append(body[position:])
+    if join_segments(parts, segments) != body:
+        return None
+    return parts, segments
+
+def join_segments(parts: List[str], segments: List[str]) -> str:
+    """按模板文本和片段还原请求体"""
+    pieces = [parts[0]]
+    for segment, part in zip(segments, parts[1:]):
+        pieces.append(segment)
+        pieces.append(part)
+    return ''.join(pieces)
+
+# 请求的延迟指标（均可为空），既是 RequestRecord 字段也是 requests 表的列
+TIMING_FIELDS = (
+    'connect_ms',         # 建立上游连接的耗时，复用连接时为0
+    'ttfb_ms',            # 收到上游响应头的时间
+    'ttft_ms',            # 收到第一个输出内容的时间（流式）
+    'gap_p50_ms',         # 上游数据块间隔的分位数（流式）
+    'gap_p95_ms',
+    'gap_p99_ms',
+    'tokens_per_second',  # 生成速度，按 usage.completion_tokens 计算（流式）
+    'chars_per_second',   # 生成速度，按输出字符数计算（流式）
+)
+
+# 从响应中提取的模型、生成ID、供应商和用量，同样是 RequestRecord 字段和 requests 表的列
+USAGE_FIELDS = (
+    'model',              # 响应中的实际模型，没有时为请求中的模型
+    'generation_id',      # 响应的 id（OpenRouter 的生成ID）
+    'provider',           # OpenRouter 返回的供应商
+    'prompt_tokens',
+    'completion_tokens',
+    'total_tokens',
+    'cost',               # usage.cost（需开启 OpenRouter 用量统计）
+)
+
+# 响应完成时记录的附加列，cache_status 为响应缓存的处理结果: hit / miss / bypass，
+# 加入相同请求、未发往上游的请求为 coalesced，回放录制的流式响应为 replay；coalesced 为加入该请求的相同请求数
+RESPONSE_FIELDS = TIMING_FIELDS + USAGE_FIELDS + ('cache_status', 'coalesced')
+
+# 用量汇总可用的分组
+USAGE_GROUPS = {
+    'model': 'requests.model',
+    'key': 'requests.authorization_bearer',
+    'provider': 'requests.provider',
+    'day': 'substr(requests.timestamp, 1, 10)',
+}
+
+# 列表中可以排序和按范围过滤的列
+SORTABLE_COLUMNS = ('duration_ms', 'bytes_out') + TIMING_FIELDS + ('prompt_tokens', 'completion_tokens',
+                                                                   'total_tokens', 'cost')
+
+# 统计汇总表：表名和时间桶（时间戳ISO格式的前缀）长度
+ROLLUP_TABLES = {
+    'minute': ('stats_minute', 16),  # 2024-01-01T12:34
+    'hour': ('stats_hour', 13),      # 2024-01-01T12
+}
+
+# 统计可用的分组，对应汇总表的列
+STATS_GROUPS = {
+    'key': 'apikey',
+    'model': 'model',
+    'status': 'status',
+}
+
+# 汇总表中延迟直方图各桶的上界(毫秒)，最后一个桶为 +Inf
+LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 20000, 30000, 60000, 120000, 300000)
 
 @dataclass
 class RequestRecord:
@@ -24,6 +274,24 @@ class RequestRecord:
     response_body: Optional[str] = None
     duration_ms: Optional[float] = None
     error: Optional[str] = None
+    bytes_out: Optional[int] = None  # 已发送给客户端的响应字节数
+    connect_ms: Optional[float] = None
+    ttfb_ms: Optional[float] = None
+    ttft_ms: Optional[float] = None
+    gap_p50_ms: Optional[float] = None
+    gap_p95_ms: Optional[float] = None
+    gap_p99_ms: Optional[float] = None
+    tokens_per_second: Optional[float] = None
+    chars_per_second: Optional[float] = None
+    model: Optional[str] = None
+    generation_id: Optional[str] = None
+    provider: Optional[str] = None
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    total_tokens: Optional[int] = None
+    cost: Optional[float] = None
+    cache_status: Optional[str] = None
+    coalesced: Optional[int] = None
     
     def to_dict(self) -> Dict[str, Any]:
         """转换为字典格式"""
@@ -31,23 +299,794 @@ class RequestRecord:
         data['timestamp'] = self.timestamp.isoformat()
         return data
     
+    def body_fields(self) -> Tuple[Optional[int], Optional[int], Optional[str]]:
+        """请求体大小、响应体大小和预览
+
+        计算代价与请求/响应体的大小成正比，结果缓存在记录上（不是数据类字段，不会被存储），
+        请求开始和完成的事件、列表和写入时只各计算一次；请求/响应体被替换后重新计算。
+        """
+        cached = getattr(self, '_body_cache', None)
+        if cached is None or cached[0] is not self.body:
+            cached = self._body_cache = (self.body, text_size(self.body), make_preview(self.body))
+        response = getattr(self, '_response_cache', None)
+        if response is None or response[0] is not self.response_body:
+            response = self._response_cache = (self.response_body, text_size(self.response_body))
+        return cached[1], response[1], cached[2]
+    
     @classmethod
     def from_dict(cls, data: Dict[str, Any]) -> 'RequestRecord':
         """从字典创建实例"""
         data['timestamp'] = datetime.fromisoformat(data['timestamp'])
         return cls(**data)
 
+class RequestSummary:
+    """列表视图使用的请求摘要，不包含请求头和请求/响应体"""
+
+    __slots__ = ('id', 'timestamp', 'method', 'url', 'response_status', 'duration_ms',
+                 'error', 'body_size', 'response_size', 'preview', 'ttft_ms', 'tokens_per_second',
+                 'model', 'total_tokens', 'cost', 'cache_status', 'coalesced')
+
+    # 对应的数据库列，顺序与 __slots__ 一致
+    COLUMNS = ', '.join(__slots__)
+
+    def __init__(self, id: str, timestamp: datetime, method: str, url: str,
+                 response_status: Optional[int] = None, duration_ms: Optional[float] = None,
+                 error: Optional[str] = None, body_size: Optional[int] = None,
+                 response_size: Optional[int] = None, preview: Optional[str] = None,
+                 ttft_ms: Optional[float] = None, tokens_per_second: Optional[float] = None,
+                 model: Optional[str] = None, total_tokens: Optional[int] = None, cost: Optional[float] = None,
+                 cache_status: Optional[str] = None, coalesced: Optional[int] = None):
+        self.id = id
+        self.timestamp = timestamp
+        self.method = method
+        self.url = url
+        self.response_status = response_status
+        self.duration_ms = duration_ms
+        self.error = error
+        self.body_size = body_size
+        self.response_size = response_size
+        self.preview = preview
+        self.ttft_ms = ttft_ms
+        self.tokens_per_second = tokens_per_second
+        self.model = model
+        self.total_tokens = total_tokens
+        self.cost = cost
+        self.cache_status = cache_status
+        self.coalesced = coalesced
+
+    @classmethod
+    def from_row(cls, row) -> 'RequestSummary':
+        """从数据库行创建摘要"""
+        return cls(row[0], datetime.fromisoformat(row[1]), *row[2:])
+
+    @classmethod
+    def from_record(cls, record: RequestRecord) -> 'RequestSummary':
+        """从完整记录创建摘要"""
+        body_size, response_size, preview = record.body_fields()
+        return cls(
+            id=record.id,
+            timestamp=record.timestamp,
+            method=record.method,
+            url=record.url,
+            response_status=record.response_status,
+            duration_ms=record.duration_ms,
+            error=record.error,
+            body_size=body_size,
+            response_size=response_size,
+            preview=preview,
+            ttft_ms=record.ttft_ms,
+            tokens_per_second=record.tokens_per_second,
+            model=record.model,
+            total_tokens=record.total_tokens,
+            cost=record.cost,
+            cache_status=record.cache_status,
+            coalesced=record.coalesced
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        """转换为字典格式"""
+        data = {name: getattr(self, name) for name in self.__slots__}
+        data['timestamp'] = self.timestamp.isoformat()
+        return data
+
+class LatencyStats:
+    """一组请求的计数、错误数和延迟直方图，可以合并，分位数按直方图估算"""
+
+    __slots__ = ('requests', 'errors', 'latency_count', 'latency_sum', 'histogram')
+
+    def __init__(self, requests: int = 0, errors: int = 0, latency_count: int = 0,
+                 latency_sum: float = 0.0, histogram: Optional[List[int]] = None):
+        self.requests = requests
+        self.errors = errors
+        self.latency_count = latency_count
+        self.latency_sum = latency_sum
+        self.histogram = histogram or [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    @classmethod
+    def from_row(cls, row) -> 'LatencyStats':
+        """从汇总表的 (requests, errors, latency_count, latency_sum, histogram) 创建"""
+        return cls(row[0], row[1], row[2], row[3], json.loads(row[4]))
+
+    def add(self, duration_ms: Optional[float], error: bool):
+        """计入一个请求"""
+        self.requests += 1
+        self.errors += error
+        if duration_ms is not None:
+            self.latency_count += 1
+            self.latency_sum += duration_ms
+            self.histogram[bisect_left(LATENCY_BUCKETS_MS, duration_ms)] += 1
+
+    def merge(self, other: 'LatencyStats'):
+        """合并另一组统计"""
+        self.requests += other.requests
+        self.errors += other.errors
+        self.latency_count += other.latency_count
+        self.latency_sum += other.latency_sum
+        self.histogram = [a + b for a, b in zip(self.histogram, other.histogram)]
+
+    def values(self) -> Tuple:
+        """写入汇总表的列值"""
+        return self.requests, self.errors, self.latency_count, self.latency_sum, json.dumps(self.histogram)
+
+    def percentile(self, p: float) -> Optional[float]:
+        """估算延迟分位数(毫秒)，在所在的桶内线性插值，落在最后一个桶时返回其下界"""
+        if not self.latency_count:
+            return None
+        rank = p / 100 * self.latency_count
+        cumulative = 0
+        for index, count in enumerate(self.histogram):
+            if count and cumulative + count >= rank:
+                lower = LATENCY_BUCKETS_MS[index - 1] if index else 0
+                if index == len(LATENCY_BUCKETS_MS):
+                    return float(lower)
+                return lower + (LATENCY_BUCKETS_MS[index] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return float(LATENCY_BUCKETS_MS[-1])
+
+    def to_dict(self) -> Dict[str, Any]:
+        """转换为API返回的统计结果"""
+        def rounded(value: Optional[float]) -> Optional[float]:
+            return round(value, 2) if value is not None else None
+
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'success_rate': rounded((self.requests - self.errors) / self.requests * 100) if self.requests else None,
+            'avg_latency_ms': rounded(self.latency_sum / self.latency_count) if self.latency_count else None,
+            'p50_ms': rounded(self.percentile(50)),
+            'p90_ms': rounded(self.percentile(90)),
+            'p95_ms': rounded(self.percentile(95)),
+            'p99_ms': rounded(self.percentile(99)),
+        }
+
+class WriteBehindQueue:
+    """后台批量写入队列
+
+    已完成的请求记录先进入有界内存队列，由独立的写线程按批次
+    （数量或时间触发）在单个事务中落盘，调用方不再等待SQLite的磁盘I/O。
+    数据库忙等临时错误按指数退避重试；整批仍然失败时逐条写入，只丢弃写不进去的记录，
+    丢弃的记录交给 discard_func。
+    """
+
+    OVERFLOW_POLICIES = ('block', 'drop_bodies', 'drop_records')
+
+    def __init__(self, flush_func: Callable[[List[RequestRecord]], None],
+                 max_size: int = STORAGE_QUEUE_SIZE,
+                 batch_size: int = STORAGE_BATCH_SIZE,
+                 flush_interval: float = STORAGE_FLUSH_INTERVAL,
+                 overflow_policy: str = STORAGE_OVERFLOW_POLICY,
+                 discard_func: Optional[Callable[[List[RequestRecord]], None]] = None,
+                 retries: int = STORAGE_WRITE_RETRIES,
+                 retry_backoff: float = STORAGE_RETRY_BACKOFF):
+        if overflow_policy not in self.OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown storage overflow policy: {overflow_policy}")
+
+        self._flush_func = flush_func
+        self.max_size = max(1, max_size)
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = max(0.0, flush_interval)
+        self.overflow_policy = overflow_policy
+        self._discard_func = discard_func
+        self.retries = max(0, retries)
+        self.retry_backoff = max(0.0, retry_backoff)
+
+        self._items: deque = deque()
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+        self._busy = False
+        self._flush_requested = False
+
+        # 统计信息
+        self.batches_flushed = 0
+        self.records_flushed = 0
+        self.records_failed = 0
+        self.records_dropped = 0
+        self.bodies_dropped = 0
+        self.write_retries = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self._total_flush_ms = 0.0
+        self._flush_count = 0
+
+    def _ensure_thread(self):
+        """按需启动写线程"""
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='storage-writer', daemon=True)
+            self._thread.start()
+
+    def put(self, record: RequestRecord) -> bool:
+        """提交待写入的记录，返回记录是否被接受"""
+        with self._cond:
+            if self._closed:
+                return False
+
+            if len(self._items) >= self.max_size:
+                if self.overflow_policy == 'block':
+                    while len(self._items) >= self.max_size and not self._closed:
+                        self._cond.wait()
+                elif self.overflow_policy == 'drop_bodies' and len(self._items) < self.max_size * 2:
+                    # 软上限：丢弃请求/响应体，仅保留元数据；超过两倍容量时整条丢弃
+                    record = self._strip_bodies(record)
+                    self.bodies_dropped += 1
+                else:
+                    self.records_dropped += 1
+                    return False
+
+            self._items.append(record)
+            self._ensure_thread()
+            if len(self._items) == 1 or len(self._items) >= self.batch_size:
+                self._cond.notify_all()
+            return True
+
+    @staticmethod
+    def _strip_bodies(record: RequestRecord) -> RequestRecord:
+        """移除记录中的请求体和响应体"""
+        return replace(
+            record,
+            body=BODY_DROPPED_PLACEHOLDER if record.body is not None else None,
+            response_body=BODY_DROPPED_PLACEHOLDER if record.response_body is not None else None
+        )
+
+    def _run(self):
+        """写线程主循环"""
+        while True:
+            with self._cond:
+                while not self._items and not self._closed:
+                    self._cond.wait()
+                if not self._items:
+                    return
+
+                # 等待凑满一批或到达最长等待时间
+                deadline = time.monotonic() + self.flush_interval
+                while (len(self._items) < self.batch_size and not self._closed
+                       and not self._flush_requested):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+
+                count = min(self.batch_size, len(self._items))
+                batch = [self._items.popleft() for _ in range(count)]
+                if not self._items:
+                    self._flush_requested = False
+                self._busy = True
+                self._cond.notify_all()
+
+            start = time.perf_counter()
+            failed = self._write(batch)
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            if failed and self._discard_func is not None:
+                try:
+                    self._discard_func(failed)
+                except Exception as e:
+                    print(f"Error discarding failed storage records: {e}")
+
+            with self._cond:
+                self._busy = False
+                self.records_failed += len(failed)
+                self.records_flushed += len(batch) - len(failed)
+                if not failed:
+                    self.batches_flushed += 1
+                self._flush_count += 1
+                self.last_flush_ms = elapsed_ms
+                self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+                self._total_flush_ms += elapsed_ms
+                self._cond.notify_all()
+
+    def _write(self, batch: List[RequestRecord]) -> List[RequestRecord]:
+        """写入一批记录，返回最终写入失败的记录"""
+        try:
+            self._write_with_retry(batch)
+            return []
+        except Exception as e:
+            print(f"Error flushing storage batch: {e}")
+        if len(batch) == 1:
+            return batch
+        # 整批失败时逐条写入，找出写不进去的记录
+        failed = []
+        for record in batch:
+            try:
+                self._flush_func([record])
+            except Exception as e:
+                print(f"Error writing storage record {record.id}: {e}")
+                failed.append(record)
+        return failed
+
+    def _write_with_retry(self, batch: List[RequestRecord]):
+        """调用写入函数，数据库忙等临时错误时按指数退避重试"""
+        delay = self.retry_backoff
+        for attempt in range(self.retries + 1):
+            try:
+                return self._flush_func(batch)
+            except sqlite3.OperationalError as e:
+                if attempt == self.retries:
+                    raise
+                print(f"Error flushing storage batch, retrying in {delay:.2f}s: {e}")
+                with self._cond:
+                    self.write_retries += 1
+                time.sleep(delay)
+                delay *= 2
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """等待队列中已有的记录全部落盘"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._flush_requested = True
+            self._cond.notify_all()
+            while self._items or self._busy:
+                if self._thread is None or not self._thread.is_alive():
+                    return False
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def close(self, timeout: Optional[float] = 10.0):
+        """停止接收新记录并等待剩余记录落盘"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        """队列统计信息"""
+        with self._cond:
+            flushes = self._flush_count
+            return {
+                'queue_depth': len(self._items),
+                'max_queue_size': self.max_size,
+                'overflow_policy': self.overflow_policy,
+                'batches_flushed': self.batches_flushed,
+                'records_flushed': self.records_flushed,
+                'records_failed': self.records_failed,
+                'records_dropped': self.records_dropped,
+                'bodies_dropped': self.bodies_dropped,
+                'write_retries': self.write_retries,
+                'last_flush_ms': round(self.last_flush_ms, 2),
+                'avg_flush_ms': round(self._total_flush_ms / flushes, 2) if flushes else 0,
+                'max_flush_ms': round(self.max_flush_ms, 2),
+            }
+
+class ProcessQueueWriter:
+    """多进程模式下代理进程使用的写入端
+
+    接口与 WriteBehindQueue 相同，已完成的记录通过进程间队列
+    交给唯一的存储写入进程，代理进程自身不写SQLite。
+    """
+
+    def __init__(self, process_queue, overflow_policy: str = STORAGE_OVERFLOW_POLICY):
+        if overflow_policy not in WriteBehindQueue.OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown storage overflow policy: {overflow_policy}")
+        self._queue = process_queue
+        self.overflow_policy = overflow_policy
+        self.records_sent = 0
+        self.records_dropped = 0
+        self.bodies_dropped = 0
+
+    def put(self, record: RequestRecord) -> bool:
+        """发送一条已完成的记录，返回是否被接受"""
+        try:
+            if self.overflow_policy == 'block':
+                self._queue.put(record)
+            else:
+                self._queue.put_nowait(record)
+        except queue.Full:
+            if self.overflow_policy != 'drop_bodies':
+                self.records_dropped += 1
+                return False
+            try:
+                self._queue.put_nowait(WriteBehindQueue._strip_bodies(record))
+            except queue.Full:
+                self.records_dropped += 1
+                return False
+            self.bodies_dropped += 1
+        self.records_sent += 1
+        return True
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """记录由写入进程落盘，这里无法等待确认"""
+        return True
+
+    def close(self, timeout: Optional[float] = None):
+        """进程退出时multiprocessing会等待队列中的数据发送完毕"""
+
+    def stats(self) -> Dict[str, Any]:
+        """发送统计信息"""
+        try:
+            depth = self._queue.qsize()
+        except NotImplementedError:  # macOS不支持qsize，指标中报告为-1
+            depth = -1
+        return {
+            'queue_depth': depth,
+            'overflow_policy': self.overflow_policy,
+            'records_sent': self.records_sent,
+            'records_dropped': self.records_dropped,
+            'bodies_dropped': self.bodies_dropped,
+        }
+
+class SharedStorageStats:
+    """多进程模式下存储写入进程的统计
+
+    写入进程定期把写入队列和压缩统计写入共享内存数组，只读的Web进程从中读取，
+    而不是报告自己进程中并未使用的写入队列。
+    """
+
+    QUEUE_FIELDS = ('queue_depth', 'max_queue_size', 'batches_flushed', 'records_flushed', 'records_failed',
+                    'records_dropped', 'bodies_dropped', 'write_retries', 'last_flush_ms', 'avg_flush_ms',
+                    'max_flush_ms')
+    CODEC_FIELDS = ('raw_bytes', 'stored_bytes', 'compression_cpu_ms')
+    FIELDS = QUEUE_FIELDS + CODEC_FIELDS
+
+    def __init__(self, values):
+        self._values = values  # multiprocessing.RawArray('d', len(FIELDS))
+
+    def update(self, stats: Dict[str, Any]):
+        for index, field in enumerate(self.FIELDS):
+            self._values[index] = stats.get(field) or 0
+
+    def read(self, fields: Tuple[str, ...]) -> Dict[str, Any]:
+        values = {field: self._values[self.FIELDS.index(field)] for field in fields}
+        return {field: value if field.endswith('_ms') else int(value) for field, value in values.items()}
+
+class SQLiteConnectionManager:
+    """SQLite连接管理器
+
+    维护一个长连接写连接和一个只读连接池，使用WAL日志模式，
+    读操作不会被写事务阻塞。每个连接都缓存预编译语句。
+    """
+
+    SYNCHRONOUS_MODES = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+    def __init__(self, db_path: str,
+                 read_pool_size: int = SQLITE_READ_POOL_SIZE,
+                 synchronous: str = SQLITE_SYNCHRONOUS,
+                 cache_size_kb: int = SQLITE_CACHE_SIZE_KB,
+                 mmap_size: int = SQLITE_MMAP_SIZE,
+                 statement_cache: int = SQLITE_STATEMENT_CACHE,
+                 busy_timeout_ms: int = SQLITE_BUSY_TIMEOUT_MS):
+        synchronous = synchronous.upper()
+        if synchronous not in self.SYNCHRONOUS_MODES:
+            raise ValueError(f"Unknown SQLite synchronous mode: {synchronous}")
+
+        self.db_path = db_path
+        self.read_pool_size = max(1, read_pool_size)
+        self.synchronous = synchronous
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size = mmap_size
+        self.statement_cache = statement_cache
+        self.busy_timeout_ms = busy_timeout_ms
+        self.read_only = False  # 只读进程（Web界面）禁止获取写连接
+
+        self._write_lock = threading.RLock()
+        self._writer: Optional[sqlite3.Connection] = None
+        self._readers: queue.LifoQueue = queue.LifoQueue()
+        self._readers_created = 0
+        self._readers_lock = threading.Lock()
+
+    def _apply_pragmas(self, conn: sqlite3.Connection):
+        """应用通用的连接参数"""
+        conn.execute(f'PRAGMA busy_timeout = {int(self.busy_timeout_ms)}')
+        conn.execute(f'PRAGMA cache_size = {-int(self.cache_size_kb)}')
+        conn.execute(f'PRAGMA mmap_size = {int(self.mmap_size)}')
+        conn.execute('PRAGMA temp_store = MEMORY')
+
+    def _open_writer(self) -> sqlite3.Connection:
+        """打开写连接"""
+        conn = sqlite3.connect(
+            self.db_path,
+            check_same_thread=False,
+            cached_statements=self.statement_cache
+        )
+        self._apply_pragmas(conn)
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute(f'PRAGMA synchronous = {self.synchronous}')
+        return conn
+
+    def _open_reader(self) -> sqlite3.Connection:
+        """打开只读连接"""
+        uri = Path(self.db_path).resolve().as_uri() + '?mode=ro'
+        conn = sqlite3.connect(
+            uri,
+            uri=True,
+            check_same_thread=False,
+            cached_statements=self.statement_cache
+        )
+        self._apply_pragmas(conn)
+        conn.execute('PRAGMA query_only = ON')
+        return conn
+
+    @contextmanager
+    def writer(self):
+        """获取写连接（串行使用）"""
+        if self.read_only:
+            raise sqlite3.OperationalError("attempt to write a readonly database")
+        with self._write_lock:
+            if self._writer is None:
+                self._writer = self._open_writer()
+            yield self._writer
+
+    @contextmanager
+    def reader(self):
+        """从连接池借用一个只读连接"""
+        conn = None
+        try:
+            conn = self._readers.get_nowait()
+        except queue.Empty:
+            with self._readers_lock:
+                if self._readers_created < self.read_pool_size:
+                    self._readers_created += 1
+                    create = True
+                else:
+                    create = False
+            if create:
+                try:
+                    conn = self._open_reader()
+                except Exception:
+                    with self._readers_lock:
+                        self._readers_created -= 1
+                    raise
+            else:
+                conn = self._readers.get()
+
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._readers.put(conn)
+
+    def close(self):
+        """关闭所有连接"""
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        while True:
+            try:
+                self._readers.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._readers_lock:
+            self._readers_created = 0
+
+class BodyCodec:
+    """请求/响应体的压缩编解码
+
+    每个压缩块以一个字节标记编码方式：r 原文、z zlib、s zstd、
+    d 使用训练字典的zstd（其后4字节为字典ID）。
+    """
+
+    RAW = b'r'
+    ZLIB = b'z'
+    ZSTD = b's'
+    ZSTD_DICT = b'd'
+    MIN_COMPRESS_SIZE = 64  # 小于该字节数的内容不压缩
+
+    def __init__(self, method: str = STORAGE_COMPRESSION, level: int = STORAGE_COMPRESSION_LEVEL):
+        method = method.lower()
+        if method not in ('zlib', 'zstd', 'none'):
+            raise ValueError(f"Unknown storage compression: {method}")
+        if method == 'zstd' and zstandard is None:
+            print("zstandard is not installed, falling back to zlib compression")
+            method = 'zlib'
+        self.method = method
+        self.level = level
+        self._dictionaries: Dict[int, Any] = {}
+        self._dict_id: Optional[int] = None
+        self._compressor = None
+        if method == 'zstd':
+            self._compressor = zstandard.ZstdCompressor(level=level)
+
+        # 统计信息（仅写线程更新）
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+        self.compress_seconds = 0.0
+
+    def add_dictionary(self, dict_id: int, data: bytes, use_for_compression: bool = False):
+        """登记zstd字典，可选地用于后续压缩"""
+        if zstandard is None:
+            return
+        dictionary = zstandard.ZstdCompressionDict(data)
+        self._dictionaries[dict_id] = dictionary
+        if use_for_compression and self.method == 'zstd':
+            self._dict_id = dict_id
+            self._compressor = zstandard.ZstdCompressor(level=self.level, dict_data=dictionary)
+
+    def encode_bytes(self, data: Optional[bytes]) -> Optional[bytes]:
+        """压缩字节内容"""
+        if data is None:
+            return None
+        start = time.perf_counter()
+        encoded = self.RAW + data
+        if self.method != 'none' and len(data) >= self.MIN_COMPRESS_SIZE:
+            if self.method == 'zstd':
+                compressed = self._compressor.compress(data)
+                if self._dict_id is not None:
+                    candidate = self.ZSTD_DICT + struct.pack('>I', self._dict_id) + compressed
+                else:
+                    candidate = self.ZSTD + compressed
+            else:
+                candidate = self.ZLIB + zlib.compress(data, self.level)
+            if len(candidate) < len(encoded):
+                encoded = candidate
+        self.compress_seconds += time.perf_counter() - start
+        self.raw_bytes += len(data)
+        self.stored_bytes += len(encoded)
+        return encoded
+
+    def encode(self, text: Optional[str]) -> Optional[bytes]:
+        """压缩文本内容"""
+        return self.encode_bytes(text.encode('utf-8', errors='replace') if text is not None else None)
+
+    def decode_bytes(self, blob: Optional[bytes]) -> Optional[bytes]:
+        """解压为字节内容"""
+        if blob is None:
+            return None
+        tag, payload = blob[:1], blob[1:]
+        if tag == self.RAW:
+            return bytes(payload)
+        if tag == self.ZLIB:
+            return zlib.decompress(payload)
+        if tag in (self.ZSTD, self.ZSTD_DICT):
+            if zstandard is None:
+                raise RuntimeError("zstandard is required to read zstd-compressed bodies")
+            if tag == self.ZSTD_DICT:
+                dict_id = struct.unpack('>I', payload[:4])[0]
+                decompressor = zstandard.ZstdDecompressor(dict_data=self._dictionaries[dict_id])
+                payload = payload[4:]
+            else:
+                decompressor = zstandard.ZstdDecompressor()
+            return decompressor.decompress(payload)
+        raise ValueError(f"Unknown body encoding: {tag!r}")
+
+    def decode(self, blob: Optional[bytes]) -> Optional[str]:
+        """解压为文本内容"""
+        data = self.decode_bytes(blob)
+        return data.decode('utf-8', errors='replace') if data is not None else None
+
+    def stats(self) -> Dict[str, Any]:
+        """压缩统计信息"""
+        return {
+            'compression': self.method,
+            'compression_dictionary': self._dict_id,
+            'raw_bytes': self.raw_bytes,
+            'stored_bytes': self.stored_bytes,
+            'compression_ratio': round(self.raw_bytes / self.stored_bytes, 2) if self.stored_bytes else None,
+            'compression_cpu_ms': round(self.compress_seconds * 1000, 2),
+        }
+
 class RequestStorage:
     """请求存储管理器"""
     
-    def __init__(self, db_path: str = "proxy_requests.db"):
+    # 按顺序执行的数据库迁移，已执行的版本记录在 PRAGMA user_version 中
+    MIGRATIONS = (
+        '_migrate_list_indexes',
+        '_migrate_fts_index',
+        '_migrate_summary_columns',
+        '_migrate_blob_table',
+        '_migrate_body_segments',
+        '_migrate_bytes_out',
+        '_migrate_timing_columns',
+        '_migrate_usage_columns',
+        '_migrate_rollup_tables',
+        '_migrate_cache_status',
+        '_migrate_coalesced',
+    )
+    
+    # 读取完整记录的列：旧记录的内容在 requests 表中，新记录在压缩的 request_blobs 表中
+    RECORD_COLUMNS = '''
+        requests.id, requests.timestamp, requests.method, requests.url,
+        requests.headers, requests.body, requests.response_status, requests.response_headers,
+        requests.response_body, requests.duration_ms, requests.error,
+        request_blobs.headers, request_blobs.body, request_blobs.response_headers, request_blobs.response_body,
+        request_blobs.segments, requests.bytes_out,
+    ''' + ', '.join(f'requests.{field}' for field in RESPONSE_FIELDS)
+    RECORD_JOIN = 'LEFT JOIN request_blobs ON request_blobs.id = requests.id'
+    
+    # 写入已完成记录的元数据，请求头和请求/响应体另存于 request_blobs 表
+    INSERT_REQUEST = f'''
+        INSERT OR REPLACE INTO requests 
+        (id, timestamp, method, url, headers, body, authorization_bearer,
+         response_status, response_headers, response_body, duration_ms, error,
+         body_size, response_size, preview, bytes_out, {', '.join(RESPONSE_FIELDS)})
+        VALUES (?, ?, ?, ?, '', NULL, ?, ?, NULL, NULL, ?, ?, ?, ?, ?, ?{', ?' * len(RESPONSE_FIELDS)})
+    '''
+    
+    def __init__(self, db_path: str = DB_PATH):
         self.db_path = db_path
         self._lock = threading.RLock()
+        self._live: Dict[str, RequestRecord] = {}  # 进行中或等待落盘的记录
+        self._db = SQLiteConnectionManager(db_path)
+        self._fts_enabled = False
+        self._codec = BodyCodec()
         self._init_database()
+        self._queue = WriteBehindQueue(self._write_batch, discard_func=self._release_live)
+        self._forward_only = False
+        self._shared_stats: Optional[SharedStorageStats] = None
+        self._rollup_pruned_at = None  # 上次清理分钟汇总时所在的小时
+        self._listeners: List[Callable[[str, RequestRecord], None]] = []
+        atexit.register(self.close)
+        os.register_at_fork(after_in_child=self._after_fork)
+    
+    def _after_fork(self):
+        """子进程中重建锁、连接和写入队列
+
+        父进程的SQLite连接和写线程不能在子进程中使用，直接丢弃而不关闭。
+        """
+        self._lock = threading.RLock()
+        self._live = {}
+        self._db = SQLiteConnectionManager(self.db_path)
+        self._queue = WriteBehindQueue(self._write_batch, discard_func=self._release_live)
+        self._forward_only = False
+        self._listeners = []
+    
+    def add_listener(self, listener: Callable[[str, RequestRecord], None]):
+        """注册请求开始(started)和完成(completed)时的回调，回调在调用方线程中同步执行"""
+        self._listeners.append(listener)
+    
+    def _notify(self, kind: str, record: RequestRecord):
+        """通知监听者，回调出错不影响请求处理"""
+        for listener in self._listeners:
+            try:
+                listener(kind, record)
+            except Exception as e:
+                print(f"Request listener failed: {e}")
+    
+    def use_process_writer(self, process_queue):
+        """将已完成的记录发送给存储写入进程，不在本进程落盘"""
+        self._queue = ProcessQueueWriter(process_queue)
+        self._forward_only = True
+    
+    def use_read_only(self):
+        """只通过只读连接访问数据库，用于独立的Web界面进程"""
+        self._db.read_only = True
+    
+    def share_stats(self, values):
+        """多进程模式下通过共享内存交换存储写入进程的统计，写入进程发布，Web进程读取"""
+        self._shared_stats = SharedStorageStats(values)
+    
+    def publish_stats(self):
+        """写入进程：将本进程的写入队列和压缩统计写入共享内存"""
+        if self._shared_stats is not None:
+            self._shared_stats.update({**self._queue.stats(), **self._codec.stats()})
+    
+    def ping(self) -> bool:
+        """检查数据库是否可读，用于健康检查"""
+        with self._db.reader() as conn:
+            return conn.execute('SELECT 1').fetchone()[0] == 1
+    
+    def save_record(self, record: RequestRecord) -> bool:
+        """将其他进程完成的记录加入本进程的写入队列"""
+        return self._queue.put(record)
     
     def _init_database(self):
         """初始化SQLite数据库"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._db.writer() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS requests (
@@ -65,163 +1104,523 @@ class RequestStorage:
                     error TEXT
                 )
             ''')
+            self._migrate(conn)
             conn.commit()
+            self._fts_enabled = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'requests_fts'"
+            ).fetchone() is not None
+            self._load_dictionaries(conn)
+    
+    def _load_dictionaries(self, conn: sqlite3.Connection):
+        """加载已训练的zstd压缩字典，最新的字典用于压缩"""
+        rows = conn.execute('SELECT id, data FROM compression_dicts ORDER BY id').fetchall()
+        for index, (dict_id, data) in enumerate(rows):
+            self._codec.add_dictionary(dict_id, data, use_for_compression=index == len(rows) - 1)
+    
+    def _migrate(self, conn: sqlite3.Connection):
+        """执行尚未应用的数据库迁移"""
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        for target, name in enumerate(self.MIGRATIONS[version:], start=version + 1):
+            with conn:
+                conn.execute('BEGIN')
+                getattr(self, name)(conn)
+                conn.execute(f'PRAGMA user_version = {target}')
     
-    def _save_to_database(self, record: RequestRecord):
-        """保存请求记录到数据库"""
+    def _migrate_list_indexes(self, conn: sqlite3.Connection):
+        """迁移1: 为列表分页和API Key过滤建立索引"""
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_requests_timestamp ON requests (timestamp, id)')
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_requests_bearer_timestamp
+            ON requests (authorization_bearer, timestamp, id)
+        ''')
+    
+    def _migrate_fts_index(self, conn: sqlite3.Connection):
+        """迁移2: 建立FTS5全文索引并回填已有记录
+
+        索引为contentless表，只保存倒排索引，rowid与requests表一致。
+        SQLite未编译FTS5时跳过，搜索退回LIKE匹配。
+        """
         try:
-            # 提取Authorization Bearer token
-            authorization_bearer = None
-            if record.headers:
-                auth_header = record.headers.get('Authorization') or record.headers.get('authorization')
-                if auth_header and auth_header.startswith('Bearer '):
-                    authorization_bearer = auth_header[7:]  # 移除 "Bearer " 前缀
-            
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute('''
-                    INSERT OR REPLACE INTO requests 
-                    (id, timestamp, method, url, headers, body, authorization_bearer,
-                     response_status, response_headers, response_body, duration_ms, error)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (
+            conn.execute('''
+                CREATE VIRTUAL TABLE requests_fts USING fts5(
+                    url, method, model, status, body, response_body,
+                    content=''
+                )
+            ''')
+        except sqlite3.OperationalError as e:
+            print(f"FTS5 unavailable, falling back to LIKE search: {e}")
+            return
+        # 与写入路径使用同一套取值，保证索引内容一致
+        for row in conn.execute('''
+            SELECT rowid, id, timestamp, method, url, headers, body, response_status,
+                   response_headers, response_body, duration_ms, error
+            FROM requests
+        '''):
+            conn.execute('''
+                INSERT INTO requests_fts (rowid, url, method, model, status, body, response_body)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (row[0], *self._fts_values(self._row_to_record(row[1:] + (None,) * 6, conn))))
+    
+    def _migrate_summary_columns(self, conn: sqlite3.Connection):
+        """迁移3: 增加列表摘要所需的大小和预览列并回填"""
+        conn.execute('ALTER TABLE requests ADD COLUMN body_size INTEGER')
+        conn.execute('ALTER TABLE requests ADD COLUMN response_size INTEGER')
+        conn.execute('ALTER TABLE requests ADD COLUMN preview TEXT')
+        rows = conn.execute('SELECT id, body, response_body FROM requests').fetchall()
+        conn.executemany(
+            'UPDATE requests SET body_size = ?, response_size = ?, preview = ? WHERE id = ?',
+            [(text_size(body), text_size(response_body), make_preview(body), request_id)
+             for request_id, body, response_body in rows]
+        )
+    
+    def _migrate_blob_table(self, conn: sqlite3.Connection):
+        """迁移4: 建立压缩的请求/响应内容表
+
+        已有记录的内容仍保留在 requests 表中，可通过 db_tool.py compress 转换。
+        """
+        conn.execute('''
+            CREATE TABLE request_blobs (
+                id TEXT PRIMARY KEY,
+                headers BLOB,
+                body BLOB,
+                response_headers BLOB,
+                response_body BLOB,
+                raw_size INTEGER NOT NULL,
+                stored_size INTEGER NOT NULL
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE compression_dicts (
+                id INTEGER PRIMARY KEY,
+                created_at TEXT NOT NULL,
+                data BLOB NOT NULL
+            )
+        ''')
+    
+    def _migrate_body_segments(self, conn: sqlite3.Connection):
+        """迁移5: 建立请求体片段去重表
+
+        去重的请求体在 request_blobs.body 中只保存模板文本，segments 列按顺序记录片段哈希。
+        """
+        conn.execute('ALTER TABLE request_blobs ADD COLUMN segments TEXT')
+        conn.execute('''
+            CREATE TABLE body_segments (
+                hash TEXT PRIMARY KEY,
+                data BLOB NOT NULL,
+                raw_size INTEGER NOT NULL,
+                stored_size INTEGER NOT NULL,
+                refcount INTEGER NOT NULL
+            )
+        ''')
+    
+    def _migrate_bytes_out(self, conn: sqlite3.Connection):
+        """迁移6: 记录已发送给客户端的字节数"""
+        conn.execute('ALTER TABLE requests ADD COLUMN bytes_out INTEGER')
+    
+    def _migrate_timing_columns(self, conn: sqlite3.Connection):
+        """迁移7: 记录连接、首字节、首个输出等延迟指标"""
+        for field in TIMING_FIELDS:
+            conn.execute(f'ALTER TABLE requests ADD COLUMN {field} REAL')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_requests_ttft ON requests (ttft_ms)')
+    
+    def _migrate_usage_columns(self, conn: sqlite3.Connection):
+        """迁移8: 记录模型、生成ID和用量，已有记录可通过 db_tool.py backfill-usage 回填"""
+        conn.execute('ALTER TABLE requests ADD COLUMN model TEXT')
+        conn.execute('ALTER TABLE requests ADD COLUMN generation_id TEXT')
+        conn.execute('ALTER TABLE requests ADD COLUMN provider TEXT')
+        conn.execute('ALTER TABLE requests ADD COLUMN prompt_tokens INTEGER')
+        conn.execute('ALTER TABLE requests ADD COLUMN completion_tokens INTEGER')
+        conn.execute('ALTER TABLE requests ADD COLUMN total_tokens INTEGER')
+        conn.execute('ALTER TABLE requests ADD COLUMN cost REAL')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_requests_model_timestamp ON requests (model, timestamp)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_requests_generation_id ON requests (generation_id)')
+    
+    def _migrate_rollup_tables(self, conn: sqlite3.Connection):
+        """迁移9: 建立按分钟和小时的统计汇总表，并从已有记录回填"""
+        for table, _ in ROLLUP_TABLES.values():
+            conn.execute(f'''
+                CREATE TABLE {table} (
+                    bucket TEXT NOT NULL,
+                    apikey TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    status INTEGER NOT NULL,
+                    requests INTEGER NOT NULL,
+                    errors INTEGER NOT NULL,
+                    latency_count INTEGER NOT NULL,
+                    latency_sum REAL NOT NULL,
+                    histogram TEXT NOT NULL,
+                    PRIMARY KEY (bucket, apikey, model, status)
+                ) WITHOUT ROWID
+            ''')
+        self._update_rollups(conn.cursor(), conn.execute('''
+            SELECT timestamp, authorization_bearer, model, response_status, duration_ms, error
+            FROM requests WHERE response_status IS NOT NULL OR error IS NOT NULL
+        '''))
+    
+    def _migrate_cache_status(self, conn: sqlite3.Connection):
+        """迁移10: 记录响应缓存的处理结果"""
+        conn.execute('ALTER TABLE requests ADD COLUMN cache_status TEXT')
+    
+    def _migrate_coalesced(self, conn: sqlite3.Connection):
+        """迁移11: 记录合并到同一上游请求的相同请求数"""
+        conn.execute('ALTER TABLE requests ADD COLUMN coalesced INTEGER')
+    
+    @staticmethod
+    def _extract_bearer(headers: Optional[Dict[str, str]]) -> Optional[str]:
+        """提取Authorization Bearer token"""
+        if headers:
+            auth_header = headers.get('Authorization') or headers.get('authorization')
+            if auth_header and auth_header.startswith('Bearer '):
+                return auth_header[7:]  # 移除 "Bearer " 前缀
+        return None
+
+    @staticmethod
+    def _fts_values(record: RequestRecord) -> Tuple:
+        """全文索引中各列的取值"""
+        return (
+            record.url,
+            record.method,
+            extract_model(record.body),
+            str(record.response_status) if record.response_status is not None else None,
+            record.body,
+            record.response_body
+        )
+    
+    def _write_batch(self, records: List[RequestRecord]):
+        """在单个事务中写入一批已完成的记录（由写线程调用）
+
+        requests 表只保存列表和过滤所需的元数据，请求头和请求/响应体
+        压缩后写入 request_blobs 表。已存在的同一ID的记录先按 delete_request 的方式删除，
+        释放其全文索引和请求体片段；重写的记录不重复计入汇总。
+        """
+        with self._db.writer() as conn, conn:
+            # 同一批次中重复的ID只写入最后一条
+            pending = list({record.id: record for record in records}.values())
+            placeholders = ', '.join('?' * len(pending))
+            existing = {row[0] for row in conn.execute(
+                f'SELECT id FROM requests WHERE id IN ({placeholders})', [record.id for record in pending])}
+            if existing:
+                self._delete_rows(conn, list(existing))
+            cursor = conn.cursor()
+            for record in pending:
+                cursor.execute(self.INSERT_REQUEST, (
                     record.id,
                     record.timestamp.isoformat(),
                     record.method,
                     record.url,
-                    json.dumps(record.headers) if record.headers else None,
-                    record.body,
-                    authorization_bearer,
+                    self._extract_bearer(record.headers),
                     record.response_status,
-                    json.dumps(record.response_headers) if record.response_headers else None,
-                    record.response_body,
                     record.duration_ms,
-                    record.error
+                    record.error,
+                    *record.body_fields(),
+                    record.bytes_out,
+                    *(getattr(record, field) for field in RESPONSE_FIELDS)
                 ))
-                conn.commit()
-        except Exception as e:
-            print(f"Error saving to database: {e}")
+                rowid = cursor.lastrowid
+                self._insert_blob(cursor, record.id,
+                                  json.dumps(record.headers) if record.headers else None,
+                                  record.body,
+                                  json.dumps(record.response_headers) if record.response_headers else None,
+                                  record.response_body)
+                if self._fts_enabled:
+                    cursor.execute('''
+                        INSERT INTO requests_fts (rowid, url, method, model, status, body, response_body)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ''', (rowid, *self._fts_values(record)))
+            self._update_rollups(cursor, [
+                (record.timestamp.isoformat(), self._extract_bearer(record.headers), record.model,
+                 record.response_status, record.duration_ms, record.error)
+                for record in pending if record.id not in existing
+            ])
+            self._prune_minute_rollups(cursor)
+        # 事务提交后记录才能从内存中移除，失败的记录由写入队列重试或通过 _release_live 丢弃
+        self._release_live(records)
+    
+    def _release_live(self, records: List[RequestRecord]):
+        """从内存中移除已落盘或已放弃写入的记录"""
+        with self._lock:
+            for record in records:
+                self._live.pop(record.id, None)
+    
+    @staticmethod
+    def _update_rollups(cursor: sqlite3.Cursor, rows):
+        """将已完成的请求计入分钟和小时汇总
+
+        rows 为 (timestamp, apikey, model, status, duration_ms, error)，先在内存中按时间桶和
+        (API Key, 模型, 状态码) 聚合，每个汇总行只读写一次。
+        """
+        pending: Dict[Tuple, LatencyStats] = {}
+        for timestamp, apikey, model, status, duration_ms, error in rows:
+            key = (apikey or '', model or '', status or 0)
+            failed = error is not None or not status or status >= 400
+            for table, length in ROLLUP_TABLES.values():
+                stats = pending.get((table, timestamp[:length]) + key)
+                if stats is None:
+                    stats = pending[(table, timestamp[:length]) + key] = LatencyStats()
+                stats.add(duration_ms, failed)
+        for (table, *key), stats in pending.items():
+            row = cursor.execute(f'''
+                SELECT requests, errors, latency_count, latency_sum, histogram FROM {table}
+                WHERE bucket = ? AND apikey = ? AND model = ? AND status = ?
+            ''', key).fetchone()
+            if row:
+                stats.merge(LatencyStats.from_row(row))
+            cursor.execute(f'''
+                INSERT OR REPLACE INTO {table}
+                (bucket, apikey, model, status, requests, errors, latency_count, latency_sum, histogram)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (*key, *stats.values()))
+    
+    def _prune_minute_rollups(self, cursor: sqlite3.Cursor):
+        """每小时清理一次超出保留时间的分钟汇总，小时汇总一直保留"""
+        hour = datetime.now().isoformat()[:13]
+        if hour == self._rollup_pruned_at:
+            return
+        self._rollup_pruned_at = hour
+        cutoff = datetime.now() - timedelta(hours=STATS_MINUTE_RETENTION_HOURS)
+        table, length = ROLLUP_TABLES['minute']
+        cursor.execute(f'DELETE FROM {table} WHERE bucket < ?', (cutoff.isoformat()[:length],))
+    
+    def _insert_blob(self, cursor: sqlite3.Cursor, request_id: str, headers: Optional[str],
+                     body: Optional[str], response_headers: Optional[str], response_body: Optional[str]):
+        """压缩并写入一条记录的请求头和请求/响应体，请求体中重复的片段只存储一次"""
+        values = (headers, body, response_headers, response_body)
+        split = split_segments(body) if STORAGE_DEDUP else None
+        hashes = None
+        if split:
+            parts, segments = split
+            hashes = self._store_segments(cursor, segments)
+            body = json.dumps(parts, ensure_ascii=False)
+        encoded = [self._codec.encode(value) for value in (headers, body, response_headers, response_body)]
+        cursor.execute('''
+            INSERT OR REPLACE INTO request_blobs
+            (id, headers, body, response_headers, response_body, raw_size, stored_size, segments)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            request_id,
+            *encoded,
+            sum(text_size(value) or 0 for value in values),
+            sum(len(blob) for blob in encoded if blob is not None),
+            json.dumps(hashes) if hashes else None
+        ))
+    
+    def _store_segments(self, cursor: sqlite3.Cursor, segments: List[str]) -> List[str]:
+        """增加片段的引用计数，新片段压缩后写入，返回片段哈希列表"""
+        hashes = []
+        for segment in segments:
+            digest = segment_hash(segment)
+            hashes.append(digest)
+            cursor.execute('UPDATE body_segments SET refcount = refcount + 1 WHERE hash = ?', (digest,))
+            if cursor.rowcount == 0:
+                data = self._codec.encode(segment)
+                cursor.execute('''
+                    INSERT INTO body_segments (hash, data, raw_size, stored_size, refcount)
+                    VALUES (?, ?, ?, ?, 1)
+                ''', (digest, data, text_size(segment), len(data)))
+        return hashes
+    
+    def _load_segments(self, conn: sqlite3.Connection, hashes: List[str]) -> List[str]:
+        """按哈希读取片段内容"""
+        unique = list(set(hashes))
+        placeholders = ', '.join('?' * len(unique))
+        rows = conn.execute(
+            f'SELECT hash, data FROM body_segments WHERE hash IN ({placeholders})', unique
+        ).fetchall()
+        segments = {digest: self._codec.decode(data) for digest, data in rows}
+        return [segments[digest] for digest in hashes]
+    
+    def _release_segments(self, cursor: sqlite3.Cursor, hashes: List[str]):
+        """减少片段的引用计数，删除不再被引用的片段"""
+        cursor.executemany('UPDATE body_segments SET refcount = refcount - 1 WHERE hash = ?',
+                           [(digest,) for digest in hashes])
+        cursor.executemany('DELETE FROM body_segments WHERE hash = ? AND refcount <= 0',
+                           [(digest,) for digest in set(hashes)])
+    
+    def _delete_rows(self, conn: sqlite3.Connection, request_ids: List[str]) -> int:
+        """在当前事务中删除记录及其全文索引，并回收不再被引用的请求体片段"""
+        placeholders = ', '.join('?' * len(request_ids))
+        rows = conn.execute(f'''
+            SELECT requests.rowid, request_blobs.segments, {self.RECORD_COLUMNS}
+            FROM requests {self.RECORD_JOIN}
+            WHERE requests.id IN ({placeholders})
+        ''', request_ids).fetchall()
+        if not rows:
+            return 0
+        
+        cursor = conn.cursor()
+        if self._fts_enabled:
+            # contentless索引需要提供写入时的原始取值才能删除
+            cursor.executemany('''
+                INSERT INTO requests_fts (requests_fts, rowid, url, method, model, status, body, response_body)
+                VALUES ('delete', ?, ?, ?, ?, ?, ?, ?)
+            ''', [(row[0], *self._fts_values(self._row_to_record(row[2:], conn))) for row in rows])
+        hashes = [digest for row in rows if row[1] for digest in json.loads(row[1])]
+        if hashes:
+            self._release_segments(cursor, hashes)
+        ids = [(row[2],) for row in rows]
+        cursor.executemany('DELETE FROM request_blobs WHERE id = ?', ids)
+        cursor.executemany('DELETE FROM requests WHERE id = ?', ids)
+        return len(rows)
+    
+    def _row_to_record(self, row, conn: sqlite3.Connection) -> RequestRecord:
+        """将数据库行（RECORD_COLUMNS）转换为请求记录，按需解压内容并还原去重的请求体"""
+        (request_id, timestamp, method, url, headers, body, response_status, response_headers,
+         response_body, duration_ms, error, blob_headers, blob_body, blob_response_headers,
+         blob_response_body, segments, bytes_out) = row[:17]
+        extra = dict(zip(RESPONSE_FIELDS, row[17:]))
+        if blob_headers is not None or blob_body is not None or blob_response_body is not None:
+            headers = self._codec.decode(blob_headers)
+            body = self._codec.decode(blob_body)
+            response_headers = self._codec.decode(blob_response_headers)
+            response_body = self._codec.decode(blob_response_body)
+            if segments:
+                body = join_segments(json.loads(body), self._load_segments(conn, json.loads(segments)))
+        return RequestRecord(
+            id=request_id,
+            timestamp=datetime.fromisoformat(timestamp),
+            method=method,
+            url=url,
+            headers=json.loads(headers) if headers else {},
+            body=body,
+            response_status=response_status,
+            response_headers=json.loads(response_headers) if response_headers else None,
+            response_body=response_body,
+            duration_ms=duration_ms,
+            error=error,
+            bytes_out=bytes_out,
+            **extra
+        )
     
     def _load_from_database(self, request_id: str) -> Optional[RequestRecord]:
         """从数据库加载请求记录"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._db.reader() as conn:
                 cursor = conn.cursor()
-                cursor.execute('SELECT * FROM requests WHERE id = ?', (request_id,))
+                cursor.execute(f'''
+                    SELECT {self.RECORD_COLUMNS} FROM requests {self.RECORD_JOIN}
+                    WHERE requests.id = ?
+                ''', (request_id,))
                 row = cursor.fetchone()
                 
-                if row:
-                    return RequestRecord(
-                        id=row[0],
-                        timestamp=datetime.fromisoformat(row[1]),
-                        method=row[2],
-                        url=row[3],
-                        headers=json.loads(row[4]) if row[4] else {},
-                        body=row[5],
-                        response_status=row[7],
-                        response_headers=json.loads(row[8]) if row[8] else None,
-                        response_body=row[9],
-                        duration_ms=row[10],
-                        error=row[11]
-                    )
-                return None
+                return self._row_to_record(row, conn) if row else None
         except Exception as e:
             print(f"Error loading from database: {e}")
             return None
     
-    def _load_requests_from_database(self, limit: int = 100, offset: int = 0, apikey_filter: str = None) -> List[RequestRecord]:
-        """从数据库加载请求列表"""
+    def _select_columns(self, summary: bool) -> Tuple[str, str]:
+        """查询列和所需的关联：完整记录或仅摘要列"""
+        if summary:
+            return ', '.join(f'requests.{column}' for column in RequestSummary.__slots__), ''
+        return self.RECORD_COLUMNS, self.RECORD_JOIN
+    
+    def _convert_rows(self, rows, summary: bool, conn: sqlite3.Connection) -> list:
+        """将查询结果转换为记录或摘要"""
+        if summary:
+            return [RequestSummary.from_row(row) for row in rows]
+        return [self._row_to_record(row, conn) for row in rows]
+    
+    def _load_requests_from_database(self, limit: int = 100, offset: int = 0, apikey_filter: str = None,
+                                     before: Optional[Cursor] = None,
+                                     after: Optional[Cursor] = None,
+                                     summary: bool = False) -> list:
+        """从数据库加载请求列表，支持按 (timestamp, id) 游标分页"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._db.reader() as conn:
                 cursor = conn.cursor()
                 
+                conditions, params = [], []
                 if apikey_filter:
-                    cursor.execute('''
-                        SELECT * FROM requests 
-                        WHERE authorization_bearer = ?
-                        ORDER BY timestamp DESC 
-                        LIMIT ? OFFSET ?
-                    ''', (apikey_filter, limit, offset))
-                else:
-                    cursor.execute('''
-                        SELECT * FROM requests 
-                        ORDER BY timestamp DESC 
-                        LIMIT ? OFFSET ?
-                    ''', (limit, offset))
+                    conditions.append('requests.authorization_bearer = ?')
+                    params.append(apikey_filter)
+                if before:
+                    conditions.append('(requests.timestamp, requests.id) < (?, ?)')
+                    params.extend(before)
+                if after:
+                    conditions.append('(requests.timestamp, requests.id) > (?, ?)')
+                    params.extend(after)
+                where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+                # 向后翻页时按升序取最近的记录，再反转为倒序
+                order = 'ASC' if after else 'DESC'
+                
+                columns, join = self._select_columns(summary)
+                cursor.execute(f'''
+                    SELECT {columns} FROM requests {join}
+                    {where}
+                    ORDER BY requests.timestamp {order}, requests.id {order}
+                    LIMIT ? OFFSET ?
+                ''', (*params, limit, offset))
                 
                 rows = cursor.fetchall()
+                if after:
+                    rows.reverse()
                 
-                records = []
-                for row in rows:
-                    record = RequestRecord(
-                        id=row[0],
-                        timestamp=datetime.fromisoformat(row[1]),
-                        method=row[2],
-                        url=row[3],
-                        headers=json.loads(row[4]) if row[4] else {},
-                        body=row[5],
-                        response_status=row[7],
-                        response_headers=json.loads(row[8]) if row[8] else None,
-                        response_body=row[9],
-                        duration_ms=row[10],
-                        error=row[11]
-                    )
-                    records.append(record)
-                return records
+                return self._convert_rows(rows, summary, conn)
         except Exception as e:
             print(f"Error loading requests from database: {e}")
             return []
     
-    def _search_database(self, query: str, limit: int = 100, apikey_filter: str = None) -> List[RequestRecord]:
-        """在数据库中搜索请求"""
+    def _search_conditions(self, query: str, apikey_filter: str = None) -> Tuple[str, str, list]:
+        """构造搜索的 FROM 和 WHERE 子句
+
+        优先使用FTS5索引。FTS5不可用或查询中没有可索引的词时退回LIKE匹配，
+        此时只匹配URL、方法和模型：请求体和响应体压缩保存在 request_blobs 中，无法用LIKE搜索。
+        """
+        fts_query = build_fts_query(query) if self._fts_enabled else ''
+        if fts_query:
+            source = 'requests_fts JOIN requests ON requests.rowid = requests_fts.rowid'
+            conditions, params = ['requests_fts MATCH ?'], [fts_query]
+        else:
+            search_pattern = f'%{query}%'
+            source = 'requests'
+            conditions = ['(requests.url LIKE ? OR requests.method LIKE ? OR requests.model LIKE ?)']
+            params = [search_pattern] * 3
+        if apikey_filter:
+            conditions.append('requests.authorization_bearer = ?')
+            params.append(apikey_filter)
+        return source, ' AND '.join(conditions), params
+    
+    def _search_database(self, query: str, limit: int = 100, offset: int = 0, apikey_filter: str = None,
+                         order: str = 'rank', summary: bool = False) -> list:
+        """在数据库中搜索请求，order 为 rank（相关度）或 time（时间倒序）"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._db.reader() as conn:
                 cursor = conn.cursor()
-                search_pattern = f'%{query}%'
-                
-                if apikey_filter:
-                    cursor.execute('''
-                        SELECT * FROM requests 
-                        WHERE (url LIKE ? OR method LIKE ? OR body LIKE ? OR response_body LIKE ?)
-                        AND authorization_bearer = ?
-                        ORDER BY timestamp DESC 
-                        LIMIT ?
-                    ''', (search_pattern, search_pattern, search_pattern, search_pattern, apikey_filter, limit))
+                source, where, params = self._search_conditions(query, apikey_filter)
+                if order == 'rank' and source != 'requests':
+                    order_by = 'requests_fts.rank, requests.timestamp DESC'
                 else:
-                    cursor.execute('''
-                        SELECT * FROM requests 
-                        WHERE url LIKE ? OR method LIKE ? OR body LIKE ? OR response_body LIKE ?
-                        ORDER BY timestamp DESC 
-                        LIMIT ?
-                    ''', (search_pattern, search_pattern, search_pattern, search_pattern, limit))
+                    order_by = 'requests.timestamp DESC, requests.id DESC'
+                
+                columns, join = self._select_columns(summary)
+                cursor.execute(f'''
+                    SELECT {columns} FROM {source} {join}
+                    WHERE {where}
+                    ORDER BY {order_by}
+                    LIMIT ? OFFSET ?
+                ''', (*params, limit, offset))
                 
                 rows = cursor.fetchall()
                 
-                records = []
-                for row in rows:
-                    record = RequestRecord(
-                        id=row[0],
-                        timestamp=datetime.fromisoformat(row[1]),
-                        method=row[2],
-                        url=row[3],
-                        headers=json.loads(row[4]) if row[4] else {},
-                        body=row[5],
-                        response_status=row[7],
-                        response_headers=json.loads(row[8]) if row[8] else None,
-                        response_body=row[9],
-                        duration_ms=row[10],
-                        error=row[11]
-                    )
-                    records.append(record)
-                return records
+                return self._convert_rows(rows, summary, conn)
         except Exception as e:
             print(f"Error searching database: {e}")
             return []
     
+    def _count_search_results_from_database(self, query: str, apikey_filter: str = None) -> int:
+        """统计数据库中的搜索结果数"""
+        try:
+            with self._db.reader() as conn:
+                source, where, params = self._search_conditions(query, apikey_filter)
+                result = conn.execute(f'SELECT COUNT(*) FROM {source} WHERE {where}', params).fetchone()
+                return result[0] if result else 0
+        except Exception as e:
+            print(f"Error counting search results: {e}")
+            return 0
+    
     def _get_total_count_from_database(self, apikey_filter: str = None) -> int:
         """从数据库获取总记录数"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._db.reader() as conn:
                 cursor = conn.cursor()
                 
                 if apikey_filter:
@@ -235,61 +1634,539 @@ class RequestStorage:
             print(f"Error getting count from database: {e}")
             return 0
     
+    def _range_conditions(self, ranges: Optional[Dict[str, Tuple[Optional[float], Optional[float]]]],
+                          apikey_filter: str = None) -> Tuple[str, list]:
+        """按数值列范围过滤的WHERE子句，ranges 为 {列: (最小值, 最大值)}"""
+        conditions, params = [], []
+        for column, (low, high) in (ranges or {}).items():
+            if column not in SORTABLE_COLUMNS:
+                raise ValueError(f"Unknown filter column: {column}")
+            if low is not None:
+                conditions.append(f'requests.{column} >= ?')
+                params.append(low)
+            if high is not None:
+                conditions.append(f'requests.{column} <= ?')
+                params.append(high)
+        if apikey_filter:
+            conditions.append('requests.authorization_bearer = ?')
+            params.append(apikey_filter)
+        return (f"WHERE {' AND '.join(conditions)}" if conditions else ''), params
+    
+    def get_sorted_request_summaries(self, sort: Optional[str], descending: bool = False,
+                                     ranges: Optional[Dict[str, Tuple[Optional[float], Optional[float]]]] = None,
+                                     limit: int = 100, offset: int = 0,
+                                     apikey_filter: str = None) -> List[RequestSummary]:
+        """按延迟等数值列排序和过滤的摘要列表，只包含已落盘的记录
+
+        sort 为空时按时间倒序，否则按该列排序，空值排在最后。
+        """
+        if sort is not None and sort not in SORTABLE_COLUMNS:
+            raise ValueError(f"Unknown sort column: {sort}")
+        where, params = self._range_conditions(ranges, apikey_filter)
+        order_by = 'requests.timestamp DESC, requests.id DESC'
+        if sort:
+            direction = 'DESC' if descending else 'ASC'
+            order_by = f'requests.{sort} IS NULL, requests.{sort} {direction}, {order_by}'
+        columns, _ = self._select_columns(summary=True)
+        try:
+            with self._db.reader() as conn:
+                rows = conn.execute(f'''
+                    SELECT {columns} FROM requests
+                    {where}
+                    ORDER BY {order_by}
+                    LIMIT ? OFFSET ?
+                ''', (*params, limit, offset)).fetchall()
+                return self._convert_rows(rows, True, conn)
+        except Exception as e:
+            print(f"Error loading sorted requests: {e}")
+            return []
+    
+    def count_filtered_requests(self, ranges: Optional[Dict[str, Tuple[Optional[float], Optional[float]]]] = None,
+                                apikey_filter: str = None) -> int:
+        """统计满足范围过滤的已落盘记录数"""
+        where, params = self._range_conditions(ranges, apikey_filter)
+        try:
+            with self._db.reader() as conn:
+                return conn.execute(f'SELECT COUNT(*) FROM requests {where}', params).fetchone()[0]
+        except Exception as e:
+            print(f"Error counting filtered requests: {e}")
+            return 0
+    
+    def _live_records(self, apikey_filter: str = None) -> List[RequestRecord]:
+        """获取内存中尚未落盘的记录快照，按时间倒序"""
+        with self._lock:
+            records = [replace(record) for record in self._live.values()
+                       if not apikey_filter or self._extract_bearer(record.headers) == apikey_filter]
+        records.sort(key=self._sort_key, reverse=True)
+        return records
+    
+    @staticmethod
+    def _sort_key(record: RequestRecord) -> Cursor:
+        """记录排序键，与数据库中的 (timestamp, id) 顺序一致"""
+        return record.timestamp.isoformat(), record.id
+    
+    @staticmethod
+    def _as_summaries(records: List[RequestRecord], summary: bool) -> list:
+        """按需将内存中的记录转换为摘要"""
+        return [RequestSummary.from_record(record) for record in records] if summary else records
+    
+    @staticmethod
+    def _merge_records(live: list, stored: list) -> list:
+        """合并内存记录和数据库记录，按时间倒序并去重"""
+        live_ids = {record.id for record in live}
+        merged = live + [record for record in stored if record.id not in live_ids]
+        merged.sort(key=RequestStorage._sort_key, reverse=True)
+        return merged
+    
     def add_request(self, method: str, url: str, headers: Dict[str, str], 
                    body: Optional[str] = None) -> str:
-        """添加新请求"""
+        """添加新请求（仅登记在内存中，完成时一次性落盘）"""
+        request_id = str(uuid.uuid4())
+        record = RequestRecord(
+            id=request_id,
+            timestamp=datetime.now(),
+            method=method,
+            url=url,
+            headers=headers,
+            body=body
+        )
+        
         with self._lock:
-            request_id = str(uuid.uuid4())
-            record = RequestRecord(
-                id=request_id,
-                timestamp=datetime.now(),
-                method=method,
-                url=url,
-                headers=headers,
-                body=body
-            )
-            
-            # 保存到数据库
-            self._save_to_database(record)
-            
-            return request_id
+            self._live[request_id] = record
+        self._notify('started', record)
+        
+        return request_id
     
     def update_response(self, request_id: str, status: int, 
                        headers: Dict[str, str], body: Optional[str] = None,
-                       duration_ms: Optional[float] = None, error: Optional[str] = None):
-        """更新响应信息"""
+                       duration_ms: Optional[float] = None, error: Optional[str] = None,
+                       bytes_out: Optional[int] = None, timings: Optional[Dict[str, float]] = None,
+                       usage: Optional[Dict[str, Any]] = None, cache_status: Optional[str] = None,
+                       coalesced: Optional[int] = None):
+        """更新响应信息，并将完整记录交给后台队列写入
+
+        timings 为 TIMING_FIELDS 中的延迟指标，usage 为 USAGE_FIELDS 中的用量信息，缺少的项保持为空。
+        cache_status 为响应缓存的处理结果，未使用缓存时为空；命中缓存、合并或回放的请求没有发往上游，cost 记为0。
+        coalesced 为加入该请求的相同请求数。
+        """
         with self._lock:
-            # 从数据库获取记录
-            record = self._load_from_database(request_id)
-            if record:
-                record.response_status = status
-                record.response_headers = headers
-                record.response_body = body
-                record.duration_ms = duration_ms
-                record.error = error
+            record = self._live.get(request_id)
+            if record is None or record.response_status is not None or record.error is not None:
+                return
+            record.response_status = status
+            record.response_headers = headers
+            record.response_body = body
+            record.duration_ms = duration_ms
+            record.error = error
+            record.bytes_out = bytes_out
+            record.cache_status = cache_status
+            record.coalesced = coalesced
+            for values in (timings, usage):
+                for field, value in (values or {}).items():
+                    if field in RESPONSE_FIELDS:
+                        setattr(record, field, value)
+            if cache_status in ('hit', 'coalesced', 'replay') and record.cost is not None:
+                record.cost = 0.0
+            if record.model is None:
+                record.model = extract_model(record.body)
+        self._notify('completed', record)
+        
+        # 交给写入进程的记录不会在本进程落盘，直接移出内存
+        if not self._queue.put(record) or self._forward_only:
+            with self._lock:
+                self._live.pop(request_id, None)
+    
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """等待所有排队的写操作落盘"""
+        return self._queue.flush(timeout)
+    
+    def close(self):
+        """关闭存储，落盘剩余写操作"""
+        self._queue.close()
+        self._db.close()
+    
+    def get_queue_stats(self) -> Dict[str, Any]:
+        """获取写入队列统计信息，只读进程返回存储写入进程发布的统计"""
+        if self._db.read_only and self._shared_stats is not None:
+            return {**self._shared_stats.read(SharedStorageStats.QUEUE_FIELDS),
+                    'overflow_policy': STORAGE_OVERFLOW_POLICY}
+        return self._queue.stats()
+    
+    def get_compression_stats(self) -> Dict[str, Any]:
+        """获取压缩统计信息，只读进程返回存储写入进程发布的统计"""
+        stats = self._codec.stats()
+        if self._db.read_only and self._shared_stats is not None:
+            stats.update(self._shared_stats.read(SharedStorageStats.CODEC_FIELDS))
+            stats['compression_ratio'] = (round(stats['raw_bytes'] / stats['stored_bytes'], 2)
+                                          if stats['stored_bytes'] else None)
+        return stats
+    
+    def get_storage_stats(self) -> Dict[str, Any]:
+        """统计数据库的存储占用、压缩率和去重情况（需要扫描内容表，仅供管理工具使用）"""
+        with self._db.reader() as conn:
+            total_rows = conn.execute('SELECT COUNT(*) FROM requests').fetchone()[0]
+            legacy_rows = conn.execute("SELECT COUNT(*) FROM requests WHERE headers != ''").fetchone()[0]
+            blob_rows, raw_bytes, stored_bytes = conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(raw_size), 0), COALESCE(SUM(stored_size), 0) FROM request_blobs'
+            ).fetchone()
+            segment_count, segment_refs, segment_raw_bytes, segment_stored_bytes = conn.execute('''
+                SELECT COUNT(*), COALESCE(SUM(refcount), 0), COALESCE(SUM(raw_size), 0), COALESCE(SUM(stored_size), 0)
+                FROM body_segments
+            ''').fetchone()
+            page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+            page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+            free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        return {
+            'total_rows': total_rows,
+            'legacy_rows': legacy_rows,
+            'compressed_rows': blob_rows,
+            'raw_bytes': raw_bytes,
+            'stored_bytes': stored_bytes + segment_stored_bytes,
+            'compression_ratio': round(raw_bytes / (stored_bytes + segment_stored_bytes), 2)
+                                 if stored_bytes + segment_stored_bytes else None,
+            'unique_segments': segment_count,
+            'segment_references': segment_refs,
+            'segment_raw_bytes': segment_raw_bytes,
+            'segment_stored_bytes': segment_stored_bytes,
+            'database_bytes': page_size * page_count,
+            'free_bytes': page_size * free_pages,
+            'compression': self._codec.method,
+        }
+    
+    def compress_legacy_rows(self, batch_size: int = 500,
+                             progress: Optional[Callable[[Dict[str, Any]], None]] = None) -> Dict[str, Any]:
+        """将旧记录的请求头和请求/响应体转移到压缩表
+
+        按批次在短事务中执行，可以在服务运行时进行。
+        """
+        totals = {'rows': 0, 'raw_bytes': 0, 'stored_bytes': 0, 'cpu_seconds': 0.0}
+        while True:
+            with self._db.writer() as conn, conn:
+                rows = conn.execute('''
+                    SELECT id, headers, body, response_headers, response_body
+                    FROM requests WHERE headers != '' LIMIT ?
+                ''', (batch_size,)).fetchall()
+                if not rows:
+                    break
                 
-                # 更新数据库
-                self._save_to_database(record)
+                raw_before = self._codec.raw_bytes
+                stored_before = self._codec.stored_bytes
+                cpu_before = self._codec.compress_seconds
+                cursor = conn.cursor()
+                for row in rows:
+                    self._insert_blob(cursor, *row)
+                cursor.executemany('''
+                    UPDATE requests
+                    SET headers = '', body = NULL, response_headers = NULL, response_body = NULL
+                    WHERE id = ?
+                ''', [(row[0],) for row in rows])
+            
+            totals['rows'] += len(rows)
+            totals['raw_bytes'] += self._codec.raw_bytes - raw_before
+            totals['stored_bytes'] += self._codec.stored_bytes - stored_before
+            totals['cpu_seconds'] += self._codec.compress_seconds - cpu_before
+            if progress:
+                progress(dict(totals))
+        return totals
+    
+    def backfill_usage(self, batch_size: int = 500,
+                       progress: Optional[Callable[[Dict[str, Any]], None]] = None) -> Dict[str, Any]:
+        """从已记录的请求/响应体中提取模型和用量，回填到旧记录的列中
+
+        按 rowid 分批读取，在短事务中更新，可以在服务运行时进行。
+        """
+        totals = {'rows': 0, 'updated': 0}
+        last_rowid = 0
+        while True:
+            with self._db.reader() as conn:
+                rows = conn.execute(f'''
+                    SELECT requests.rowid, {self.RECORD_COLUMNS} FROM requests {self.RECORD_JOIN}
+                    WHERE requests.rowid > ? AND requests.generation_id IS NULL AND requests.prompt_tokens IS NULL
+                    ORDER BY requests.rowid LIMIT ?
+                ''', (last_rowid, batch_size)).fetchall()
+                records = [(row[0], self._row_to_record(row[1:], conn)) for row in rows]
+            if not records:
+                break
+            last_rowid = records[-1][0]
+            
+            updates = []
+            for rowid, record in records:
+                usage = extract_usage(record.response_body)
+                usage.setdefault('model', record.model or extract_model(record.body))
+                # 只更新有新值的记录，重复执行时不会再次写入
+                if any(value is not None and getattr(record, field) != value for field, value in usage.items()):
+                    updates.append((*(usage.get(field) for field in USAGE_FIELDS), rowid))
+            if updates:
+                assignments = ', '.join(f'{field} = COALESCE(?, {field})' for field in USAGE_FIELDS)
+                with self._db.writer() as conn, conn:
+                    conn.executemany(f'UPDATE requests SET {assignments} WHERE rowid = ?', updates)
+            
+            totals['rows'] += len(records)
+            totals['updated'] += len(updates)
+            if progress:
+                progress(dict(totals))
+        return totals
+    
+    def get_streamed_records(self, limit: int = 100, model: Optional[str] = None,
+                             path: Optional[str] = None) -> List[RequestRecord]:
+        """最近成功完成的流式响应记录（有首token时间的记录），model 支持*通配，path 为路径前缀"""
+        conditions = ['requests.response_status = 200', 'requests.error IS NULL', 'requests.ttft_ms IS NOT NULL']
+        params: List[Any] = []
+        if model:
+            conditions.append('requests.model GLOB ?')
+            params.append(model)
+        if path:
+            conditions.append('instr(requests.url, ?) > 0')
+            params.append(path)
+        with self._db.reader() as conn:
+            rows = conn.execute(f'''
+                SELECT {self.RECORD_COLUMNS} FROM requests {self.RECORD_JOIN}
+                WHERE {' AND '.join(conditions)}
+                ORDER BY requests.timestamp DESC LIMIT ?
+            ''', (*params, limit)).fetchall()
+            records = [self._row_to_record(row, conn) for row in rows]
+        if path:
+            records = [record for record in records if urlsplit(record.url).path.startswith(path)]
+        return records
+    
+    def get_usage_totals(self, group_by: Sequence[str] = ('model',), since: Optional[datetime] = None,
+                         until: Optional[datetime] = None, apikey_filter: str = None) -> List[Dict[str, Any]]:
+        """按模型、API Key、供应商或日期汇总用量，只包含已落盘的记录"""
+        unknown = [group for group in group_by if group not in USAGE_GROUPS]
+        if unknown:
+            raise ValueError(f"Unknown usage group: {unknown[0]}")
+        conditions, params = [], []
+        if since:
+            conditions.append('requests.timestamp >= ?')
+            params.append(since.isoformat())
+        if until:
+            conditions.append('requests.timestamp < ?')
+            params.append(until.isoformat())
+        if apikey_filter:
+            conditions.append('requests.authorization_bearer = ?')
+            params.append(apikey_filter)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        columns = [f'{USAGE_GROUPS[group]} AS {group}' for group in group_by] + [
+            'COUNT(*)', 'SUM(prompt_tokens)', 'SUM(completion_tokens)', 'SUM(total_tokens)', 'SUM(cost)'
+        ]
+        group_clause = f"GROUP BY {', '.join(group_by)}" if group_by else ''
+        
+        with self._db.reader() as conn:
+            cursor = conn.execute(f'''
+                SELECT {', '.join(columns)}
+                FROM requests
+                {where}
+                {group_clause}
+                ORDER BY SUM(total_tokens) IS NULL, SUM(total_tokens) DESC, COUNT(*) DESC
+            ''', params)
+            names = list(group_by) + ['requests', 'prompt_tokens', 'completion_tokens', 'total_tokens', 'cost']
+            return [dict(zip(names, row)) for row in cursor.fetchall()]
+    
+    @staticmethod
+    def _rollup_ranges(since: Optional[datetime], until: Optional[datetime]) -> List[Tuple[str, str, str]]:
+        """将时间范围拆分为中间的整小时和两端不足一小时的部分
+
+        返回 (汇总表, 起始桶, 结束桶) 列表，结束桶不包含在内。范围按分钟取整，
+        分钟汇总已被清理的一端扩展到整小时。
+        """
+        minute_table, minute_length = ROLLUP_TABLES['minute']
+        hour_table, hour_length = ROLLUP_TABLES['hour']
+        
+        def floor(value: datetime, hour: bool) -> datetime:
+            return value.replace(minute=0 if hour else value.minute, second=0, microsecond=0)
+        
+        def ceil(value: datetime, hour: bool) -> datetime:
+            floored = floor(value, hour)
+            return floored if floored == value else floored + (timedelta(hours=1) if hour else timedelta(minutes=1))
+        
+        now = datetime.now()
+        minute_cutoff = now - timedelta(hours=STATS_MINUTE_RETENTION_HOURS)
+        start = floor(since, hour=since < minute_cutoff) if since else None
+        end = ceil(until or now, hour=(until or now) < minute_cutoff)
+        if start is not None and start >= end:
+            return []
+        hour_start = ceil(start, hour=True) if start else None
+        hour_end = floor(end, hour=True)
+        if hour_start is not None and hour_start >= hour_end:
+            return [(minute_table, start.isoformat()[:minute_length], end.isoformat()[:minute_length])]
+        
+        ranges = [(hour_table, hour_start.isoformat()[:hour_length] if hour_start else '',
+                   hour_end.isoformat()[:hour_length])]
+        if start is not None and start < hour_start:
+            ranges.append((minute_table, start.isoformat()[:minute_length], hour_start.isoformat()[:minute_length]))
+        if end > hour_end:
+            ranges.append((minute_table, hour_end.isoformat()[:minute_length], end.isoformat()[:minute_length]))
+        return ranges
+    
+    def get_stats(self, since: Optional[datetime] = None, until: Optional[datetime] = None,
+                  apikey_filter: str = None, group_by: Sequence[str] = ()) -> Dict[str, Any]:
+        """从汇总表统计时间范围内的请求数、成功率和延迟分位数，只包含已落盘的记录
+
+        读取的汇总行数只与时间范围的小时数和分组数有关，与记录总数无关。
+        group_by 可选 STATS_GROUPS 中的分组，结果的 groups 按请求数降序排列。
+        """
+        unknown = [group for group in group_by if group not in STATS_GROUPS]
+        if unknown:
+            raise ValueError(f"Unknown stats group: {unknown[0]}")
+        columns = [STATS_GROUPS[group] for group in group_by]
+        total = LatencyStats()
+        groups: Dict[Tuple, LatencyStats] = {}
+        
+        with self._db.reader() as conn:
+            for table, start, end in self._rollup_ranges(since, until):
+                conditions, params = ['bucket >= ?', 'bucket < ?'], [start, end]
+                if apikey_filter:
+                    conditions.append('apikey = ?')
+                    params.append(apikey_filter)
+                for row in conn.execute(f'''
+                    SELECT {', '.join(columns + ['requests', 'errors', 'latency_count', 'latency_sum', 'histogram'])}
+                    FROM {table} WHERE {' AND '.join(conditions)}
+                ''', params):
+                    stats = LatencyStats.from_row(row[len(columns):])
+                    total.merge(stats)
+                    if columns:
+                        groups.setdefault(tuple(row[:len(columns)]), LatencyStats()).merge(stats)
+        
+        result = total.to_dict()
+        if group_by:
+            # 汇总表中用空字符串和0表示缺少的API Key、模型和状态码
+            result['groups'] = [
+                {**{group: value or None for group, value in zip(group_by, key)}, **stats.to_dict()}
+                for key, stats in sorted(groups.items(), key=lambda item: item[1].requests, reverse=True)
+            ]
+        return result
+    
+    def count_rollup_requests(self, apikey_filter: str = None) -> int:
+        """从小时汇总统计全部已落盘的请求数，删除记录不会减少该计数"""
+        table, _ = ROLLUP_TABLES['hour']
+        with self._db.reader() as conn:
+            if apikey_filter:
+                row = conn.execute(f'SELECT SUM(requests) FROM {table} WHERE apikey = ?', (apikey_filter,)).fetchone()
+            else:
+                row = conn.execute(f'SELECT SUM(requests) FROM {table}').fetchone()
+        return row[0] or 0
+    
+    def vacuum(self):
+        """整理数据库文件，回收已释放的空间"""
+        with self._db.writer() as conn:
+            conn.execute('VACUUM')
+    
+    def train_compression_dictionary(self, samples: int = 2000, dict_size: int = 112640) -> int:
+        """用最近的请求/响应体训练zstd字典，之后的写入使用该字典压缩
+
+        返回新字典的ID。已运行的服务进程需重启后才会使用新字典。
+        """
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to train a compression dictionary")
+        with self._db.reader() as conn:
+            rows = conn.execute('''
+                SELECT body, response_body FROM request_blobs ORDER BY rowid DESC LIMIT ?
+            ''', (samples,)).fetchall()
+        sample_data = [data for row in rows for data in map(self._codec.decode_bytes, row) if data]
+        if not sample_data:
+            raise RuntimeError("No compressed bodies available for training")
+        dictionary = zstandard.train_dictionary(dict_size, sample_data)
+        with self._db.writer() as conn, conn:
+            cursor = conn.execute(
+                'INSERT INTO compression_dicts (created_at, data) VALUES (?, ?)',
+                (datetime.now().isoformat(), dictionary.as_bytes())
+            )
+            dict_id = cursor.lastrowid
+        self._codec.add_dictionary(dict_id, dictionary.as_bytes(), use_for_compression=True)
+        return dict_id
+    
+    def delete_request(self, request_id: str) -> bool:
+        """删除一条请求记录"""
+        with self._lock:
+            live = self._live.pop(request_id, None) is not None
+        with self._db.writer() as conn, conn:
+            return self._delete_rows(conn, [request_id]) > 0 or live
+    
+    def delete_requests_before(self, cutoff: datetime, batch_size: int = 500) -> int:
+        """分批删除指定时间之前的请求记录，返回删除的条数"""
+        deleted = 0
+        while True:
+            with self._db.writer() as conn, conn:
+                request_ids = [row[0] for row in conn.execute(
+                    'SELECT id FROM requests WHERE timestamp < ? ORDER BY timestamp LIMIT ?',
+                    (cutoff.isoformat(), batch_size)
+                )]
+                if not request_ids:
+                    return deleted
+                deleted += self._delete_rows(conn, request_ids)
     
     def get_request(self, request_id: str) -> Optional[RequestRecord]:
         """获取单个请求记录"""
         with self._lock:
-            return self._load_from_database(request_id)
+            record = self._live.get(request_id)
+            if record is not None:
+                return replace(record)
+        return self._load_from_database(request_id)
     
-    def get_requests(self, limit: int = 100, offset: int = 0, apikey_filter: str = None) -> List[RequestRecord]:
-        """获取请求列表"""
-        with self._lock:
-            return self._load_requests_from_database(limit, offset, apikey_filter)
+    def get_requests(self, limit: int = 100, offset: int = 0, apikey_filter: str = None,
+                     before: Optional[Cursor] = None, after: Optional[Cursor] = None,
+                     summary: bool = False) -> list:
+        """获取请求列表
+
+        传入 before/after 游标时使用键集分页，任意页的查询代价与第一页相同；
+        否则按 offset 分页（内存中的记录排在最前）。summary 为 True 时只返回摘要。
+        """
+        live = self._live_records(apikey_filter)
+        if before or after:
+            live = [record for record in live
+                    if (not before or self._sort_key(record) < tuple(before))
+                    and (not after or self._sort_key(record) > tuple(after))]
+            stored = self._load_requests_from_database(limit, 0, apikey_filter, before=before, after=after,
+                                                       summary=summary)
+            merged = self._merge_records(self._as_summaries(live, summary), stored)
+            # 向后翻页时取离游标最近的一页
+            return merged[-limit:] if after else merged[:limit]
+        
+        head = live[offset:offset + limit]
+        stored = []
+        if len(head) < limit:
+            stored = self._load_requests_from_database(limit - len(head), max(0, offset - len(live)), apikey_filter,
+                                                       summary=summary)
+        return self._merge_records(self._as_summaries(head, summary), stored)[:limit]
+    
+    def get_request_summaries(self, limit: int = 100, offset: int = 0, apikey_filter: str = None,
+                              before: Optional[Cursor] = None,
+                              after: Optional[Cursor] = None) -> List[RequestSummary]:
+        """获取请求摘要列表，只读取列表需要的列"""
+        return self.get_requests(limit, offset, apikey_filter, before=before, after=after, summary=True)
     
     def get_total_count(self, apikey_filter: str = None) -> int:
         """获取总请求数"""
-        with self._lock:
-            return self._get_total_count_from_database(apikey_filter)
+        return self._get_total_count_from_database(apikey_filter) + len(self._live_records(apikey_filter))
     
-    def search_requests(self, query: str, limit: int = 100, apikey_filter: str = None) -> List[RequestRecord]:
-        """搜索请求"""
-        with self._lock:
-            return self._search_database(query, limit, apikey_filter)
+    def _search_live(self, query: str, apikey_filter: str = None) -> List[RequestRecord]:
+        """在内存中尚未落盘的记录里做简单的子串匹配，匹配的字段与数据库搜索一致"""
+        needle = query.lower()
+        full_text = self._fts_enabled and bool(build_fts_query(query))
+        return [record for record in self._live_records(apikey_filter)
+                if any(needle in (value or '').lower()
+                       for value in ((record.url, record.method, record.model, record.body, record.response_body)
+                                     if full_text else (record.url, record.method, record.model)))]
+    
+    def search_requests(self, query: str, limit: int = 100, offset: int = 0, apikey_filter: str = None,
+                        order: str = 'rank', summary: bool = False) -> list:
+        """搜索请求，默认按相关度排序；进行中的匹配记录排在第一页最前"""
+        live = self._search_live(query, apikey_filter)
+        head = self._as_summaries(live[offset:offset + limit], summary)
+        stored = self._search_database(query, limit - len(head), max(0, offset - len(live)),
+                                       apikey_filter, order, summary) if len(head) < limit else []
+        live_ids = {record.id for record in head}
+        return (head + [record for record in stored if record.id not in live_ids])[:limit]
+    
+    def search_request_summaries(self, query: str, limit: int = 100, offset: int = 0, apikey_filter: str = None,
+                                 order: str = 'rank') -> List[RequestSummary]:
+        """搜索请求并只返回摘要"""
+        return self.search_requests(query, limit, offset, apikey_filter, order, summary=True)
+    
+    def count_search_results(self, query: str, apikey_filter: str = None) -> int:
+        """获取搜索结果总数"""
+        return (self._count_search_results_from_database(query, apikey_filter)
+                + len(self._search_live(query, apikey_filter)))
 
 # 全局存储实例
 request_storage = RequestStorage()
@@ -4,33 +4,169 @@ OpenAI API 反向代理服务器
 import asyncio
 import aiohttp
 import json
+import os
+import socket
 import time
 import logging
 from aiohttp import web, ClientSession, ClientTimeout
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Mapping, Optional, Tuple
 from urllib.parse import urljoin
 
-from models import request_storage
+from cache import ResponseCache, CacheDecision, CachedResponse, CACHE_HEADER
+from catalog import CatalogCache, CONDITIONAL_HEADERS, etag_matches
+from coalesce import Coalescer, FlightReader
+from replay import StreamReplayer, StreamRecorder, REPLAY_HEADER, replay_schedule
+from models import request_storage, extract_model
+from metrics import Registry, RouteLabels, ModelLabels, CONTENT_TYPE, OVERFLOW_LABEL
+from sse import StreamCapture, usage_from_response
+from upstream import (
+    UpstreamPool, UpstreamTimeout, PhaseTimeouts, ReadWatchdog, resolve_timeouts, overrides_need_model
+)
 from config import (
-    PROXY_HOST, PROXY_PORT, OPENAI_API_BASE, DEFAULT_APIKEY
+    PROXY_HOST, PROXY_PORT, OPENAI_API_BASE, DEFAULT_APIKEY,
+    STREAM_FLUSH_BYTES, STREAM_FLUSH_LATENCY_MS, STREAM_FLUSH_ON_EVENT, METRICS_PORT, STREAM_REPLAY_PRELOAD
 )
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# 客户端在响应完成前断开时记录的错误
+CLIENT_ABORTED = "client_aborted"
+CLIENT_CLOSED_STATUS = 499  # 客户端断开的请求在指标和记录中使用的状态码
+
+class StreamStats:
+    """流式转发的写入统计，用于调整写入合并参数"""
+
+    FLUSH_REASONS = ('event', 'size', 'latency', 'eof')
+
+    def __init__(self):
+        self.streams = 0
+        self.chunks = 0
+        self.writes = 0
+        self.bytes = 0
+        self.flushes = dict.fromkeys(self.FLUSH_REASONS, 0)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """转换为字典"""
+        return {
+            'streams': self.streams,
+            'chunks': self.chunks,
+            'writes': self.writes,
+            'bytes': self.bytes,
+            'chunks_per_write': round(self.chunks / self.writes, 2) if self.writes else None,
+            'flushes': dict(self.flushes),
+            'flush_bytes': STREAM_FLUSH_BYTES,
+            'flush_latency_ms': STREAM_FLUSH_LATENCY_MS,
+            'flush_on_event': STREAM_FLUSH_ON_EVENT,
+        }
+
+class ProxyMetrics:
+    """代理的Prometheus指标"""
+
+    STREAM_BUCKETS = (0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0)
+    METHODS = frozenset(('GET', 'POST', 'PUT', 'PATCH', 'DELETE', 'HEAD', 'OPTIONS'))
+
+    def __init__(self, proxy: 'OpenAIProxy'):
+        self.registry = registry = Registry()
+        self.requests = registry.counter(
+            'proxy_requests_total', 'Proxied requests.', ('method', 'path', 'status', 'model'))
+        self.duration = registry.histogram(
+            'proxy_request_duration_seconds', 'Total request duration including streaming.', ('path',))
+        self.ttfb = registry.histogram(
+            'proxy_upstream_ttfb_seconds', 'Time until upstream response headers arrived.', ('model',))
+        self.stream_duration = registry.histogram(
+            'proxy_stream_duration_seconds', 'Duration of streaming responses.', ('model',),
+            buckets=self.STREAM_BUCKETS)
+        self.bytes_in = registry.counter('proxy_request_bytes_total', 'Request body bytes received from clients.')
+        self.bytes_out = registry.counter('proxy_response_bytes_total', 'Response body bytes sent to clients.')
+        self.routes = RouteLabels()
+        self.models = ModelLabels()
+
+        # 以下数值在抓取时从已有的统计信息读取
+        upstream = proxy.upstream
+        registry.gauge('proxy_requests_in_flight', 'Requests currently being proxied.',
+                       function=lambda: proxy.in_flight)
+        registry.gauge('proxy_storage_queue_depth', 'Records waiting to be written to storage.',
+                       function=lambda: request_storage.get_queue_stats()['queue_depth'])
+        registry.counter('proxy_storage_records_dropped_total', 'Records dropped because the storage queue was full.',
+                         function=lambda: request_storage.get_queue_stats()['records_dropped'])
+        registry.gauge('proxy_upstream_connections', 'Upstream connections by state.', ('state',),
+                       function=lambda: self._connections(upstream))
+        registry.gauge('proxy_upstream_connections_queued', 'Requests waiting for an upstream connection.',
+                       function=lambda: upstream.queued_now)
+        registry.counter('proxy_upstream_connections_created_total', 'Upstream connections opened.',
+                         function=lambda: upstream.connections_created)
+        registry.counter('proxy_upstream_connections_reused_total', 'Requests that reused a pooled connection.',
+                         function=lambda: upstream.connections_reused)
+        cache = proxy.cache
+        registry.counter('proxy_cache_requests_total', 'Response cache lookups by result.', ('result',),
+                         function=lambda: {(result,): count for result, count in cache.results.items()})
+        registry.gauge('proxy_cache_bytes', 'Bytes held by the response cache.', ('tier',),
+                       function=lambda: {('memory',): cache.memory_bytes, ('disk',): cache.disk_bytes})
+        coalescer = proxy.coalescer
+        registry.counter('proxy_coalesced_requests_total',
+                         'Requests that joined an identical in-flight upstream request.',
+                         function=lambda: coalescer.followers)
+        registry.gauge('proxy_coalesce_in_progress', 'Upstream requests that identical requests can still join.',
+                       function=lambda: coalescer.in_progress)
+        replayer = proxy.replayer
+        registry.counter('proxy_stream_replays_total', 'Streaming responses served from a recording.',
+                         function=lambda: replayer.replayed)
+        registry.counter('proxy_stream_recordings_total', 'Streaming responses recorded for replay.',
+                         function=lambda: replayer.recorded)
+        catalog = proxy.catalog
+        registry.counter('proxy_catalog_requests_total', 'Catalog endpoint requests by cache result.', ('result',),
+                         function=lambda: {(result,): count for result, count in catalog.results.items()})
+        registry.counter('proxy_catalog_revalidations_total',
+                         'Catalog refreshes answered by upstream with 304 Not Modified.',
+                         function=lambda: catalog.revalidated)
+
+    @staticmethod
+    def _connections(upstream: UpstreamPool) -> Dict[tuple, float]:
+        """连接池中使用中和空闲的连接数"""
+        stats = upstream.stats()
+        return {('in_use',): stats['connections_in_use'], ('idle',): stats['connections_idle']}
+
+    def observe(self, request: web.Request, status: int, duration: float, bytes_out: int):
+        """记录一个已结束的请求，各阶段的耗时由处理过程写入request"""
+        path = self.routes.label(request.path)
+        model = self.models.label(request.get('model'))
+        method = request.method if request.method in self.METHODS else OVERFLOW_LABEL
+        self.requests.labels(method, path, str(status), model).inc()
+        self.duration.labels(path).observe(duration)
+        self.bytes_in.inc(request.content_length or 0)
+        self.bytes_out.inc(bytes_out)
+        ttfb_ms = request.get('timings', {}).get('ttfb_ms')
+        if ttfb_ms is not None:
+            self.ttfb.labels(model).observe(ttfb_ms / 1000)
+            if request.get('streaming'):
+                self.stream_duration.labels(model).observe(duration)
+
+    def render(self) -> str:
+        return self.registry.render()
+
 class OpenAIProxy:
     """OpenAI API 代理类"""
 
     def __init__(self):
         self.session: Optional[ClientSession] = None
-        self.timeout = ClientTimeout(total=300)  # 5分钟超时
+        # 各阶段的超时由 ReadWatchdog 控制，会话只设置默认的连接超时
+        self.timeout = PhaseTimeouts().client_timeout()
+        self.upstream = UpstreamPool()
+        self.stream_stats = StreamStats()
+        self.in_flight = 0  # 正在处理的请求数
+        self.cache = ResponseCache()
+        self.coalescer = Coalescer()
+        self.replayer = StreamReplayer()
+        self.catalog = CatalogCache()
+        self.metrics = ProxyMetrics(self)
 
     def _prepare_headers(self, original_headers: Dict[str, str]) -> Dict[str, str]:
         """准备转发的请求头"""
-        # 移除不需要转发的头部
+        # 移除不需要转发的头部和代理自身的控制头(X-Proxy-*)
         forward_headers = {k: v for k, v in original_headers.items()
-                         if k.lower() not in ['host', 'content-length']}
+                         if k.lower() not in ['host', 'content-length'] and not k.lower().startswith('x-proxy-')}
 
         # 如果没有Authorization头，添加默认API Key
         if not any(k.lower() == 'authorization' for k in forward_headers.keys()):
@@ -41,7 +177,7 @@ class OpenAIProxy:
     async def init_session(self):
         """初始化HTTP会话"""
         if not self.session:
-            self.session = ClientSession(timeout=self.timeout)
+            self.session = self.upstream.create_session(self.timeout)
 
     async def close_session(self):
         """关闭HTTP会话"""
@@ -49,36 +185,85 @@ class OpenAIProxy:
             await self.session.close()
             self.session = None
 
+    def _cached_response(self, cached: CachedResponse, request_id: str, start_time: float) -> web.Response:
+        """返回缓存的响应，记录中标记为命中"""
+        duration_ms = (time.time() - start_time) * 1000
+        request_storage.update_response(
+            request_id=request_id,
+            status=cached.status,
+            headers=cached.headers,
+            body=cached.body.decode('utf-8', errors='replace'),
+            duration_ms=duration_ms,
+            bytes_out=len(cached.body),
+            usage=cached.usage,
+            cache_status='hit'
+        )
+        logger.info(f"Response {cached.status} for {request_id} from cache ({duration_ms:.2f}ms)")
+        return web.Response(
+            body=cached.body,
+            status=cached.status,
+            headers={**cached.headers, CACHE_HEADER: 'HIT', 'Age': str(cached.age())}
+        )
+
     async def _handle_regular_response(self, response, response_headers: Dict[str, str],
-                                     request_id: str, start_time: float) -> web.Response:
-        """处理普通（非流式）响应"""
+                                     request_id: str, start_time: float,
+                                     watchdog: Optional[ReadWatchdog], timings: Dict[str, float],
+                                     cache_decision: Optional[CacheDecision] = None) -> web.Response:
+        """处理普通（非流式）响应，合并的请求没有 watchdog，由读取上游的任务监视"""
         # 读取完整响应
-        response_body = await response.read()
+        chunks = []
+        try:
+            while True:
+                chunk = await response.content.readany()
+                if not chunk:
+                    break
+                if watchdog is not None:
+                    watchdog.touch()
+                chunks.append(chunk)
+        except asyncio.CancelledError:
+            logger.info(f"Client disconnected while reading response for {request_id}")
+            request_storage.update_response(
+                request_id=request_id,
+                status=response.status,
+                headers=response_headers,
+                body=None,
+                duration_ms=(time.time() - start_time) * 1000,
+                error=CLIENT_ABORTED,
+                bytes_out=0,
+                timings=timings,
+                **self._coalesce_fields(response)
+            )
+            raise
+        response_body = b''.join(chunks)
 
         # 计算耗时
         duration_ms = (time.time() - start_time) * 1000
 
-        # 尝试解析响应体为JSON格式化
-        try:
-            if response.content_type == 'application/json':
-                response_json = json.loads(response_body.decode('utf-8'))
-                formatted_response = json.dumps(response_json, ensure_ascii=False, indent=2)
-            else:
-                formatted_response = response_body.decode('utf-8')
-        except:
-            formatted_response = response_body.decode('utf-8', errors='ignore')
-
-        # 更新请求记录
+        # 原样记录响应体，格式化在Web界面查看时进行
+        usage = self._response_usage(response_body)
+        fields = self._coalesce_fields(response)
+        if cache_decision is not None:
+            fields['cache_status'] = cache_decision.status.lower()
         request_storage.update_response(
             request_id=request_id,
             status=response.status,
             headers=response_headers,
-            body=formatted_response,
-            duration_ms=duration_ms
+            body=response_body.decode('utf-8', errors='replace'),
+            duration_ms=duration_ms,
+            bytes_out=len(response_body),
+            timings=timings,
+            usage=usage,
+            **fields
         )
 
         logger.info(f"Response {response.status} for {request_id} ({duration_ms:.2f}ms)")
 
+        if cache_decision is not None:
+            if cache_decision.store and response.status == 200:
+                self.cache.put(cache_decision.key, CachedResponse.create(
+                    response.status, response_headers, response_body, usage, cache_decision.ttl))
+            response_headers = {**response_headers, CACHE_HEADER: cache_decision.status}
+
         # 返回响应
         return web.Response(
             body=response_body,
@@ -88,63 +273,88 @@ class OpenAIProxy:
 
     async def _handle_streaming_response(self, response, response_headers: Dict[str, str],
                                        request_id: str, start_time: float,
-                                       original_request: web.Request) -> web.StreamResponse:
-        """处理流式响应"""
+                                       original_request: web.Request, started_at: float,
+                                       watchdog: Optional[ReadWatchdog], timings: Dict[str, float],
+                                       recorder: Optional[StreamRecorder] = None) -> web.StreamResponse:
+        """处理流式响应，started_at 为计算首token时间等指标的起点（事件循环时间）"""
         logger.info(f"Handling streaming response for {request_id}")
 
-        # 确保必要的CORS和流式响应头
-        headers = dict(response_headers)
-        headers['Access-Control-Allow-Origin'] = '*'
-        headers['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS'
-        headers['Access-Control-Allow-Headers'] = '*'
-        headers['Cache-Control'] = 'no-cache'
-        headers['Connection'] = 'keep-alive'
-
         # 创建流式响应
         stream_response = web.StreamResponse(
             status=response.status,
-            headers=headers
+            headers=self._stream_headers(response_headers)
         )
 
         # 准备流式响应
+        original_request['streaming'] = True
         await stream_response.prepare(original_request)
 
-        # 用于收集流式数据
-        collected_chunks = []
+        # 边转发边增量解析，只保留有限的原始数据
+        capture = StreamCapture(started_at=started_at)
 
         try:
-            # 逐块转发数据，使用更小的块大小以提高响应性
-            async for chunk in response.content.iter_any():
-                if chunk:
-                    collected_chunks.append(chunk)
-                    await stream_response.write(chunk)
-                    # 立即刷新数据到客户端
-                    await stream_response.drain()
+            await self._forward_stream(response, stream_response, capture, watchdog, recorder)
 
             # 计算耗时
             duration_ms = (time.time() - start_time) * 1000
 
-            # 合并所有块用于记录
-            full_response = b''.join(collected_chunks)
-            try:
-                formatted_response = full_response.decode('utf-8')
-            except:
-                formatted_response = full_response.decode('utf-8', errors='ignore')
+            # 完整且没有错误的流保存为录制
+            if recorder is not None and response.status == 200 and capture.assembler.error is None:
+                self.replayer.save(recorder, response.status, response_headers, capture.assembler.usage_fields(),
+                                   timings.get('ttfb_ms'), asyncio.get_running_loop().time())
 
             # 更新请求记录
             request_storage.update_response(
                 request_id=request_id,
                 status=response.status,
                 headers=response_headers,
-                body=formatted_response,
-                duration_ms=duration_ms
+                body=capture.body(),
+                duration_ms=duration_ms,
+                bytes_out=capture.bytes_out,
+                timings={**timings, **capture.timings()},
+                usage=capture.assembler.usage_fields(),
+                **self._coalesce_fields(response)
             )
 
             logger.info(f"Streaming response completed for {request_id} ({duration_ms:.2f}ms)")
 
-        except asyncio.CancelledError:
-            logger.info(f"Streaming response cancelled for {request_id}")
-            raise
+        except (asyncio.CancelledError, ConnectionResetError) as e:
+            # 客户端断开：立即关闭上游连接停止生成，记录已收到的部分数据
+            logger.info(f"Client disconnected from stream {request_id} after {capture.bytes_out} bytes")
+            response.close()
+            request_storage.update_response(
+                request_id=request_id,
+                status=response.status,
+                headers=response_headers,
+                body=capture.body(),
+                duration_ms=(time.time() - start_time) * 1000,
+                error=CLIENT_ABORTED,
+                bytes_out=capture.bytes_out,
+                timings={**timings, **capture.timings()},
+                usage=capture.assembler.usage_fields(),
+                **self._coalesce_fields(response)
+            )
+            if isinstance(e, asyncio.CancelledError):
+                raise
+        except UpstreamTimeout as e:
+            logger.warning(f"Reaping stalled stream {request_id}: {e}")
+            # 通知客户端上游超时，并记录已收到的部分数据
+            try:
+                await stream_response.write(self._sse_error_event(e))
+            except Exception:
+                pass  # 客户端可能已断开
+            request_storage.update_response(
+                request_id=request_id,
+                status=response.status,
+                headers=response_headers,
+                body=capture.body(),
+                duration_ms=(time.time() - start_time) * 1000,
+                error=str(e),
+                bytes_out=capture.bytes_out,
+                timings={**timings, **capture.timings()},
+                usage=capture.assembler.usage_fields(),
+                **self._coalesce_fields(response)
+            )
         except Exception as e:
             logger.error(f"Error in streaming response for {request_id}: {e}")
             # 记录错误
@@ -153,9 +363,13 @@ class OpenAIProxy:
                 request_id=request_id,
                 status=response.status,
                 headers=response_headers,
-                body=None,
+                body=capture.body(),
                 duration_ms=duration_ms,
-                error=str(e)
+                error=str(e),
+                bytes_out=capture.bytes_out,
+                timings={**timings, **capture.timings()},
+                usage=capture.assembler.usage_fields(),
+                **self._coalesce_fields(response)
             )
             raise
 
@@ -167,25 +381,359 @@ class OpenAIProxy:
 
         return stream_response
     
+    @staticmethod
+    def _stream_headers(response_headers: Dict[str, str]) -> Dict[str, str]:
+        """确保必要的CORS和流式响应头"""
+        headers = dict(response_headers)
+        headers['Access-Control-Allow-Origin'] = '*'
+        headers['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS'
+        headers['Access-Control-Allow-Headers'] = '*'
+        headers['Cache-Control'] = 'no-cache'
+        headers['Connection'] = 'keep-alive'
+        return headers
+
+    @staticmethod
+    def _coalesce_fields(response) -> Dict[str, Any]:
+        """合并的请求在记录中附加的信息"""
+        return response.record_fields() if isinstance(response, FlightReader) else {}
+
+    @staticmethod
+    def _response_usage(body: bytes) -> Dict[str, Any]:
+        """从非流式JSON响应中提取模型和用量"""
+        if body.lstrip()[:1] != b'{':
+            return {}
+        try:
+            return usage_from_response(json.loads(body))
+        except ValueError:
+            return {}
+
+    @staticmethod
+    def _sse_error_event(error: UpstreamTimeout) -> bytes:
+        """上游超时时发送给客户端的SSE错误事件"""
+        event = {'error': {'message': str(error), 'type': 'upstream_timeout', 'code': 504}}
+        return f"data: {json.dumps(event)}\n\n".encode()
+
+    async def _forward_stream(self, response, stream_response: web.StreamResponse,
+                              capture: StreamCapture, watchdog: Optional[ReadWatchdog],
+                              recorder: Optional[StreamRecorder] = None):
+        """转发流式数据，将短时间内到达的小块合并后写出
+
+        缓冲以完整SSE事件结尾、达到 STREAM_FLUSH_BYTES 字节或最早的数据
+        已等待 STREAM_FLUSH_LATENCY_MS 毫秒时写出。
+        """
+        loop = asyncio.get_running_loop()
+        latency = STREAM_FLUSH_LATENCY_MS / 1000
+        stats = self.stream_stats
+        stats.streams += 1
+        buffer = bytearray()
+        deadline = 0.0
+
+        async def flush(reason: str):
+            stats.writes += 1
+            stats.bytes += len(buffer)
+            stats.flushes[reason] += 1
+            data = bytes(buffer)
+            buffer.clear()
+            # write()在发送缓冲区过大时会自动等待drain
+            await stream_response.write(data)
+            capture.bytes_out += len(data)
+
+        while True:
+            if buffer:
+                # 已有待写出的数据，最多再等待到截止时间
+                timeout = deadline - loop.time()
+                chunk = None
+                if timeout > 0:
+                    try:
+                        chunk = await asyncio.wait_for(response.content.readany(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+                if chunk is None:
+                    await flush('latency')
+                    continue
+            else:
+                chunk = await response.content.readany()
+
+            if not chunk:
+                if buffer:
+                    await flush('eof')
+                return
+
+            stats.chunks += 1
+            if watchdog is not None:
+                watchdog.touch()
+            now = loop.time()
+            capture.feed(chunk, now)
+            if recorder is not None:
+                recorder.feed(chunk, now)
+            if not buffer:
+                deadline = now + latency
+            buffer += chunk
+            if len(buffer) >= STREAM_FLUSH_BYTES:
+                await flush('size')
+            elif STREAM_FLUSH_ON_EVENT and (buffer.endswith(b'\n\n') or buffer.endswith(b'\r\n\r\n')):
+                await flush('event')
+            elif latency <= 0:
+                await flush('latency')
+
+    async def _replay_stream(self, recording: CachedResponse, speed: float, request_id: str, start_time: float,
+                             started_at: float, request: web.Request) -> web.StreamResponse:
+        """按录制的时间回放流式响应，speed 为倍速，0为不等待"""
+        loop = asyncio.get_running_loop()
+        timings: Dict[str, float] = {}
+        request['timings'] = timings
+        # 回放的数据同样经过 StreamCapture，记录的首token时间等指标反映回放的节奏
+        capture = StreamCapture(started_at=started_at)
+        stream_response = None
+
+        def record(error: Optional[str] = None, status: Optional[int] = None) -> float:
+            duration_ms = (time.time() - start_time) * 1000
+            request_storage.update_response(
+                request_id=request_id,
+                status=status or recording.status,
+                headers=recording.headers,
+                body=capture.body(),
+                duration_ms=duration_ms,
+                error=error,
+                bytes_out=capture.bytes_out,
+                timings={**timings, **capture.timings()},
+                usage=capture.assembler.usage_fields(),
+                cache_status='replay'
+            )
+            return duration_ms
+
+        try:
+            if speed > 0:
+                await asyncio.sleep(max(0.0, started_at + recording.timeline['ttfb_ms'] / 1000 / speed - loop.time()))
+            timings['ttfb_ms'] = (loop.time() - started_at) * 1000
+
+            stream_response = web.StreamResponse(
+                status=recording.status,
+                headers={**self._stream_headers(recording.headers), REPLAY_HEADER: 'HIT'}
+            )
+            request['streaming'] = True
+            await stream_response.prepare(request)
+
+            for data, due in replay_schedule(recording, speed):
+                delay = started_at + due - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                await stream_response.write(data)
+                capture.feed(data, loop.time())
+                capture.bytes_out += len(data)
+            duration_ms = record()
+            logger.info(f"Replayed stream for {request_id} at speed {speed:g} ({duration_ms:.2f}ms)")
+        except (asyncio.CancelledError, ConnectionResetError) as e:
+            logger.info(f"Client disconnected from replayed stream {request_id} after {capture.bytes_out} bytes")
+            record(CLIENT_ABORTED, None if stream_response is not None else CLIENT_CLOSED_STATUS)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+        except Exception as e:
+            # 录制损坏等错误，已开始输出时只能结束流
+            error_msg = str(e)
+            logger.error(f"Replay error for {request_id}: {error_msg}")
+            if stream_response is None or not stream_response.prepared:
+                record(error_msg, 500)
+                return web.Response(
+                    text=json.dumps({"error": error_msg}),
+                    status=500,
+                    content_type='application/json'
+                )
+            record(error_msg)
+        finally:
+            if stream_response is not None and stream_response.prepared:
+                try:
+                    await stream_response.write_eof()
+                except:
+                    pass  # 忽略EOF写入错误
+        return stream_response
+
+    async def preload_recordings(self, limit: int):
+        """从最近的请求记录中导入流式响应的录制"""
+        records = await asyncio.get_running_loop().run_in_executor(
+            None, lambda: request_storage.get_streamed_records(limit))
+        self.replayer.import_records(records)
+
+    async def _open_upstream(self, method: str, target_url: str, forward_headers: Dict[str, str],
+                             body_bytes: Optional[bytes], timeouts: PhaseTimeouts, timings: Dict[str, float]):
+        """发送请求到上游并等待响应头，等待的时间计入首字节超时"""
+        phase, limit = timeouts.first_byte_limit()
+        try:
+            return await asyncio.wait_for(self.session.request(
+                method=method,
+                url=target_url,
+                headers=forward_headers,
+                data=body_bytes if method in ['POST', 'PUT', 'PATCH'] else None,
+                timeout=timeouts.client_timeout(),
+                trace_request_ctx=timings
+            ), limit or None)
+        except aiohttp.ServerTimeoutError:
+            raise UpstreamTimeout('connect', timeouts.connect)
+        except asyncio.TimeoutError:
+            raise UpstreamTimeout(phase, limit)
+
+    async def _fetch_catalog(self, target_url: str, forward_headers: Dict[str, str], validators: Dict[str, str],
+                             timeouts: PhaseTimeouts, timings: Dict[str, float]) -> Tuple[int, Mapping[str, str], bytes]:
+        """向上游请求目录接口，validators 为条件请求头"""
+        await self.init_session()
+        started_at = asyncio.get_running_loop().time()
+        headers = {name: value for name, value in forward_headers.items() if name.lower() not in CONDITIONAL_HEADERS}
+        response = await self._open_upstream('GET', target_url, {**headers, **validators}, None, timeouts, timings)
+        timings['ttfb_ms'] = (asyncio.get_running_loop().time() - started_at) * 1000
+        watchdog = ReadWatchdog(response, timeouts, started_at)
+        chunks = []
+        try:
+            async with response:
+                while True:
+                    chunk = await response.content.readany()
+                    if not chunk:
+                        break
+                    watchdog.touch()
+                    chunks.append(chunk)
+        finally:
+            watchdog.stop()
+        return response.status, response.headers, b''.join(chunks)
+
+    async def _handle_catalog(self, request: web.Request, target_url: str, forward_headers: Dict[str, str],
+                              log_headers: Dict[str, str], start_time: float) -> web.Response:
+        """从目录缓存返回目录接口的响应，客户端的 If-None-Match 与 ETag 匹配时返回304"""
+        timeouts = resolve_timeouts(request.path)
+        timings: Dict[str, float] = {}
+        request['timings'] = timings
+        # 刷新可能在后台进行，上游的耗时只在本请求等待了上游时计入
+        fetched: Dict[str, float] = {}
+
+        def fetch(validators: Dict[str, str]):
+            return self._fetch_catalog(target_url, forward_headers, validators, timeouts, fetched)
+
+        try:
+            key = self.catalog.make_key(request.path_qs, forward_headers.get('Authorization', ''))
+            entry, result = await self.catalog.get(key, fetch)
+            if result in ('miss', 'bypass'):
+                timings.update(fetched)
+        except Exception as e:
+            timings.update(fetched)
+            error_msg = str(e)
+            status = 504 if isinstance(e, UpstreamTimeout) else 500
+            request_id = request_storage.add_request(method='GET', url=target_url, headers=log_headers, body=None)
+            request_storage.update_response(
+                request_id=request_id,
+                status=status,
+                headers={},
+                body=None,
+                duration_ms=(time.time() - start_time) * 1000,
+                error=error_msg,
+                timings=timings
+            )
+            logger.error(f"Proxy error for {request_id}: {error_msg}")
+            return web.Response(
+                text=json.dumps({"error": error_msg}),
+                status=status,
+                content_type='application/json'
+            )
+
+        cached = entry.response
+        headers = {**cached.headers, CACHE_HEADER: result.upper()}
+        if result in ('hit', 'stale'):
+            headers['Age'] = str(cached.age())
+        if result != 'bypass' and etag_matches(request.headers.get('If-None-Match'), entry.etag):
+            self.catalog.not_modified += 1
+            status, body = 304, b''
+            headers = {name: value for name, value in headers.items()
+                       if name.lower() not in ('content-type', 'content-length')}
+        else:
+            status, body = cached.status, cached.body
+
+        # 未命中的请求完整记录，命中缓存的请求按 CATALOG_CACHE_STORAGE 记录
+        store, store_body = self.catalog.record_body(result)
+        if store:
+            request_id = request_storage.add_request(method='GET', url=target_url, headers=log_headers, body=None)
+            duration_ms = (time.time() - start_time) * 1000
+            request_storage.update_response(
+                request_id=request_id,
+                status=status,
+                headers=headers,
+                body=body.decode('utf-8', errors='replace') if store_body and body else None,
+                duration_ms=duration_ms,
+                bytes_out=len(body),
+                timings=timings,
+                cache_status={'stale': 'hit', 'bypass': None}.get(result, result)
+            )
+            logger.info(f"Response {status} for {request_id} from catalog cache ({result}, {duration_ms:.2f}ms)")
+        return web.Response(body=body, status=status, headers=headers)
+
+    async def _dispatch_response(self, response, request_id: str, start_time: float, request: web.Request,
+                                 started_at: float, watchdog: Optional[ReadWatchdog], timings: Dict[str, float],
+                                 body_bytes: Optional[bytes], cache_decision: Optional[CacheDecision],
+                                 recorder: Optional[StreamRecorder]) -> web.StreamResponse:
+        """按响应类型转发上游响应，response 也可以是合并请求的 FlightReader"""
+        response_headers = dict(response.headers)
+
+        # 检查是否为流式响应
+        # 1. 检查响应头中的content-type
+        content_type = response_headers.get('content-type', '').lower()
+        is_streaming = (
+            content_type.startswith('text/event-stream') or
+            content_type.startswith('text/plain') or  # OpenAI有时使用text/plain
+            response_headers.get('transfer-encoding', '').lower() == 'chunked'
+        )
+
+        # 2. 如果响应头不明确，检查请求体中是否有stream参数
+        if not is_streaming and body_bytes and b'"stream"' in body_bytes:
+            try:
+                if request.content_type == 'application/json':
+                    body_data = json.loads(body_bytes)
+                    is_streaming = body_data.get('stream', False)
+            except:
+                pass
+
+        if is_streaming:
+            # 处理流式响应
+            return await self._handle_streaming_response(
+                response, response_headers, request_id, start_time, request, started_at, watchdog, timings,
+                recorder
+            )
+        else:
+            # 处理普通响应
+            return await self._handle_regular_response(
+                response, response_headers, request_id, start_time, watchdog, timings, cache_decision
+            )
+
+    async def _lookup(self, lookup, request_id: str, start_time: float, kind: str):
+        """等待缓存或录制的查找，查找失败时按未命中处理，转发上游"""
+        try:
+            return await lookup
+        except asyncio.CancelledError:
+            logger.info(f"Client disconnected before response for {request_id}")
+            request_storage.update_response(
+                request_id=request_id,
+                status=CLIENT_CLOSED_STATUS,
+                headers={},
+                body=None,
+                duration_ms=(time.time() - start_time) * 1000,
+                error=CLIENT_ABORTED,
+                bytes_out=0
+            )
+            raise
+        except Exception as e:
+            logger.warning(f"{kind} lookup failed for {request_id}, forwarding upstream: {e}")
+            return None
+
     async def proxy_request(self, request: web.Request) -> web.StreamResponse:
         """代理请求处理"""
         start_time = time.time()
+        started_at = asyncio.get_running_loop().time()
         
         # 记录请求信息
         method = request.method
         path = request.path_qs
         headers = dict(request.headers)
         
-        # 读取请求体
+        # 读取原始请求体，原样转发和记录
         body_bytes = None
         try:
-            if request.content_type == 'application/json':
-                body_data = await request.json()
-                body_str = json.dumps(body_data, ensure_ascii=False, indent=2)
-                body_bytes = body_str.encode('utf-8')
-            else:
-                body_bytes = await request.read()
-                body_str = body_bytes.decode('utf-8') if body_bytes else None
+            body_bytes = await request.read()
+            body_str = body_bytes.decode('utf-8', errors='replace') if body_bytes else None
         except Exception as e:
             body_str = f"Error reading body: {str(e)}"
             body_bytes = None
@@ -197,6 +745,10 @@ class OpenAIProxy:
         forward_headers = self._prepare_headers(headers)
         log_headers = dict(headers)
 
+        # 模型列表等目录接口由目录缓存处理
+        if self.catalog.matches(method, request.path):
+            return await self._handle_catalog(request, target_url, forward_headers, log_headers, start_time)
+
         request_id = request_storage.add_request(
             method=method,
             url=target_url,
@@ -206,98 +758,220 @@ class OpenAIProxy:
 
         logger.info(f"Proxying {method} {target_url} [ID: {request_id}]")
 
+        # 按路径和模型确定各阶段超时，模型同时用作指标标签
+        model = extract_model(body_str)
+        request['model'] = model
+        timeouts = resolve_timeouts(request.path, model if overrides_need_model() else None)
+
+        # 相同的请求直接返回缓存的响应
+        cache_decision = self.cache.decide(method, request.path, request.headers, body_bytes)
+        if cache_decision is not None and cache_decision.lookup:
+            cached = await self._lookup(self.cache.get(cache_decision.key), request_id, start_time, "Cache")
+            if cached is not None:
+                return self._cached_response(cached, request_id, start_time)
+
+        # 按配置回放录制的流式响应，没有录制时转发上游并录制
+        replay = self.replayer.decide(method, request.path, model, body_bytes)
+        recorder = None
+        if replay is not None:
+            if replay.replay:
+                recording = await self._lookup(self.replayer.get(replay.key), request_id, start_time, "Replay")
+                if recording is not None:
+                    return await self._replay_stream(recording, replay.speed, request_id, start_time,
+                                                     started_at, request)
+            recorder = self.replayer.recorder(replay, started_at)
+
+        # 相同的请求同时进行时只向上游发送一次
+        coalesce_key = self.coalescer.key_for(method, request.path, request.headers, body_bytes)
+
+        # 各阶段耗时，建立连接的耗时由连接池的追踪回调写入
+        timings: Dict[str, float] = {}
+        request['timings'] = timings
+        response = None
+        reader = None
         try:
             await self.init_session()
-            
-            # 发送请求到OpenAI API
-            async with self.session.request(
-                method=method,
-                url=target_url,
-                headers=forward_headers,
-                data=body_bytes if method in ['POST', 'PUT', 'PATCH'] else None
-            ) as response:
-
-                response_headers = dict(response.headers)
-
-                # 检查是否为流式响应
-                # 1. 检查响应头中的content-type
-                content_type = response_headers.get('content-type', '').lower()
-                is_streaming = (
-                    content_type.startswith('text/event-stream') or
-                    content_type.startswith('text/plain') or  # OpenAI有时使用text/plain
-                    response_headers.get('transfer-encoding', '').lower() == 'chunked'
-                )
 
-                # 2. 如果响应头不明确，检查请求体中是否有stream参数
-                if not is_streaming and body_str:
-                    try:
-                        if request.content_type == 'application/json':
-                            body_data = json.loads(body_str)
-                            is_streaming = body_data.get('stream', False)
-                    except:
-                        pass
-
-                if is_streaming:
-                    # 处理流式响应
-                    return await self._handle_streaming_response(
-                        response, response_headers, request_id, start_time, request
+            def open_upstream():
+                return self._open_upstream(method, target_url, forward_headers, body_bytes, timeouts, timings)
+
+            if coalesce_key is not None:
+                # 上游响应由合并请求的后台任务读取，本请求和相同的请求都从中读取
+                reader = self.coalescer.join(coalesce_key, open_upstream, timeouts, started_at)
+                if not reader.leader:
+                    logger.info(f"Coalesced {request_id} with an identical in-flight request")
+                try:
+                    await reader.wait_response()
+                    timings['ttfb_ms'] = (asyncio.get_running_loop().time() - started_at) * 1000
+                    response = reader
+                    # 只有发起上游请求的请求更新响应缓存和录制
+                    return await self._dispatch_response(
+                        reader, request_id, start_time, request, started_at, None, timings, body_bytes,
+                        *((cache_decision, recorder) if reader.leader else (None, None))
                     )
-                else:
-                    # 处理普通响应
-                    return await self._handle_regular_response(
-                        response, response_headers, request_id, start_time
+                finally:
+                    reader.close()
+
+            response = await open_upstream()
+            timings['ttfb_ms'] = (asyncio.get_running_loop().time() - started_at) * 1000
+
+            watchdog = ReadWatchdog(response, timeouts, started_at)
+            try:
+                async with response:
+                    return await self._dispatch_response(
+                        response, request_id, start_time, request, started_at, watchdog, timings, body_bytes,
+                        cache_decision, recorder
                     )
-                
+            except asyncio.CancelledError:
+                # 客户端断开时处理器被取消，关闭上游连接而不是放回连接池
+                response.close()
+                raise
+            finally:
+                watchdog.stop()
+
+        except asyncio.CancelledError:
+            # 收到响应后的断开已由各处理函数记录
+            if response is None:
+                logger.info(f"Client disconnected before response for {request_id}")
+            request_storage.update_response(
+                request_id=request_id,
+                status=CLIENT_CLOSED_STATUS,
+                headers={},
+                body=None,
+                duration_ms=(time.time() - start_time) * 1000,
+                error=CLIENT_ABORTED,
+                bytes_out=0,
+                timings=timings,
+                **self._coalesce_fields(reader)
+            )
+            raise
         except Exception as e:
             error_msg = str(e)
             duration_ms = (time.time() - start_time) * 1000
+            status = 504 if isinstance(e, UpstreamTimeout) else 500
             
-            # 记录错误
+            # 记录错误，合并的请求共享同一个上游错误
             request_storage.update_response(
                 request_id=request_id,
-                status=500,
+                status=status,
                 headers={},
                 body=None,
                 duration_ms=duration_ms,
-                error=error_msg
+                error=error_msg,
+                timings=timings,
+                **self._coalesce_fields(reader)
             )
             
             logger.error(f"Proxy error for {request_id}: {error_msg}")
             
             return web.Response(
                 text=json.dumps({"error": error_msg}),
-                status=500,
+                status=status,
                 content_type='application/json'
             )
 
+    async def handle_request(self, request: web.Request) -> web.StreamResponse:
+        """转发请求并记录指标"""
+        loop = asyncio.get_running_loop()
+        started_at = loop.time()
+        self.in_flight += 1
+        status = 500
+        bytes_out = 0
+        try:
+            response = await self.proxy_request(request)
+            status = response.status
+            # 流式响应已经写完，普通响应在处理器返回后才写出
+            bytes_out = response.body_length if response.prepared else (response.content_length or 0)
+            return response
+        except asyncio.CancelledError:
+            status = CLIENT_CLOSED_STATUS
+            raise
+        finally:
+            self.in_flight -= 1
+            self.metrics.observe(request, status, loop.time() - started_at, bytes_out)
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        """健康检查：上游会话可用时返回200"""
+        healthy = self.session is not None and not self.session.closed
+        return web.json_response({
+            'status': 'ok' if healthy else 'unavailable',
+            'pid': os.getpid(),
+            'in_flight': self.in_flight,
+        }, status=200 if healthy else 503)
+
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        """Prometheus文本格式的指标"""
+        return web.Response(body=self.metrics.render().encode(), headers={'Content-Type': CONTENT_TYPE})
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        """代理自身的运行统计"""
+        return web.json_response({
+            'pid': os.getpid(),
+            'streaming': self.stream_stats.to_dict(),
+            'upstream': self.upstream.stats(),
+            'cache': self.cache.stats(),
+            'coalesce': self.coalescer.stats(),
+            'replay': self.replayer.stats(),
+            'catalog': self.catalog.stats(),
+        })
+
 async def create_app() -> web.Application:
     """创建应用"""
     app = web.Application()
     proxy = OpenAIProxy()
+    app['proxy'] = proxy
     
+    # 代理自身的健康检查和统计信息，需在通配路由之前注册
+    app.router.add_get('/_proxy/healthz', proxy.handle_health)
+    app.router.add_get('/_proxy/stats', proxy.handle_stats)
+    app.router.add_get('/_proxy/metrics', proxy.handle_metrics)
+
     # 添加所有路由到代理处理器
-    app.router.add_route('*', '/{path:.*}', proxy.proxy_request)
+    app.router.add_route('*', '/{path:.*}', proxy.handle_request)
     
-    # 清理资源
+    # 启动时预热上游连接，退出时清理资源
     async def cleanup_context(app):
+        await proxy.init_session()
+        warmup = asyncio.create_task(proxy.upstream.warm_up(proxy.session, OPENAI_API_BASE))
+        if proxy.replayer.enabled and STREAM_REPLAY_PRELOAD:
+            await proxy.preload_recordings(STREAM_REPLAY_PRELOAD)
         yield
+        warmup.cancel()
         await proxy.close_session()
     
     app.cleanup_ctx.append(cleanup_context)
     
     return app
 
-async def main():
-    """主函数"""
+async def start_metrics_server(proxy: OpenAIProxy, port: int) -> web.AppRunner:
+    """在单独的端口上提供指标，多进程模式下可以分别抓取每个代理进程"""
+    app = web.Application()
+    app.router.add_get('/metrics', proxy.handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, PROXY_HOST, port).start()
+    logger.info(f"Metrics available on http://{PROXY_HOST}:{port}/metrics")
+    return runner
+
+async def main(sock: Optional[socket.socket] = None, worker_index: int = 0):
+    """主函数，多进程模式下在supervisor预先绑定的socket上监听"""
     app = await create_app()
     
-    runner = web.AppRunner(app)
+    # 客户端断开时立即取消处理器，以便中止上游请求
+    runner = web.AppRunner(app, handler_cancellation=True)
     await runner.setup()
     
-    site = web.TCPSite(runner, PROXY_HOST, PROXY_PORT)
+    if sock is not None:
+        site = web.SockSite(runner, sock)
+    else:
+        site = web.TCPSite(runner, PROXY_HOST, PROXY_PORT)
     await site.start()
     
-    logger.info(f"OpenAI Proxy Server started on http://{PROXY_HOST}:{PROXY_PORT}")
+    logger.info(f"OpenAI Proxy Server started on http://{PROXY_HOST}:{PROXY_PORT} (pid {os.getpid()})")
+    
+    metrics_runner = None
+    if METRICS_PORT:
+        metrics_runner = await start_metrics_server(app['proxy'], METRICS_PORT + worker_index)
     
     try:
         await asyncio.Future()  # 永远运行
@@ -305,6 +979,8 @@ async def main():
         logger.info("Shutting down proxy server...")
     finally:
         await runner.cleanup()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
 
 if __name__ == '__main__':
     asyncio.run(main())
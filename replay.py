@@ -0,0 +1,231 @@
+"""
+流式响应的录制和回放
+
+录制时按SSE事件保存转发的流式响应，以及每个事件距请求开始的时间；回放时相同的请求
+（路径、模型和规范化后的请求体相同）不再请求上游，按录制的时间原速、加速或不等待地输出，
+用于压测代理和演示环境。录制也可以从已保存的请求记录中导入，没有逐个事件的时间时，
+按记录的首字节、首token时间和总耗时均匀分布。
+
+录制使用与响应缓存相同的内存/磁盘两级存储，不区分API Key。
+"""
+import fnmatch
+import json
+import logging
+from typing import Any, Dict, Iterable, Iterator, List, Mapping, Optional, Tuple
+from urllib.parse import urlsplit
+
+from cache import ResponseCache, CachedResponse
+from config import (
+    STREAM_REPLAY_MODE, STREAM_REPLAY_SPEED, STREAM_REPLAY_RULES, STREAM_REPLAY_TTL,
+    STREAM_REPLAY_MEMORY_BYTES, STREAM_REPLAY_MAX_BYTES, STREAM_REPLAY_DIR, STREAM_REPLAY_DISK_BYTES
+)
+from models import RequestRecord
+from sse import TRUNCATED_MARKER
+
+logger = logging.getLogger(__name__)
+
+REPLAY_HEADER = 'X-Proxy-Replay'  # 响应头: 回放的响应为 HIT
+
+REPLAY_MODES = ('off', 'record', 'replay')
+
+# 被截断的流式记录中的标记，这样的记录不能导入
+_TRUNCATED = TRUNCATED_MARKER.split('{}')[0].encode()
+
+def event_ends(data: bytes) -> List[int]:
+    """各个完整SSE事件（以空行结束）的结束位置"""
+    ends = []
+    position = 0
+    while True:
+        lf = data.find(b'\n\n', position)
+        crlf = data.find(b'\r\n\r\n', position)
+        if crlf >= 0 and (lf < 0 or crlf < lf):
+            position = crlf + 4
+        elif lf >= 0:
+            position = lf + 2
+        else:
+            return ends
+        ends.append(position)
+
+def resolve_replay(path: str, model: Optional[str] = None, mode: str = STREAM_REPLAY_MODE,
+                   speed: float = STREAM_REPLAY_SPEED,
+                   rules: Dict[str, Dict[str, Any]] = STREAM_REPLAY_RULES) -> Tuple[str, float]:
+    """按路径前缀和模型计算请求的回放方式 (mode, speed)，模型的设置优先于路径"""
+    matched = [values for key, values in rules.items()
+               if key.startswith('/') and path.startswith(key)]
+    if model:
+        matched += [values for key, values in rules.items()
+                    if not key.startswith('/') and fnmatch.fnmatchcase(model, key)]
+    for values in matched:
+        mode = values.get('mode', mode)
+        speed = float(values.get('speed', speed))
+    return mode, speed
+
+class ReplayDecision:
+    """一个流式请求的录制/回放方式"""
+
+    __slots__ = ('key', 'replay', 'speed')
+
+    def __init__(self, key: str, replay: bool, speed: float):
+        self.key = key
+        self.replay = replay  # 是否先查找录制，否则只录制
+        self.speed = speed
+
+class StreamRecorder:
+    """记录转发的流式数据和每个SSE事件的到达时间"""
+
+    def __init__(self, key: str, started_at: float, max_bytes: int = STREAM_REPLAY_MAX_BYTES):
+        self.key = key
+        self.started_at = started_at
+        self.max_bytes = max_bytes
+        self.data = bytearray()
+        self.events: List[List[float]] = []  # [[事件结束位置, 距请求开始的毫秒数], ...]
+        self.overflow = False
+        self._scanned = 0
+
+    def feed(self, chunk: bytes, now: float):
+        if self.overflow:
+            return
+        if len(self.data) + len(chunk) > self.max_bytes:
+            # 超出上限的流不录制
+            self.overflow = True
+            self.data = bytearray()
+            self.events = []
+            return
+        self.data += chunk
+        at = round((now - self.started_at) * 1000, 1)
+        # 事件的结束标记可能跨越两块数据，从上次扫描位置之前3个字节开始查找
+        start = max(self._scanned - 3, self.events[-1][0] if self.events else 0)
+        for end in event_ends(bytes(self.data[start:])):
+            self.events.append([start + end, at])
+        self._scanned = len(self.data)
+
+    def timeline(self, ttfb_ms: Optional[float], last_at: float) -> Dict[str, Any]:
+        """录制的时间线，结尾不完整的事件在流结束时输出"""
+        events = list(self.events)
+        if not events or events[-1][0] < len(self.data):
+            events.append([len(self.data), round((last_at - self.started_at) * 1000, 1)])
+        return {'ttfb_ms': ttfb_ms or 0.0, 'events': events}
+
+def timeline_from_record(body: bytes, record: RequestRecord) -> Dict[str, Any]:
+    """已保存的记录没有逐个事件的时间，按首token时间到结束时间均匀分布各事件"""
+    ends = event_ends(body)
+    if not ends or ends[-1] < len(body):
+        ends.append(len(body))
+    ttfb = record.ttfb_ms or 0.0
+    first = record.ttft_ms if record.ttft_ms is not None else ttfb
+    last = max(first, record.duration_ms or first)
+    step = (last - first) / (len(ends) - 1) if len(ends) > 1 else 0.0
+    return {'ttfb_ms': ttfb, 'events': [[end, round(first + step * index, 1)] for index, end in enumerate(ends)]}
+
+def replay_schedule(recording: CachedResponse, speed: float) -> Iterator[Tuple[bytes, float]]:
+    """回放的数据和输出时间(距请求开始的秒数)，同一时间输出的事件合并为一次写入"""
+    body = recording.body
+    start = 0
+    pending_at = None
+    pending_end = 0
+    for end, at in recording.timeline['events']:
+        due = at / 1000 / speed if speed > 0 else 0.0
+        if pending_at is not None and due > pending_at:
+            yield body[start:pending_end], pending_at
+            start = pending_end
+        pending_at, pending_end = due, end
+    if pending_at is not None and pending_end > start:
+        yield body[start:pending_end], pending_at
+
+class StreamReplayer:
+    """流式响应的录制和回放"""
+
+    def __init__(self, mode: str = STREAM_REPLAY_MODE, speed: float = STREAM_REPLAY_SPEED,
+                 rules: Dict[str, Dict[str, Any]] = STREAM_REPLAY_RULES, ttl: float = STREAM_REPLAY_TTL,
+                 memory_bytes: int = STREAM_REPLAY_MEMORY_BYTES, max_bytes: int = STREAM_REPLAY_MAX_BYTES,
+                 disk_dir: str = STREAM_REPLAY_DIR, disk_bytes: int = STREAM_REPLAY_DISK_BYTES):
+        for value in [mode] + [values['mode'] for values in rules.values() if 'mode' in values]:
+            if value not in REPLAY_MODES:
+                raise ValueError(f"Unknown stream replay mode: {value}")
+        self.mode = mode
+        self.speed = speed
+        self.rules = rules
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.enabled = mode != 'off' or any(values.get('mode', 'off') != 'off' for values in rules.values())
+        # 只使用响应缓存的存储部分，请求是否适用由 decide 判断
+        self.store = ResponseCache(mode='off', ttl=ttl, memory_bytes=memory_bytes, max_entry_bytes=max_bytes,
+                                   disk_dir=disk_dir, disk_bytes=disk_bytes, paths='', shared=True)
+        self.replayed = 0
+        self.recorded = 0
+        self.imported = 0
+
+    def decide(self, method: str, path: str, model: Optional[str], body: Optional[bytes]) -> Optional[ReplayDecision]:
+        """判断流式请求是否录制或回放，不适用时返回 None"""
+        if not self.enabled or method != 'POST' or not body or b'"stream"' not in body:
+            return None
+        mode, speed = resolve_replay(path, model, self.mode, self.speed, self.rules)
+        if mode == 'off':
+            return None
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return None
+        if not isinstance(data, dict) or not data.get('stream'):
+            return None
+        return ReplayDecision(self.make_key(path, data), replay=mode == 'replay', speed=speed)
+
+    @staticmethod
+    def make_key(path: str, data: Dict[str, Any]) -> str:
+        return ResponseCache.make_key('POST', path, '', data)
+
+    def recorder(self, decision: ReplayDecision, started_at: float) -> StreamRecorder:
+        return StreamRecorder(decision.key, started_at, self.max_bytes)
+
+    async def get(self, key: str) -> Optional[CachedResponse]:
+        """查找录制，找到时计为一次回放"""
+        recording = await self.store.get(key)
+        if recording is not None:
+            self.replayed += 1
+        return recording
+
+    def save(self, recorder: StreamRecorder, status: int, headers: Mapping[str, str],
+             usage: Dict[str, Any], ttfb_ms: Optional[float], last_at: float):
+        """保存完整转发的流式响应"""
+        if recorder.overflow or not recorder.data:
+            return
+        self.store.put(recorder.key, CachedResponse.create(
+            status, headers, bytes(recorder.data), usage, self.ttl, recorder.timeline(ttfb_ms, last_at)))
+        self.recorded += 1
+
+    def import_records(self, records: Iterable[RequestRecord]) -> int:
+        """从已保存的请求记录导入录制，跳过不是SSE原始数据或被截断的响应，返回导入的数量"""
+        count = 0
+        for record in records:
+            body = (record.response_body or '').encode('utf-8')
+            if (record.response_status != 200 or record.error is not None or not body
+                    or body.lstrip()[:1] not in (b'd', b':', b'e') or _TRUNCATED in body):
+                continue
+            try:
+                data = json.loads(record.body or '')
+            except ValueError:
+                continue
+            if not isinstance(data, dict) or not data.get('stream'):
+                continue
+            key = self.make_key(urlsplit(record.url).path, data)
+            self.store.put(key, CachedResponse.create(
+                200, record.response_headers or {}, body, {}, self.ttl, timeline_from_record(body, record)))
+            count += 1
+        self.imported += count
+        logger.info(f"Imported {count} stream recordings from stored requests")
+        return count
+
+    def stats(self) -> Dict[str, Any]:
+        """录制和回放统计"""
+        store = self.store.stats()
+        return {
+            'mode': self.mode,
+            'speed': self.speed,
+            'replayed': self.replayed,
+            'recorded': self.recorded,
+            'imported': self.imported,
+            'misses': store['miss'],
+            'recordings_in_memory': store['memory_entries'],
+            'memory_bytes': store['memory_bytes'],
+            'disk_bytes': store['disk_bytes'],
+        }
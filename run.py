@@ -2,15 +2,15 @@
 """
 OpenAI 代理服务启动脚本
 """
+import argparse
 import asyncio
 import logging
 import signal
 import sys
 from concurrent.futures import ThreadPoolExecutor
 
-from proxy_server import main as proxy_main
-from web_server import main as web_main
-from config import PROXY_HOST, PROXY_PORT, WEB_HOST, WEB_PORT
+from config import PROXY_HOST, PROXY_PORT, WEB_HOST, WEB_PORT, PROXY_WORKERS
+from workers import Supervisor
 
 # 配置日志
 logging.basicConfig(
@@ -30,6 +30,9 @@ class ProxyService:
     async def start(self):
         """启动所有服务"""
         logger.info("正在启动 OpenAI 代理服务...")
+        # 单进程模式才需要加载服务代码，supervisor只负责管理子进程
+        from proxy_server import main as proxy_main
+        from web_server import main as web_main
         
         try:
             # 启动代理服务器
@@ -109,7 +112,23 @@ async def main():
     finally:
         await service.stop()
 
+def parse_args():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="OpenAI 代理服务")
+    parser.add_argument('--workers', type=int, default=PROXY_WORKERS,
+                        help="代理工作进程数，默认0为单进程模式（代理和Web界面运行在同一事件循环）；"
+                             "大于0时代理和Web界面各自运行在独立进程中")
+    return parser.parse_args()
+
 if __name__ == '__main__':
+    args = parse_args()
+    if args.workers > 0:
+        print(f"🚀 OpenAI 代理服务（{args.workers} 个代理进程）")
+        print(f"📡 代理服务器: http://{PROXY_HOST}:{PROXY_PORT}")
+        print(f"🌐 Web界面: http://{WEB_HOST}:{WEB_PORT}")
+        print(f"🩺 健康检查: http://{PROXY_HOST}:{PROXY_PORT}/_proxy/healthz, http://{WEB_HOST}:{WEB_PORT}/healthz")
+        Supervisor(args.workers).run()
+        sys.exit(0)
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
@@ -0,0 +1,380 @@
+"""
+流式响应（Server-Sent Events）的增量解析和重组
+"""
+import json
+import math
+from array import array
+from typing import Dict, List, Optional, Any, Tuple
+
+from config import STREAM_CAPTURE_MODE, STREAM_CAPTURE_MAX_BYTES
+
+# 流式记录被截断时追加的SSE注释行
+TRUNCATED_MARKER = "\n\n: [stream capture truncated, {} bytes omitted]\n"
+
+def usage_fields(model: Optional[str], generation_id: Optional[str], provider: Optional[str],
+                 usage: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """整理为存储使用的用量字段（见 models.USAGE_FIELDS）"""
+    fields = {'model': model, 'generation_id': generation_id, 'provider': provider}
+    usage = usage if isinstance(usage, dict) else {}
+    for key in ('prompt_tokens', 'completion_tokens', 'total_tokens'):
+        value = usage.get(key)
+        fields[key] = value if isinstance(value, int) else None
+    cost = usage.get('cost')
+    fields['cost'] = float(cost) if isinstance(cost, (int, float)) else None
+    return {key: value for key, value in fields.items() if value is not None}
+
+def usage_from_response(data: Any) -> Dict[str, Any]:
+    """从非流式JSON响应中提取用量字段"""
+    if not isinstance(data, dict):
+        return {}
+    return usage_fields(data.get('model'), data.get('id'), data.get('provider'), data.get('usage'))
+
+def extract_usage(body: Optional[str]) -> Dict[str, Any]:
+    """从已记录的响应体（JSON 或 SSE 原始数据）中提取用量字段"""
+    if not body:
+        return {}
+    if body.lstrip()[:1] == '{':
+        try:
+            return usage_from_response(json.loads(body))
+        except ValueError:
+            return {}
+    parser, assembler = SSEParser(), StreamAssembler(keep_text=False)
+    for _, data in parser.feed(body.encode('utf-8')) + parser.close():
+        assembler.feed(data)
+    return assembler.usage_fields()
+
+class SSEParser:
+    """增量SSE解析器，只缓存尚未结束的一行"""
+
+    MAX_LINE_SIZE = 4 * 1024 * 1024  # 单行最大字节数，超出的行被丢弃
+
+    def __init__(self):
+        self._buffer = b''
+        self._discarding = False
+        self._event = None
+        self._data: List[str] = []
+        self.dropped_lines = 0
+
+    def feed(self, chunk: bytes) -> List[Tuple[Optional[str], str]]:
+        """输入一段数据，返回其中完整的事件列表 [(event, data), ...]"""
+        events = []
+        lines = (self._buffer + chunk).split(b'\n')
+        self._buffer = lines.pop()
+        for line in lines:
+            if self._discarding:
+                self._discarding = False
+                continue
+            event = self._process_line(line.rstrip(b'\r').decode('utf-8', errors='replace'))
+            if event:
+                events.append(event)
+        if len(self._buffer) > self.MAX_LINE_SIZE:
+            self._buffer = b''
+            self._discarding = True
+            self.dropped_lines += 1
+        return events
+
+    def close(self) -> List[Tuple[Optional[str], str]]:
+        """流结束，处理剩余的数据"""
+        events = self.feed(b'\n\n') if self._buffer or self._data else []
+        self._buffer = b''
+        return events
+
+    def _process_line(self, line: str) -> Optional[Tuple[Optional[str], str]]:
+        """处理一行，遇到空行时返回累积的事件"""
+        if not line:
+            if not self._data:
+                self._event = None
+                return None
+            event = (self._event, '\n'.join(self._data))
+            self._event = None
+            self._data = []
+            return event
+        if line.startswith(':'):
+            return None  # 注释行，例如 ": OPENROUTER PROCESSING"
+        field, _, value = line.partition(':')
+        if value.startswith(' '):
+            value = value[1:]
+        if field == 'data':
+            self._data.append(value)
+        elif field == 'event':
+            self._event = value
+        return None
+
+class StreamAssembler:
+    """将chat.completion.chunk事件重组为完整的响应
+
+    keep_text 为 False 时只统计输出字符数、用量、结束原因和ID，不保留生成的文本；
+    保留的文本超过 max_chars 个字符后不再保留，结果标记为截断。
+    """
+
+    def __init__(self, keep_text: bool = True, max_chars: Optional[int] = None):
+        self.keep_text = keep_text
+        self.max_chars = max_chars
+        self.omitted_chars = 0  # 超出上限未保留的字符数
+        self._kept_chars = 0
+        self.id = None
+        self.model = None
+        self.created = None
+        self.object = None
+        self.usage = None
+        self.provider = None
+        self.error = None
+        self.done = False
+        self.events = 0
+        self.output_chars = 0  # 已生成的内容、推理和工具调用参数的字符数
+        self._choices: Dict[int, Dict[str, Any]] = {}
+
+    def feed(self, data: str):
+        """处理一个事件的data内容"""
+        if data.strip() == '[DONE]':
+            self.done = True
+            return
+        try:
+            chunk = json.loads(data)
+        except ValueError:
+            return
+        if not isinstance(chunk, dict):
+            return
+        self.events += 1
+        self.id = self.id or chunk.get('id')
+        self.model = self.model or chunk.get('model')
+        self.created = self.created or chunk.get('created')
+        self.object = self.object or chunk.get('object')
+        self.provider = self.provider or chunk.get('provider')
+        if chunk.get('usage'):
+            self.usage = chunk['usage']
+        if chunk.get('error'):
+            self.error = chunk['error']
+        for choice in chunk.get('choices') or []:
+            self._feed_choice(choice)
+
+    def _keep(self, text: str) -> bool:
+        """计入输出字符数，返回是否保留该段文本"""
+        self.output_chars += len(text)
+        if not self.keep_text:
+            return False
+        if self.omitted_chars or (self.max_chars is not None and self._kept_chars + len(text) > self.max_chars):
+            self.omitted_chars += len(text)
+            return False
+        self._kept_chars += len(text)
+        return True
+
+    @property
+    def truncated(self) -> bool:
+        """保留的文本是否超出了上限"""
+        return self.omitted_chars > 0
+
+    def _feed_choice(self, choice: Dict[str, Any]):
+        """合并单个choice的增量"""
+        state = self._choices.setdefault(choice.get('index', 0), {
+            'role': None, 'content': [], 'reasoning': [], 'tool_calls': {}, 'finish_reason': None
+        })
+        if choice.get('finish_reason'):
+            state['finish_reason'] = choice['finish_reason']
+        delta = choice.get('delta')
+        if delta is None:
+            # 旧版completions接口使用text字段
+            if isinstance(choice.get('text'), str) and self._keep(choice['text']):
+                state['content'].append(choice['text'])
+            return
+        if delta.get('role'):
+            state['role'] = delta['role']
+        if isinstance(delta.get('content'), str) and self._keep(delta['content']):
+            state['content'].append(delta['content'])
+        if isinstance(delta.get('reasoning'), str) and self._keep(delta['reasoning']):
+            state['reasoning'].append(delta['reasoning'])
+        for call in delta.get('tool_calls') or []:
+            if not self.keep_text:
+                arguments = (call.get('function') or {}).get('arguments')
+                if isinstance(arguments, str):
+                    self._keep(arguments)
+                continue
+            current = state['tool_calls'].setdefault(call.get('index', 0), {
+                'id': None, 'type': 'function', 'function': {'name': '', 'arguments': ''}
+            })
+            if call.get('id'):
+                current['id'] = call['id']
+            if call.get('type'):
+                current['type'] = call['type']
+            function = call.get('function') or {}
+            if function.get('name'):
+                current['function']['name'] += function['name']
+            if function.get('arguments') and self._keep(function['arguments']):
+                current['function']['arguments'] += function['arguments']
+
+    def usage_fields(self) -> Dict[str, Any]:
+        """流中的模型、生成ID和用量"""
+        return usage_fields(self.model, self.id, self.provider, self.usage)
+
+    @property
+    def finish_reason(self) -> Optional[str]:
+        """第一个choice的结束原因"""
+        choice = self._choices.get(0)
+        return choice['finish_reason'] if choice else None
+
+    def result(self) -> Dict[str, Any]:
+        """重组后的完整响应，格式与非流式响应一致"""
+        choices = []
+        for index in sorted(self._choices):
+            state = self._choices[index]
+            message = {'role': state['role'] or 'assistant', 'content': ''.join(state['content'])}
+            if state['reasoning']:
+                message['reasoning'] = ''.join(state['reasoning'])
+            if state['tool_calls']:
+                message['tool_calls'] = [state['tool_calls'][i] for i in sorted(state['tool_calls'])]
+            choices.append({'index': index, 'message': message, 'finish_reason': state['finish_reason']})
+        result = {
+            'id': self.id,
+            'object': (self.object or 'chat.completion').replace('.chunk', ''),
+            'created': self.created,
+            'model': self.model,
+            'choices': choices,
+        }
+        if self.provider is not None:
+            result['provider'] = self.provider
+        if self.usage is not None:
+            result['usage'] = self.usage
+        if self.error is not None:
+            result['error'] = self.error
+        if self.truncated:
+            result['truncated'] = {'omitted_chars': self.omitted_chars}
+        return result
+
+class GapHistogram:
+    """数据块间隔(毫秒)的对数分桶直方图，占用固定内存
+
+    每个桶的上界是下界的 GROWTH 倍，分位数取所在桶的几何中点，并限制在已观测的最小、最大值之间，
+    相对误差不超过约5%。同时记录间隔的数量、总和和最大值。
+    """
+
+    MIN_MS = 0.1    # 第一个桶的上界
+    GROWTH = 1.1
+    BUCKETS = 150   # 最后一个桶的下界约为 0.1ms * 1.1^148 ≈ 130s
+
+    def __init__(self):
+        self.counts = array('I', bytes(4 * self.BUCKETS))
+        self.count = 0
+        self.total = 0.0
+        self.min: Optional[float] = None
+        self.max: Optional[float] = None
+
+    def add(self, value: float):
+        if value <= self.MIN_MS:
+            index = 0
+        else:
+            index = min(self.BUCKETS - 1, math.ceil(math.log(value / self.MIN_MS, self.GROWTH)))
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    @property
+    def mean(self) -> Optional[float]:
+        return self.total / self.count if self.count else None
+
+    def percentile(self, p: float) -> Optional[float]:
+        """估算分位数（最近秩法）"""
+        if not self.count:
+            return None
+        rank = max(1, math.ceil(p / 100 * self.count))
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                if index == self.BUCKETS - 1:
+                    return self.max  # 最后一个桶没有上界
+                estimate = self.MIN_MS * self.GROWTH ** (index - 0.5) if index else self.MIN_MS / 2
+                return min(self.max, max(self.min, estimate))
+        return self.max
+
+class StreamCapture:
+    """边转发边记录流式响应，内存占用与流长度无关
+
+    原始数据最多保留 max_bytes 字节。mode 为 raw 时记录（可能被截断的）原始数据，重组时只统计
+    字符数和用量；为 assembled 时只记录重组结果，重组的文本最多保留 max_bytes 个字符，
+    解析出第一个事件后不再保留原始数据。
+    feed 传入到达时间时同时统计首个输出的时间、数据块间隔和生成速度。
+    """
+
+    def __init__(self, mode: str = STREAM_CAPTURE_MODE, max_bytes: int = STREAM_CAPTURE_MAX_BYTES,
+                 started_at: float = 0.0):
+        mode = mode.lower()
+        if mode not in ('raw', 'assembled'):
+            raise ValueError(f"Unknown stream capture mode: {mode}")
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self.parser = SSEParser()
+        self.assembler = StreamAssembler(keep_text=mode == 'assembled', max_chars=max_bytes)
+        self.total_bytes = 0
+        self.bytes_out = 0  # 已写给客户端的字节数，由转发循环更新
+        self._raw = bytearray()
+        self.started_at = started_at
+        self.first_output_at: Optional[float] = None
+        self.last_output_at: Optional[float] = None
+        self._last_chunk_at: Optional[float] = None
+        self.gaps = GapHistogram()  # 开始输出后相邻数据块的间隔(毫秒)
+
+    def feed(self, chunk: bytes, now: Optional[float] = None):
+        """记录一段转发的数据，now 为数据到达的时间"""
+        self.total_bytes += len(chunk)
+        assembling = self.mode == 'assembled' and self.assembler.events > 0
+        room = self.max_bytes - len(self._raw)
+        if room > 0 and not assembling:
+            self._raw += chunk[:room]
+        output_chars = self.assembler.output_chars
+        for _, data in self.parser.feed(chunk):
+            self.assembler.feed(data)
+        if self._raw and self.mode == 'assembled' and self.assembler.events:
+            # 能够重组时只记录重组结果，原始数据只在不是SSE格式时使用
+            self._raw = bytearray()
+        if now is None:
+            return
+        # 输出开始之前的保活注释等数据不计入间隔
+        if self.first_output_at is not None:
+            self.gaps.add((now - self._last_chunk_at) * 1000)
+            self._last_chunk_at = now
+        if self.assembler.output_chars > output_chars:
+            if self.first_output_at is None:
+                self.first_output_at = self._last_chunk_at = now
+            self.last_output_at = now
+
+    def timings(self) -> Dict[str, Optional[float]]:
+        """首个输出的时间、数据块间隔分位数(毫秒)和生成速度"""
+        if self.first_output_at is None:
+            return {}
+        window = self.last_output_at - self.first_output_at
+        tokens = (self.assembler.usage or {}).get('completion_tokens')
+        return {
+            'ttft_ms': (self.first_output_at - self.started_at) * 1000,
+            'gap_p50_ms': self.gaps.percentile(50),
+            'gap_p95_ms': self.gaps.percentile(95),
+            'gap_p99_ms': self.gaps.percentile(99),
+            'tokens_per_second': tokens / window if window > 0 and isinstance(tokens, (int, float)) else None,
+            'chars_per_second': self.assembler.output_chars / window if window > 0 else None,
+        }
+
+    @property
+    def truncated(self) -> bool:
+        """记录的内容是否超出了上限"""
+        if self.mode == 'assembled' and self.assembler.events:
+            return self.assembler.truncated
+        return self.total_bytes > len(self._raw)
+
+    def raw_text(self) -> str:
+        """已记录的原始数据，截断时附加说明"""
+        text = self._raw.decode('utf-8', errors='ignore')
+        if self.truncated:
+            text += TRUNCATED_MARKER.format(self.total_bytes - len(self._raw))
+        return text
+
+    def body(self) -> Optional[str]:
+        """用于存储的响应体"""
+        for _, data in self.parser.close():
+            self.assembler.feed(data)
+        if not self.total_bytes:
+            return None
+        # 不是SSE格式的分块响应没有可重组的内容，始终记录原始数据
+        if self.mode == 'assembled' and self.assembler.events:
+            return json.dumps(self.assembler.result(), ensure_ascii=False)
+        return self.raw_text()
@@ -2,34 +2,186 @@
  * OpenAI 代理监控前端脚本
  */
 
+// 最近一次同步的统计信息，实时事件在此基础上累加
+let liveStats = null;
+let statsSyncInterval;
+
+// 显示统计信息
+function renderStats(data) {
+    const totalRequestsEl = document.getElementById('total-requests');
+    const successRateEl = document.getElementById('success-rate');
+    const avgResponseTimeEl = document.getElementById('avg-response-time');
+    const p95ResponseTimeEl = document.getElementById('p95-response-time');
+    
+    if (totalRequestsEl) {
+        totalRequestsEl.textContent = data.total_requests;
+    }
+    
+    if (successRateEl) {
+        successRateEl.textContent = `${data.success_rate}%`;
+    }
+    
+    if (avgResponseTimeEl) {
+        avgResponseTimeEl.textContent = `${data.avg_response_time}ms`;
+    }
+    
+    if (p95ResponseTimeEl) {
+        p95ResponseTimeEl.textContent = data.p95_ms === null ? '-' : `${data.p95_ms}ms`;
+    }
+}
+
 // 更新统计信息
 async function updateStats() {
     try {
         const response = await fetch('/api/stats');
-        const data = await response.json();
-        
-        // 更新统计数据
-        const totalRequestsEl = document.getElementById('total-requests');
-        const successRateEl = document.getElementById('success-rate');
-        const avgResponseTimeEl = document.getElementById('avg-response-time');
-        
-        if (totalRequestsEl) {
-            totalRequestsEl.textContent = data.total_requests;
-        }
-        
-        if (successRateEl) {
-            successRateEl.textContent = `${data.success_rate}%`;
-        }
-        
-        if (avgResponseTimeEl) {
-            avgResponseTimeEl.textContent = `${data.avg_response_time}ms`;
-        }
-        
+        liveStats = await response.json();
+        renderStats(liveStats);
     } catch (error) {
         console.error('更新统计信息失败:', error);
     }
 }
 
+// 累加服务器推送的统计增量（分位数在下次同步时更新）
+function applyStatsDelta(delta) {
+    if (!liveStats) {
+        return;
+    }
+    const requests = (liveStats.requests || 0) + delta.requests;
+    const errors = (liveStats.errors || 0) + delta.errors;
+    const latencySum = (liveStats.avg_latency_ms || 0) * (liveStats.requests || 0) + delta.latency_sum;
+    liveStats.total_requests += delta.requests;
+    liveStats.requests = requests;
+    liveStats.errors = errors;
+    liveStats.success_rate = requests ? Math.round((requests - errors) / requests * 10000) / 100 : 0;
+    liveStats.avg_latency_ms = requests ? Math.round(latencySum / requests * 100) / 100 : 0;
+    liveStats.avg_response_time = liveStats.avg_latency_ms;
+    renderStats(liveStats);
+}
+
+// 转义HTML
+function escapeHtml(text) {
+    const div = document.createElement('div');
+    div.textContent = text;
+    return div.innerHTML;
+}
+
+// 格式化文件大小（与模板的 filesizeformat 一致）
+function formatSize(bytes) {
+    if (bytes < 1000) {
+        return bytes === 1 ? '1 Byte' : `${bytes} Bytes`;
+    } else if (bytes < 1000 * 1000) {
+        return `${(bytes / 1000).toFixed(1)} kB`;
+    }
+    return `${(bytes / 1000 / 1000).toFixed(1)} MB`;
+}
+
+// 生成请求列表项，与 index.html 中的模板保持一致
+function renderRequestItem(request) {
+    const item = document.createElement('div');
+    item.className = 'request-item';
+    item.dataset.requestId = request.id;
+    item.addEventListener('click', () => window.open(`/request/${request.id}`, '_blank'));
+    
+    const details = [];
+    if (request.response_status) {
+        const statusClass = request.response_status < 400 ? 'success' : 'error';
+        details.push(`<span class="status status-${statusClass}">${request.response_status}</span>`);
+    } else {
+        details.push('<span class="status status-pending">处理中</span>');
+    }
+    if (request.duration_ms) {
+        details.push(`<span class="duration">${request.duration_ms.toFixed(2)}ms</span>`);
+    }
+    if (request.cache_status === 'hit') {
+        details.push('<span class="size" title="响应来自缓存"><i class="fas fa-database"></i> 缓存命中</span>');
+    } else if (request.cache_status === 'replay') {
+        details.push('<span class="size" title="回放录制的流式响应"><i class="fas fa-redo"></i> 回放</span>');
+    } else if (request.cache_status === 'coalesced') {
+        details.push('<span class="size" title="与同时进行的相同请求共享上游响应"><i class="fas fa-link"></i> 已合并</span>');
+    }
+    if (request.coalesced) {
+        details.push(`<span class="size" title="合并到该请求的相同请求数"><i class="fas fa-link"></i> 合并 ${request.coalesced}</span>`);
+    }
+    if (request.model) {
+        details.push(`<span class="size" title="模型"><i class="fas fa-robot"></i> ${escapeHtml(request.model)}</span>`);
+    }
+    if (request.total_tokens !== null) {
+        const cost = request.cost !== null ? ` · $${request.cost.toFixed(4)}` : '';
+        details.push(`<span class="size" title="Token用量"><i class="fas fa-coins"></i> ${request.total_tokens} tokens${cost}</span>`);
+    }
+    if (request.ttft_ms !== null) {
+        details.push(`<span class="duration" title="首个Token时间"><i class="fas fa-bolt"></i> ${request.ttft_ms.toFixed(0)}ms</span>`);
+    }
+    if (request.tokens_per_second !== null) {
+        details.push(`<span class="duration" title="生成速度"><i class="fas fa-tachometer-alt"></i> ${request.tokens_per_second.toFixed(1)} tok/s</span>`);
+    }
+    if (request.body_size !== null) {
+        details.push(`<span class="size" title="请求体大小"><i class="fas fa-arrow-up"></i> ${formatSize(request.body_size)}</span>`);
+    }
+    if (request.response_size !== null) {
+        details.push(`<span class="size" title="响应体大小"><i class="fas fa-arrow-down"></i> ${formatSize(request.response_size)}</span>`);
+    }
+    if (request.error) {
+        details.push('<span class="error-indicator"><i class="fas fa-exclamation-triangle"></i></span>');
+    }
+    
+    item.innerHTML = `
+        <div class="request-header">
+            <span class="method ${getMethodClass(request.method)}">${escapeHtml(request.method)}</span>
+            <span class="url">${escapeHtml(request.url)}</span>
+            <span class="timestamp">${request.timestamp.slice(11, 19)}</span>
+        </div>
+        <div class="request-details">${details.join('')}</div>
+        ${request.preview ? `<div class="request-preview">${escapeHtml(request.preview)}</div>` : ''}
+    `;
+    return item;
+}
+
+// 将推送的请求开始/完成事件更新到列表（仅第一页且未搜索、排序时）
+function applyRequestEvent(event) {
+    const container = document.querySelector('.requests-container[data-live]');
+    if (!container) {
+        return;
+    }
+    let list = container.querySelector('.requests-list');
+    if (!list) {
+        container.innerHTML = '';
+        list = document.createElement('div');
+        list.className = 'requests-list';
+        container.appendChild(list);
+    }
+    
+    const item = renderRequestItem(event.request);
+    const existing = list.querySelector(`[data-request-id="${CSS.escape(event.request.id)}"]`);
+    if (existing) {
+        existing.replaceWith(item);
+        return;
+    }
+    list.prepend(item);
+    const pageSize = parseInt(container.dataset.pageSize, 10);
+    while (list.children.length > pageSize) {
+        list.lastElementChild.remove();
+    }
+}
+
+// 订阅服务器推送的实时事件，浏览器不支持时退回定时轮询
+function initLiveFeed() {
+    if (!window.EventSource) {
+        statsSyncInterval = setInterval(updateStats, 5000);
+        updateStats();
+        return;
+    }
+    const source = new EventSource('/api/events');
+    // 连接或重新连接后以服务器的统计为准
+    source.addEventListener('open', updateStats);
+    source.addEventListener('resync', updateStats);
+    source.addEventListener('stats', e => applyStatsDelta(JSON.parse(e.data).delta));
+    source.addEventListener('request', e => applyRequestEvent(JSON.parse(e.data)));
+    // 增量无法更新分位数和滑动的统计时间范围，定期重新同步
+    statsSyncInterval = setInterval(updateStats, 60000);
+    window.addEventListener('beforeunload', () => source.close());
+}
+
 // 格式化时间戳
 function formatTimestamp(timestamp) {
     const date = new Date(timestamp);
@@ -235,9 +387,13 @@ window.addEventListener('beforeunload', function() {
     if (autoRefreshInterval) {
         clearInterval(autoRefreshInterval);
     }
+    if (statsSyncInterval) {
+        clearInterval(statsSyncInterval);
+    }
 });
 
 // 导出函数供全局使用
 window.updateStats = updateStats;
+window.initLiveFeed = initLiveFeed;
 window.copyToClipboard = copyToClipboard;
 window.showNotification = showNotification;
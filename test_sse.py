@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+测试SSE解析和流式响应重组的脚本
+
+上游的数据块可能在任意字节处断开（包括多字节UTF-8字符和 \\r\\n 中间），
+同一个流无论怎样切分，解析出的事件和重组结果都应与一次性输入时相同。
+"""
+import json
+import random
+import sys
+
+from sse import SSEParser, StreamAssembler, StreamCapture
+
+def chunk_event(delta, finish_reason=None, **extra):
+    """构造一个chat.completion.chunk事件"""
+    chunk = {
+        "id": "gen-test",
+        "object": "chat.completion.chunk",
+        "created": 1700000000,
+        "model": "openai/gpt-4o",
+        "provider": "OpenAI",
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        **extra,
+    }
+    return json.dumps(chunk, ensure_ascii=False)
+
+def data_line(data, newline="\n"):
+    """构造一个只有data字段的事件"""
+    return f"data: {data}{newline}{newline}".encode()
+
+# 覆盖注释行、\r\n 换行、event 字段、多行 data、中文内容和分段的工具调用参数
+FIRST_CALL = {'index': 0, 'id': 'call_1', 'function': {'name': 'get_weather', 'arguments': '{"ci'}}
+REST_CALL = {'index': 0, 'function': {'arguments': 'ty": "北京"}'}}
+USAGE = {'prompt_tokens': 10, 'completion_tokens': 8, 'total_tokens': 18}
+STREAM = b"".join([
+    b": OPENROUTER PROCESSING\n\n",
+    data_line(chunk_event({'role': 'assistant', 'content': ''}), "\r\n"),
+    data_line(chunk_event({'content': '你好，'})),
+    b"event: message\n" + data_line(chunk_event({'content': '世界 🌍'})),
+    b'data: {"id": "gen-test", "choices": [{"index": 0,\ndata:  "delta": {"content": "!"}}]}\n\n',
+    data_line(chunk_event({'tool_calls': [FIRST_CALL]})),
+    data_line(chunk_event({'tool_calls': [REST_CALL]})),
+    data_line(chunk_event({}, 'tool_calls', usage=USAGE)),
+    data_line("[DONE]"),
+])
+
+def parse(chunks):
+    """依次输入各数据块，返回全部事件"""
+    parser = SSEParser()
+    events = []
+    for chunk in chunks:
+        events.extend(parser.feed(chunk))
+    events.extend(parser.close())
+    return events
+
+def assemble(events, **kwargs):
+    """重组事件，返回完整响应"""
+    assembler = StreamAssembler(**kwargs)
+    for _, data in events:
+        assembler.feed(data)
+    return assembler.result()
+
+def capture(chunks, mode, max_bytes=1 << 20):
+    """用 StreamCapture 记录数据块，返回存储的响应体"""
+    stream_capture = StreamCapture(mode=mode, max_bytes=max_bytes)
+    for chunk in chunks:
+        stream_capture.feed(chunk)
+    return stream_capture.body()
+
+def split_at(data, points):
+    """在给定位置切分数据"""
+    bounds = [0, *sorted(points), len(data)]
+    return [data[start:end] for start, end in zip(bounds, bounds[1:])]
+
+EXPECTED_EVENTS = parse([STREAM])
+EXPECTED_RESULT = assemble(EXPECTED_EVENTS)
+
+def test_reference():
+    """一次性输入时的解析和重组结果"""
+    print("📜 测试完整输入...")
+    assert len(EXPECTED_EVENTS) == 8, f"事件数为 {len(EXPECTED_EVENTS)}"
+    assert EXPECTED_EVENTS[2][0] == 'message'
+    message = EXPECTED_RESULT['choices'][0]['message']
+    assert message['content'] == '你好，世界 🌍!', message['content']
+    assert message['tool_calls'][0]['function']['arguments'] == '{"city": "北京"}'
+    assert EXPECTED_RESULT['choices'][0]['finish_reason'] == 'tool_calls'
+    assert EXPECTED_RESULT['usage']['completion_tokens'] == 8
+    print(f"✅ 解析出 {len(EXPECTED_EVENTS)} 个事件，重组结果正确")
+
+def test_every_split_point():
+    """在每个字节处切成两块"""
+    print("\n✂️  测试任意位置切分为两块...")
+    for point in range(len(STREAM) + 1):
+        events = parse(split_at(STREAM, [point]))
+        assert events == EXPECTED_EVENTS, f"在第 {point} 字节处切分时事件不同"
+        assert assemble(events) == EXPECTED_RESULT, f"在第 {point} 字节处切分时重组结果不同"
+    print(f"✅ {len(STREAM) + 1} 个切分位置的结果都相同")
+
+def test_random_splits():
+    """随机切成多块，以及逐字节输入"""
+    print("\n🎲 测试随机切分...")
+    rng = random.Random(20240101)
+    for _ in range(300):
+        points = rng.sample(range(1, len(STREAM)), rng.randint(2, 20))
+        assert parse(split_at(STREAM, points)) == EXPECTED_EVENTS, f"切分位置 {sorted(points)} 的事件不同"
+    single_bytes = [STREAM[i:i + 1] for i in range(len(STREAM))]
+    assert parse(single_bytes) == EXPECTED_EVENTS, "逐字节输入时事件不同"
+    print("✅ 300 次随机切分和逐字节输入的结果都相同")
+
+def test_capture_splits():
+    """StreamCapture 记录的响应体与切分方式无关，截断时也一样"""
+    print("\n📼 测试流式记录...")
+    rng = random.Random(7)
+    for mode, max_bytes in (('assembled', 1 << 20), ('assembled', 8), ('raw', 1 << 20), ('raw', 100)):
+        expected = capture([STREAM], mode, max_bytes)
+        for _ in range(100):
+            points = rng.sample(range(1, len(STREAM)), rng.randint(1, 10))
+            assert capture(split_at(STREAM, points), mode, max_bytes) == expected, \
+                f"{mode} 模式 (max_bytes={max_bytes}) 在 {sorted(points)} 处切分时记录不同"
+        print(f"   {mode} max_bytes={max_bytes}: {len(expected)} 字符")
+    assert json.loads(capture([STREAM], 'assembled')) == EXPECTED_RESULT
+    assert capture([STREAM], 'raw') == STREAM.decode('utf-8')
+    print("✅ 各种切分方式记录的响应体都相同")
+
+def test_usage_only():
+    """只统计用量时输出字符数与保留文本时一致"""
+    print("\n🔢 测试只统计用量的重组...")
+    full = StreamAssembler()
+    counting = StreamAssembler(keep_text=False)
+    for _, data in EXPECTED_EVENTS:
+        full.feed(data)
+        counting.feed(data)
+    assert counting.output_chars == full.output_chars, (counting.output_chars, full.output_chars)
+    assert counting.usage_fields() == full.usage_fields()
+    print(f"✅ 输出字符数均为 {full.output_chars}")
+
+if __name__ == "__main__":
+    print("=" * 60)
+    print("🌊 SSE 解析和重组测试")
+    print("=" * 60)
+
+    tests = (test_reference, test_every_split_point, test_random_splits, test_capture_splits, test_usage_only)
+    failed = 0
+    for test in tests:
+        try:
+            test()
+        except AssertionError as e:
+            failed += 1
+            print(f"❌ {test.__name__} 失败: {e}")
+
+    print("\n" + "=" * 60)
+    print(f"📊 测试总结: {len(tests) - failed}/{len(tests)} 通过")
+    print("=" * 60)
+    sys.exit(1 if failed else 0)
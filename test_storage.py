@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+测试请求体片段去重存储的脚本
+
+检查 split_segments / join_segments 能逐字节还原请求体，以及多条记录共用片段、
+同一ID的记录被重写后，从数据库读回的请求体和片段引用计数仍然正确。
+"""
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+from dataclasses import replace
+
+# 在导入 models 之前指定临时数据库，避免模块级的存储实例写入当前目录
+TEMP_DIR = tempfile.mkdtemp(prefix='proxy-test-')
+os.environ['DB_PATH'] = os.path.join(TEMP_DIR, 'global.db')
+
+from models import RequestStorage, build_fts_query, split_segments, join_segments, segment_hash
+
+LONG_TEXT = "这是一段足够长的系统提示，用于触发片段去重。" * 20
+TOOL = {
+    "type": "function",
+    "function": {
+        "name": "get_weather",
+        "description": "Get the weather for a city. " * 10,
+        "parameters": {"type": "object", "properties": {"city": {"type": "string"}}},
+    },
+}
+
+def chat_body(question, indent=None, separators=None):
+    """构造带有共同系统提示和工具定义的聊天请求体"""
+    return json.dumps({
+        "model": "openai/gpt-4o",
+        "messages": [
+            {"role": "system", "content": LONG_TEXT},
+            {"role": "user", "content": question},
+        ],
+        "tools": [TOOL],
+        "stream": False,
+    }, ensure_ascii=False, indent=indent, separators=separators)
+
+# 各种格式的请求体，都必须能逐字节还原
+BODIES = [
+    chat_body("你好"),
+    chat_body("Hello", indent=2),
+    chat_body("compact", separators=(',', ':')),
+    json.dumps({"messages": [{"content": "转义 \" \\ \n \t   " + "x" * 300}]}),
+    '  {  "messages" : [ ' + json.dumps({"content": "y" * 300}) + ' , "short" , [1, 2, 3] ] , "n": 1 }  ',
+    '{"messages": [], "tools": []}',
+    '{"model": "a", "messages": "not a list"}',
+    '{"messages": [{"content": "' + "z" * 300 + '"}',  # 不完整的JSON
+    '[{"messages": []}]',
+    'not json at all, mentions "messages" though',
+    '',
+]
+
+def test_split_round_trip():
+    """拆分后再拼接应得到原始请求体"""
+    print("🧩 测试片段拆分和还原...")
+    for body in BODIES:
+        split = split_segments(body)
+        if split is None:
+            print(f"   不拆分: {body[:40]!r}")
+            continue
+        parts, segments = split
+        assert len(parts) == len(segments) + 1, body[:60]
+        assert join_segments(parts, segments) == body, f"还原失败: {body[:60]!r}"
+        print(f"   {len(segments)} 个片段: {body[:40]!r}")
+    print("✅ 所有请求体都能逐字节还原")
+
+def stored_segments(storage):
+    """数据库中的片段引用计数 {hash: refcount}"""
+    with storage._db.reader() as conn:
+        return dict(conn.execute('SELECT hash, refcount FROM body_segments').fetchall())
+
+def add_record(storage, body):
+    """写入一条已完成的记录并等待落盘"""
+    request_id = storage.add_request('POST', 'http://127.0.0.1/api/v1/chat/completions', {}, body)
+    storage.update_response(request_id, 200, {}, '{"choices": []}', duration_ms=1.0)
+    assert storage.flush(10), "写入队列没有按时落盘"
+    return request_id
+
+def test_shared_segments():
+    """多条记录共用片段时只存一份，读回的请求体不变"""
+    print("\n🔗 测试共用片段...")
+    storage = RequestStorage(os.path.join(TEMP_DIR, 'shared.db'))
+    try:
+        first = add_record(storage, chat_body("第一个问题"))
+        second = add_record(storage, chat_body("第二个问题"))
+        shared = {segment_hash(segment): 2 for segment in split_segments(chat_body("第一个问题"))[1]}
+        segments = stored_segments(storage)
+        for digest, refcount in shared.items():
+            assert segments.get(digest) == refcount, f"片段 {digest[:12]} 的引用计数为 {segments.get(digest)}"
+        assert storage.get_request(first).body == chat_body("第一个问题")
+        assert storage.get_request(second).body == chat_body("第二个问题")
+        print(f"   {len(shared)} 个共用片段，数据库中共 {len(segments)} 个片段")
+
+        storage.delete_request(first)
+        assert all(count == 1 for count in stored_segments(storage).values())
+        assert storage.get_request(second).body == chat_body("第二个问题")
+        storage.delete_request(second)
+        assert stored_segments(storage) == {}, "删除所有记录后片段没有释放"
+        print("✅ 共用片段的存储、读取和释放正确")
+    finally:
+        storage.close()
+
+def test_rewrite():
+    """同一ID的记录被重写时，旧片段被释放，读回的是新请求体"""
+    print("\n♻️  测试重写记录...")
+    storage = RequestStorage(os.path.join(TEMP_DIR, 'rewrite.db'))
+    try:
+        request_id = add_record(storage, chat_body("original question"))
+        record = storage.get_request(request_id)
+        before = stored_segments(storage)
+
+        # 与原记录完全相同的重写不应改变引用计数
+        storage._write_batch([replace(record)])
+        assert stored_segments(storage) == before, "相同内容重写后引用计数发生变化"
+        assert storage.get_request(request_id).body == record.body
+
+        # 换一个请求体重写，同一批次中重复的ID只写入最后一条
+        new_body = json.dumps({"messages": [{"role": "user", "content": "rewritten content " * 30}]})
+        storage._write_batch([replace(record, body=chat_body("中间版本")), replace(record, body=new_body)])
+        expected = {segment_hash(segment): 1 for segment in split_segments(new_body)[1]}
+        assert stored_segments(storage) == expected, "重写后旧片段没有释放"
+        assert storage.get_request(request_id).body == new_body
+        assert len(storage.search_requests('rewritten')) == 1
+        assert len(storage.search_requests('original')) == 0, "重写后旧内容仍然能被搜索到"
+        print("✅ 重写后的请求体、片段和搜索索引正确")
+    finally:
+        storage.close()
+
+# 搜索框输入和期望的FTS5查询
+FTS_QUERIES = [
+    ('hello world', '"hello" "world"'),
+    ('model:openai/gpt* status:200', 'model : "openai/gpt"* status : "200"'),
+    ('"exact phrase"', '"exact phrase"'),
+    ('foo AND bar OR', '"foo" AND "bar"'),
+    ('NOT', ''),
+    ('say "hi', '"say" "hi"'),
+    ('unknown:field', '"unknown:field"'),
+    ('a"b', '"a""b"'),
+    ('', ''),
+]
+
+def test_fts_query():
+    """搜索框输入转换后的FTS5查询，非空的查询都必须是合法的语法"""
+    print("\n🔍 测试全文搜索查询转换...")
+    conn = sqlite3.connect(':memory:')
+    try:
+        conn.execute('CREATE VIRTUAL TABLE fts USING fts5(url, method, model, status, body, response_body)')
+    except sqlite3.OperationalError:
+        conn = None
+        print("   SQLite 不支持 FTS5，只检查转换结果")
+    for query, expected in FTS_QUERIES:
+        fts_query = build_fts_query(query)
+        assert fts_query == expected, f"{query!r} 转换为 {fts_query!r}，期望 {expected!r}"
+        if conn is not None and fts_query:
+            try:
+                conn.execute('SELECT * FROM fts WHERE fts MATCH ?', (fts_query,)).fetchall()
+            except sqlite3.OperationalError as e:
+                raise AssertionError(f"{query!r} 转换后的查询 {fts_query!r} 不合法: {e}")
+    print(f"✅ {len(FTS_QUERIES)} 个查询转换正确")
+
+if __name__ == "__main__":
+    print("=" * 60)
+    print("🗄️  请求体去重存储测试")
+    print("=" * 60)
+
+    tests = (test_split_round_trip, test_shared_segments, test_rewrite, test_fts_query)
+    failed = 0
+    for test in tests:
+        try:
+            test()
+        except AssertionError as e:
+            failed += 1
+            print(f"❌ {test.__name__} 失败: {e}")
+
+    print("\n" + "=" * 60)
+    print(f"📊 测试总结: {len(tests) - failed}/{len(tests)} 通过")
+    if failed:
+        print(f"   临时数据库保留在: {TEMP_DIR}")
+    else:
+        shutil.rmtree(TEMP_DIR, ignore_errors=True)
+    print("=" * 60)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,274 @@
+"""
+上游连接池管理和统计
+"""
+import asyncio
+import fnmatch
+import logging
+import time
+from dataclasses import dataclass, fields, replace
+from typing import Dict, Any, Optional, Tuple
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, TraceConfig
+
+from config import (
+    UPSTREAM_LIMIT, UPSTREAM_LIMIT_PER_HOST, UPSTREAM_KEEPALIVE_TIMEOUT,
+    UPSTREAM_DNS_CACHE_TTL, UPSTREAM_WARMUP_CONNECTIONS, UPSTREAM_CONNECT_TIMEOUT,
+    UPSTREAM_FIRST_BYTE_TIMEOUT, UPSTREAM_IDLE_TIMEOUT, UPSTREAM_TOTAL_TIMEOUT, TIMEOUT_OVERRIDES
+)
+
+logger = logging.getLogger(__name__)
+
+class UpstreamTimeout(Exception):
+    """上游请求在某个阶段超时"""
+
+    def __init__(self, phase: str, seconds: float):
+        self.phase = phase
+        self.seconds = seconds
+        super().__init__(f"upstream {phase} timeout after {seconds:g}s")
+
+@dataclass(frozen=True)
+class PhaseTimeouts:
+    """上游请求各阶段的超时(秒)，0为不限制"""
+    connect: float = UPSTREAM_CONNECT_TIMEOUT
+    first_byte: float = UPSTREAM_FIRST_BYTE_TIMEOUT
+    idle: float = UPSTREAM_IDLE_TIMEOUT
+    total: float = UPSTREAM_TOTAL_TIMEOUT
+
+    def client_timeout(self) -> ClientTimeout:
+        """aiohttp只负责建立连接的超时，其余阶段由代理自行控制"""
+        return ClientTimeout(total=None, sock_connect=self.connect or None)
+
+    def first_byte_limit(self) -> Tuple[str, float]:
+        """等待响应头时生效的限制: (阶段, 秒数)"""
+        limits = [(phase, value) for phase, value in (('first_byte', self.first_byte), ('total', self.total))
+                  if value]
+        return min(limits, key=lambda limit: limit[1]) if limits else ('total', 0)
+
+_TIMEOUT_PHASES = {field.name for field in fields(PhaseTimeouts)}
+
+def resolve_timeouts(path: str, model: Optional[str] = None,
+                     overrides: Dict[str, Dict[str, float]] = TIMEOUT_OVERRIDES) -> PhaseTimeouts:
+    """按路径前缀和模型计算请求的超时，模型的设置优先于路径"""
+    timeouts = PhaseTimeouts()
+    matched = [values for key, values in overrides.items()
+               if key.startswith('/') and path.startswith(key)]
+    if model:
+        matched += [values for key, values in overrides.items()
+                    if not key.startswith('/') and fnmatch.fnmatchcase(model, key)]
+    for values in matched:
+        timeouts = replace(timeouts, **{phase: float(value) for phase, value in values.items()
+                                        if phase in _TIMEOUT_PHASES})
+    return timeouts
+
+def overrides_need_model(overrides: Dict[str, Dict[str, float]] = TIMEOUT_OVERRIDES) -> bool:
+    """是否配置了按模型的超时（需要从请求体中提取模型）"""
+    return any(not key.startswith('/') for key in overrides)
+
+class ReadWatchdog:
+    """监视上游响应体的读取
+
+    首块数据超过 first_byte、两块数据间隔超过 idle 或整个请求超过 total 时，
+    在响应流上设置 UpstreamTimeout，正在等待的读取会立即抛出该异常。
+    只使用定时器，不为每次读取创建任务。
+    """
+
+    def __init__(self, response, timeouts: PhaseTimeouts, started_at: float):
+        self._loop = asyncio.get_running_loop()
+        self._content = response.content
+        self.timeouts = timeouts
+        self.started_at = started_at
+        self.last_activity = started_at
+        self.received = False
+        self.expired: Optional[UpstreamTimeout] = None
+        self._idle_handle = None
+        self._total_handle = None
+        if timeouts.total:
+            self._total_handle = self._loop.call_at(started_at + timeouts.total,
+                                                    self._expire, 'total', timeouts.total)
+        self._arm()
+
+    def touch(self):
+        """收到一块数据"""
+        self.last_activity = self._loop.time()
+        if not self.received:
+            self.received = True
+            self._arm()
+
+    def _arm(self):
+        """按当前阶段设置下一次检查的时间"""
+        if self._idle_handle is not None:
+            self._idle_handle.cancel()
+            self._idle_handle = None
+        if self.received:
+            if self.timeouts.idle:
+                self._idle_handle = self._loop.call_at(self.last_activity + self.timeouts.idle, self._check)
+        elif self.timeouts.first_byte:
+            self._idle_handle = self._loop.call_at(self.started_at + self.timeouts.first_byte, self._check)
+
+    def _check(self):
+        """定时检查，期间收到过数据则顺延"""
+        self._idle_handle = None
+        if self.received:
+            deadline = self.last_activity + self.timeouts.idle
+            phase, limit = 'idle', self.timeouts.idle
+        else:
+            deadline = self.started_at + self.timeouts.first_byte
+            phase, limit = 'first_byte', self.timeouts.first_byte
+        if self._loop.time() >= deadline:
+            self._expire(phase, limit)
+        else:
+            self._idle_handle = self._loop.call_at(deadline, self._check)
+
+    def _expire(self, phase: str, limit: float):
+        """超时，使后续读取抛出异常"""
+        if self.expired is None:
+            self.expired = UpstreamTimeout(phase, limit)
+            self._content.set_exception(self.expired)
+        self.stop()
+
+    def stop(self):
+        """取消所有定时器"""
+        for handle in (self._idle_handle, self._total_handle):
+            if handle is not None:
+                handle.cancel()
+        self._idle_handle = self._total_handle = None
+
+class UpstreamPool:
+    """上游HTTP连接池
+
+    连接器参数来自配置，并通过 TraceConfig 统计排队等待、新建连接和连接复用情况。
+    请求时通过 trace_request_ctx 传入字典，可得到该请求建立连接的耗时 connect_ms。
+    """
+
+    def __init__(self, limit: int = UPSTREAM_LIMIT, limit_per_host: int = UPSTREAM_LIMIT_PER_HOST,
+                 keepalive_timeout: float = UPSTREAM_KEEPALIVE_TIMEOUT,
+                 dns_cache_ttl: int = UPSTREAM_DNS_CACHE_TTL):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.connector: Optional[TCPConnector] = None
+
+        # 统计信息（只在事件循环线程中更新）
+        self.requests = 0
+        self.connections_created = 0
+        self.connections_reused = 0
+        self.queued = 0
+        self.queued_now = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        self.connect_total = 0.0
+        self.dns_cache_hits = 0
+        self.dns_cache_misses = 0
+
+    def create_session(self, timeout: ClientTimeout) -> ClientSession:
+        """创建使用该连接池的会话"""
+        self.connector = TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            use_dns_cache=self.dns_cache_ttl != 0,
+            ttl_dns_cache=self.dns_cache_ttl if self.dns_cache_ttl > 0 else None,
+        )
+        return ClientSession(connector=self.connector, timeout=timeout,
+                             trace_configs=[self._trace_config()])
+
+    def _trace_config(self) -> TraceConfig:
+        """注册连接池相关的追踪回调"""
+        trace = TraceConfig()
+
+        async def on_request_start(session, ctx, params):
+            self.requests += 1
+
+        async def on_queued_start(session, ctx, params):
+            ctx.queued_at = time.perf_counter()
+            self.queued += 1
+            self.queued_now += 1
+
+        async def on_queued_end(session, ctx, params):
+            self.queued_now -= 1
+            wait = time.perf_counter() - ctx.queued_at
+            self.queue_wait_total += wait
+            self.queue_wait_max = max(self.queue_wait_max, wait)
+            if wait > 1.0:
+                logger.warning(f"Waited {wait * 1000:.0f}ms for an upstream connection "
+                               f"({self.queued_now} still queued, limit {self.limit})")
+
+        async def on_create_start(session, ctx, params):
+            ctx.connect_at = time.perf_counter()
+
+        async def on_create_end(session, ctx, params):
+            elapsed = time.perf_counter() - ctx.connect_at
+            self.connections_created += 1
+            self.connect_total += elapsed
+            if isinstance(ctx.trace_request_ctx, dict):
+                ctx.trace_request_ctx['connect_ms'] = elapsed * 1000
+
+        async def on_reuse(session, ctx, params):
+            self.connections_reused += 1
+            if isinstance(ctx.trace_request_ctx, dict):
+                ctx.trace_request_ctx['connect_ms'] = 0.0
+
+        async def on_dns_hit(session, ctx, params):
+            self.dns_cache_hits += 1
+
+        async def on_dns_miss(session, ctx, params):
+            self.dns_cache_misses += 1
+
+        trace.on_request_start.append(on_request_start)
+        trace.on_connection_queued_start.append(on_queued_start)
+        trace.on_connection_queued_end.append(on_queued_end)
+        trace.on_connection_create_start.append(on_create_start)
+        trace.on_connection_create_end.append(on_create_end)
+        trace.on_connection_reuseconn.append(on_reuse)
+        trace.on_dns_cache_hit.append(on_dns_hit)
+        trace.on_dns_cache_miss.append(on_dns_miss)
+        return trace
+
+    async def warm_up(self, session: ClientSession, base_url: str,
+                      connections: int = UPSTREAM_WARMUP_CONNECTIONS):
+        """启动时预先建立到上游的连接，避免首批请求承担握手延迟"""
+        if connections <= 0:
+            return
+
+        async def open_connection():
+            async with session.head(base_url, allow_redirects=False) as response:
+                await response.read()
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(open_connection() for _ in range(connections)),
+                                       return_exceptions=True)
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            logger.warning(f"Upstream warm-up: {len(errors)}/{connections} connections failed: {errors[0]}")
+        logger.info(f"Upstream warm-up opened {connections - len(errors)} connections "
+                    f"in {(time.perf_counter() - start) * 1000:.2f}ms")
+
+    def stats(self) -> Dict[str, Any]:
+        """连接池统计信息"""
+        in_use = idle = 0
+        if self.connector is not None and not self.connector.closed:
+            # aiohttp没有公开连接数，从连接器内部状态读取
+            in_use = len(getattr(self.connector, '_acquired', ()))
+            idle = sum(len(conns) for conns in getattr(self.connector, '_conns', {}).values())
+        acquired = self.connections_created + self.connections_reused
+        return {
+            'limit': self.limit,
+            'limit_per_host': self.limit_per_host,
+            'keepalive_timeout': self.keepalive_timeout,
+            'dns_cache_ttl': self.dns_cache_ttl,
+            'requests': self.requests,
+            'connections_in_use': in_use,
+            'connections_idle': idle,
+            'connections_created': self.connections_created,
+            'connections_reused': self.connections_reused,
+            'reuse_ratio': round(self.connections_reused / acquired, 3) if acquired else None,
+            'queued': self.queued,
+            'queued_now': self.queued_now,
+            'queue_wait_avg_ms': round(self.queue_wait_total / self.queued * 1000, 2) if self.queued else None,
+            'queue_wait_max_ms': round(self.queue_wait_max * 1000, 2),
+            'connect_avg_ms': round(self.connect_total / self.connections_created * 1000, 2)
+                              if self.connections_created else None,
+            'dns_cache_hits': self.dns_cache_hits,
+            'dns_cache_misses': self.dns_cache_misses,
+        }
@@ -2,15 +2,25 @@
 Web界面服务器
 """
 import json
+import asyncio
+import functools
 import logging
+import threading
+from collections import OrderedDict
+from dataclasses import replace
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Tuple
 from aiohttp import web
 from aiohttp_jinja2 import setup as jinja2_setup, template
 import aiohttp_jinja2
 import jinja2
 from pathlib import Path
 
-from models import request_storage
-from config import WEB_HOST, WEB_PORT, PAGE_SIZE, SUPER_ADMIN_APIKEY, DEFAULT_APIKEY
+from urllib.parse import urlencode
+
+from events import event_bus, storage_listener
+from models import request_storage, encode_cursor, decode_cursor, RequestRecord, SORTABLE_COLUMNS
+from config import WEB_HOST, WEB_PORT, PAGE_SIZE, SUPER_ADMIN_APIKEY, DEFAULT_APIKEY, DETAIL_CACHE_SIZE, STATS_WINDOW_HOURS, EVENTS_KEEPALIVE_INTERVAL
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
@@ -37,6 +47,44 @@ def should_filter_by_apikey(apikey: str) -> str:
     # 其他key只能查看自己的记录
     return apikey
 
+def mask_apikey(apikey: Optional[str]) -> Optional[str]:
+    """只保留API Key的前后几位，用于统计结果"""
+    if apikey and len(apikey) > 12:
+        return f"{apikey[:8]}...{apikey[-4:]}"
+    return apikey
+
+async def run_storage(func, *args, **kwargs):
+    """在线程池中执行存储查询，避免阻塞事件循环"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+def parse_sort_and_ranges(query) -> Tuple[Optional[str], bool, Dict[str, Tuple[Optional[float], Optional[float]]]]:
+    """解析排序和范围过滤参数
+
+    sort=<列> 升序、sort=-<列> 降序；<列>_min / <列>_max 按范围过滤，列见 SORTABLE_COLUMNS。
+    """
+    sort = query.get('sort', '').strip() or None
+    descending = False
+    if sort and sort.startswith('-'):
+        sort, descending = sort[1:], True
+    if sort and sort not in SORTABLE_COLUMNS:
+        raise ValueError(f"Unknown sort column: {sort}")
+    ranges = {}
+    for column in SORTABLE_COLUMNS:
+        low, high = query.get(f'{column}_min', ''), query.get(f'{column}_max', '')
+        if low or high:
+            ranges[column] = (float(low) if low else None, float(high) if high else None)
+    return sort, descending, ranges
+
+def format_body(text: Optional[str]) -> Optional[str]:
+    """查看时将JSON内容格式化，其他内容原样返回"""
+    if not text or text.lstrip()[:1] not in ('{', '['):
+        return text
+    try:
+        return json.dumps(json.loads(text), ensure_ascii=False, indent=2)
+    except ValueError:
+        return text
+
 @web.middleware
 async def cors_middleware(request: web.Request, handler):
     """CORS中间件"""
@@ -60,8 +108,8 @@ async def cors_middleware(request: web.Request, handler):
 @web.middleware
 async def auth_middleware(request: web.Request, handler):
     """认证中间件"""
-    # 登录页面和静态文件不需要认证
-    if request.path in ['/login', '/static'] or request.path.startswith('/static/'):
+    # 登录页面、健康检查和静态文件不需要认证
+    if request.path in ['/login', '/healthz', '/static'] or request.path.startswith('/static/'):
         return await handler(request)
     
     apikey = get_apikey_from_request(request)
@@ -82,35 +130,106 @@ async def auth_middleware(request: web.Request, handler):
 class WebServer:
     """Web界面服务器类"""
 
+    def __init__(self, detail_cache_size: int = DETAIL_CACHE_SIZE):
+        self._detail_cache: OrderedDict = OrderedDict()
+        self._detail_cache_size = detail_cache_size
+        self._detail_cache_lock = threading.Lock()
+
+    def _load_formatted_record(self, request_id: str) -> Optional[RequestRecord]:
+        """加载请求记录并格式化请求/响应体，已完成的记录会被缓存"""
+        with self._detail_cache_lock:
+            record = self._detail_cache.get(request_id)
+            if record is not None:
+                self._detail_cache.move_to_end(request_id)
+                return record
+
+        record = request_storage.get_request(request_id)
+        if not record:
+            return None
+        record = replace(record, body=format_body(record.body), response_body=format_body(record.response_body))
+
+        # 进行中的记录内容还会变化，不缓存
+        if self._detail_cache_size > 0 and (record.response_status is not None or record.error is not None):
+            with self._detail_cache_lock:
+                self._detail_cache[request_id] = record
+                while len(self._detail_cache) > self._detail_cache_size:
+                    self._detail_cache.popitem(last=False)
+        return record
+
     @template('login.html')
     async def login(self, request: web.Request) -> dict:
         """登录页面"""
         return {'default_apikey': DEFAULT_APIKEY}
 
-    @template('index.html')
-    async def index(self, request: web.Request) -> dict:
-        """主页面"""
+    async def _list_requests(self, request: web.Request) -> dict:
+        """按查询参数获取一页请求记录
+
+        支持 page 偏移分页，以及 before/after=<timestamp>,<id> 键集分页；
+        搜索结果按相关度排序（order=time 时按时间），使用 page 分页。
+        不搜索时可按延迟等列排序和过滤（见 parse_sort_and_ranges），使用 page 分页。
+        """
         page = int(request.query.get('page', 1))
         search = request.query.get('search', '').strip()
         apikey_filter = request.get('apikey_filter')
 
+        try:
+            before = decode_cursor(request.query['before']) if request.query.get('before') else None
+            after = decode_cursor(request.query['after']) if request.query.get('after') else None
+            sort, descending, ranges = parse_sort_and_ranges(request.query)
+        except ValueError as e:
+            raise web.HTTPBadRequest(text=str(e))
+
         offset = (page - 1) * PAGE_SIZE
 
         if search:
-            requests = request_storage.search_requests(search, limit=PAGE_SIZE, apikey_filter=apikey_filter)
-            total_count = len(requests)
+            order = 'time' if request.query.get('order') == 'time' else 'rank'
+            requests = await run_storage(request_storage.search_request_summaries, search, limit=PAGE_SIZE, offset=offset,
+                                         apikey_filter=apikey_filter, order=order)
+            total_count = await run_storage(request_storage.count_search_results, search, apikey_filter=apikey_filter)
+        elif sort or ranges:
+            requests = await run_storage(request_storage.get_sorted_request_summaries, sort,
+                                         descending=descending, ranges=ranges,
+                                         limit=PAGE_SIZE, offset=offset, apikey_filter=apikey_filter)
+            total_count = await run_storage(request_storage.count_filtered_requests, ranges,
+                                            apikey_filter=apikey_filter)
         else:
-            requests = request_storage.get_requests(limit=PAGE_SIZE, offset=offset, apikey_filter=apikey_filter)
-            total_count = request_storage.get_total_count(apikey_filter=apikey_filter)
+            requests = await run_storage(request_storage.get_request_summaries, limit=PAGE_SIZE, offset=offset,
+                                         apikey_filter=apikey_filter, before=before, after=after)
+            total_count = await run_storage(request_storage.get_total_count, apikey_filter=apikey_filter)
+
+        # 排序和过滤参数在翻页时保留
+        list_params = {key: value for key, value in request.query.items()
+                       if key == 'sort' or key.endswith(('_min', '_max'))}
+        paged = not search and not list_params and bool(requests)
+        return {
+            'sort': request.query.get('sort', ''),
+            'list_query': urlencode(list_params),
+            'requests': requests,
+            'page': page,
+            'total_count': total_count,
+            'search': search,
+            'next_cursor': encode_cursor(requests[-1]) if paged and len(requests) == PAGE_SIZE else None,
+            'prev_cursor': encode_cursor(requests[0]) if paged and page > 1 else None
+        }
+
+    @template('index.html')
+    async def index(self, request: web.Request) -> dict:
+        """主页面"""
+        result = await self._list_requests(request)
+        total_count = result['total_count']
 
         total_pages = (total_count + PAGE_SIZE - 1) // PAGE_SIZE
 
         return {
-            'requests': requests,
-            'current_page': page,
+            'requests': result['requests'],
+            'current_page': result['page'],
             'total_pages': total_pages,
             'total_count': total_count,
-            'search': search,
+            'search': result['search'],
+            'next_cursor': result['next_cursor'],
+            'prev_cursor': result['prev_cursor'],
+            'sort': result['sort'],
+            'list_query': result['list_query'],
             'page_size': PAGE_SIZE,
             'current_apikey': request.get('apikey', ''),
             'is_admin': request.get('apikey') == SUPER_ADMIN_APIKEY
@@ -120,7 +239,7 @@ class WebServer:
     async def request_detail(self, request: web.Request) -> dict:
         """请求详情页面"""
         request_id = request.match_info['request_id']
-        record = request_storage.get_request(request_id)
+        record = await run_storage(self._load_formatted_record, request_id)
 
         if not record:
             raise web.HTTPNotFound(text="Request not found")
@@ -129,63 +248,139 @@ class WebServer:
 
     async def api_requests(self, request: web.Request) -> web.Response:
         """API: 获取请求列表"""
-        page = int(request.query.get('page', 1))
-        search = request.query.get('search', '').strip()
-        apikey_filter = request.get('apikey_filter')
-
-        offset = (page - 1) * PAGE_SIZE
-
-        if search:
-            requests = request_storage.search_requests(search, limit=PAGE_SIZE, apikey_filter=apikey_filter)
-            total_count = len(requests)
-        else:
-            requests = request_storage.get_requests(limit=PAGE_SIZE, offset=offset, apikey_filter=apikey_filter)
-            total_count = request_storage.get_total_count(apikey_filter=apikey_filter)
+        result = await self._list_requests(request)
 
         return web.json_response({
-            'requests': [req.to_dict() for req in requests],
-            'total_count': total_count,
-            'page': page,
-            'page_size': PAGE_SIZE
+            'requests': [req.to_dict() for req in result['requests']],
+            'total_count': result['total_count'],
+            'page': result['page'],
+            'page_size': PAGE_SIZE,
+            'next_cursor': result['next_cursor'],
+            'prev_cursor': result['prev_cursor']
         })
 
     async def api_request_detail(self, request: web.Request) -> web.Response:
         """API: 获取请求详情"""
         request_id = request.match_info['request_id']
-        record = request_storage.get_request(request_id)
+        record = await run_storage(self._load_formatted_record, request_id)
 
         if not record:
             raise web.HTTPNotFound(text="Request not found")
 
         return web.json_response(record.to_dict())
 
-    async def api_stats(self, request: web.Request) -> web.Response:
-        """API: 获取统计信息"""
+    async def api_usage(self, request: web.Request) -> web.Response:
+        """API: 按模型、API Key、供应商或日期汇总token用量和费用"""
+        group_by = [group.strip() for group in request.query.get('group', 'model').split(',') if group.strip()]
+        try:
+            since = datetime.fromisoformat(request.query['since']) if request.query.get('since') else None
+            until = datetime.fromisoformat(request.query['until']) if request.query.get('until') else None
+            rows = await run_storage(request_storage.get_usage_totals, group_by, since=since, until=until,
+                                     apikey_filter=request.get('apikey_filter'))
+        except ValueError as e:
+            raise web.HTTPBadRequest(text=str(e))
+
+        if 'key' in group_by:
+            for row in rows:
+                row['key'] = mask_apikey(row['key'])
+
+        return web.json_response({'group': group_by, 'usage': rows})
+
+    async def api_events(self, request: web.Request) -> web.StreamResponse:
+        """API: 实时事件流(SSE)，推送请求的开始和完成以及统计增量"""
         apikey_filter = request.get('apikey_filter')
-        
-        total_requests = request_storage.get_total_count(apikey_filter=apikey_filter)
-        recent_requests = request_storage.get_requests(limit=10, apikey_filter=apikey_filter)
+        response = web.StreamResponse(headers={
+            'Content-Type': 'text/event-stream',
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',
+        })
+        await response.prepare(request)
+        subscription = event_bus.subscribe()
+        try:
+            await response.write(b'retry: 3000\n\n')
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscription.get(), EVENTS_KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    await response.write(b': keepalive\n\n')
+                    continue
+                if event is None:
+                    break
+                if subscription.dropped:
+                    # 页面处理不及时丢失了事件，通知其重新加载统计
+                    subscription.dropped = 0
+                    await response.write(b'event: resync\ndata: {}\n\n')
+                if apikey_filter and event.get('apikey') != apikey_filter:
+                    continue
+                payload = {key: value for key, value in event.items() if key not in ('type', 'apikey')}
+                await response.write(f"event: {event['type']}\ndata: {json.dumps(payload)}\n\n".encode())
+        except ConnectionResetError:
+            pass
+        finally:
+            event_bus.unsubscribe(subscription)
+        return response
 
-        # 计算成功率
-        success_count = sum(1 for req in recent_requests
-                          if req.response_status and 200 <= req.response_status < 300)
-        success_rate = (success_count / len(recent_requests) * 100) if recent_requests else 0
+    async def healthz(self, request: web.Request) -> web.Response:
+        """健康检查：数据库可读时返回200"""
+        try:
+            await run_storage(request_storage.ping)
+        except Exception as e:
+            return web.json_response({'status': 'unavailable', 'error': str(e)}, status=503)
+        return web.json_response({'status': 'ok'})
 
-        # 计算平均响应时间
-        response_times = [req.duration_ms for req in recent_requests
-                         if req.duration_ms is not None]
-        avg_response_time = sum(response_times) / len(response_times) if response_times else 0
+    async def api_stats(self, request: web.Request) -> web.Response:
+        """API: 获取统计信息
+
+        成功率、延迟和分位数来自统计汇总表，默认统计最近 STATS_WINDOW_HOURS 小时，
+        可用 since / until (ISO格式) 指定范围，group=model,key,status 按维度分组。
+        """
+        apikey_filter = request.get('apikey_filter')
+        group_by = [group.strip() for group in request.query.get('group', '').split(',') if group.strip()]
+        try:
+            until = datetime.fromisoformat(request.query['until']) if request.query.get('until') else None
+            since = (datetime.fromisoformat(request.query['since']) if request.query.get('since')
+                     else (until or datetime.now()) - timedelta(hours=STATS_WINDOW_HOURS))
+            stats = await run_storage(request_storage.get_stats, since, until,
+                                      apikey_filter=apikey_filter, group_by=group_by)
+        except ValueError as e:
+            raise web.HTTPBadRequest(text=str(e))
+        total_requests = await run_storage(request_storage.count_rollup_requests, apikey_filter=apikey_filter)
+
+        for group in stats.get('groups', []):
+            if 'key' in group:
+                group['key'] = mask_apikey(group['key'])
 
         return web.json_response({
+            **stats,
             'total_requests': total_requests,
-            'success_rate': round(success_rate, 2),
-            'avg_response_time': round(avg_response_time, 2),
-            'recent_requests_count': len(recent_requests)
+            'success_rate': stats['success_rate'] if stats['success_rate'] is not None else 0,
+            'avg_response_time': stats['avg_latency_ms'] if stats['avg_latency_ms'] is not None else 0,
+            'since': since.isoformat(),
+            'until': until.isoformat() if until else None,
+            'storage': {**request_storage.get_queue_stats(), **request_storage.get_compression_stats()}
         })
 
-async def create_web_app() -> web.Application:
-    """创建Web应用"""
+async def start_event_bus(app: web.Application):
+    """启动事件总线
+
+    多进程模式下从进程间队列接收代理进程的事件；否则代理运行在同一进程中，直接监听请求存储。
+    """
+    event_bus.start()
+    if app['event_queue'] is not None:
+        event_bus.consume(app['event_queue'])
+    else:
+        request_storage.add_listener(storage_listener(event_bus.publish_threadsafe, event_bus.has_subscribers))
+
+async def stop_event_bus(app: web.Application):
+    """在等待进行中的请求之前结束事件流连接"""
+    await event_bus.stop()
+
+async def create_web_app(event_queue=None) -> web.Application:
+    """创建Web应用，event_queue 为多进程模式下代理进程发来事件的队列"""
     app = web.Application(middlewares=[cors_middleware, auth_middleware])
+    app['event_queue'] = event_queue
+    app.on_startup.append(start_event_bus)
+    app.on_shutdown.append(stop_event_bus)
 
     # 设置模板引擎
     template_dir = Path(__file__).parent / 'templates'
@@ -200,6 +395,7 @@ async def create_web_app() -> web.Application:
 
     # 添加路由
     app.router.add_get('/login', web_server.login, name='login')
+    app.router.add_get('/healthz', web_server.healthz, name='healthz')
     app.router.add_get('/', web_server.index, name='index')
     app.router.add_get('/request/{request_id}', web_server.request_detail, name='request_detail')
 
@@ -207,12 +403,14 @@ async def create_web_app() -> web.Application:
     app.router.add_get('/api/requests', web_server.api_requests, name='api_requests')
     app.router.add_get('/api/request/{request_id}', web_server.api_request_detail, name='api_request_detail')
     app.router.add_get('/api/stats', web_server.api_stats, name='api_stats')
+    app.router.add_get('/api/usage', web_server.api_usage, name='api_usage')
+    app.router.add_get('/api/events', web_server.api_events, name='api_events')
 
     return app
 
-async def main():
+async def main(event_queue=None):
     """主函数"""
-    app = await create_web_app()
+    app = await create_web_app(event_queue)
 
     runner = web.AppRunner(app)
     await runner.setup()
@@ -223,7 +421,6 @@ async def main():
     logger.info(f"Web Server started on http://{WEB_HOST}:{WEB_PORT}")
 
     try:
-        import asyncio
         await asyncio.Future()  # 永远运行
     except KeyboardInterrupt:
         logger.info("Shutting down web server...")
@@ -231,5 +428,4 @@ async def main():
         await runner.cleanup()
 
 if __name__ == '__main__':
-    import asyncio
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,249 @@
+"""
+多进程运行模式
+
+supervisor 预先绑定代理端口，fork 出多个代理工作进程共享该监听socket，
+另有一个存储写入进程负责所有SQLite写操作，以及一个只读访问数据库的Web界面进程。
+代理进程不加载Web界面的代码，界面上的慢查询不会影响代理的延迟。
+请求开始和完成的事件经进程间队列发给Web进程，用于推送给已打开的页面。
+子进程定期更新心跳，异常退出或心跳超时后会被自动重启。
+"""
+import asyncio
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+import signal
+import socket
+import time
+from typing import Any, Callable, Dict, Optional
+
+from config import (
+    PROXY_HOST, PROXY_PORT, STORAGE_QUEUE_SIZE, WORKER_HEARTBEAT_INTERVAL, WORKER_HEARTBEAT_TIMEOUT,
+    EVENTS_QUEUE_SIZE
+)
+
+logger = logging.getLogger(__name__)
+
+# 使用fork启动子进程，子进程直接继承监听socket和已加载的模块
+_mp = multiprocessing.get_context('fork')
+
+def create_listen_socket(host: str = PROXY_HOST, port: int = PROXY_PORT, backlog: int = 1024) -> socket.socket:
+    """在supervisor中绑定代理端口，由所有工作进程共享"""
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+def _run_until_terminated(heartbeat, main: Callable, *args):
+    """在子进程中运行异步服务，收到SIGTERM时取消并完成清理"""
+    # Ctrl+C 会发给整个进程组，由supervisor统一协调退出
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    async def beat():
+        # 心跳由事件循环更新，循环被阻塞时supervisor会发现心跳停止
+        while True:
+            heartbeat.value = time.monotonic()
+            await asyncio.sleep(WORKER_HEARTBEAT_INTERVAL)
+
+    async def runner():
+        loop = asyncio.get_running_loop()
+        task = asyncio.ensure_future(main(*args))
+        beat_task = asyncio.ensure_future(beat())
+        loop.add_signal_handler(signal.SIGTERM, task.cancel)
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        finally:
+            beat_task.cancel()
+
+    asyncio.run(runner())
+
+def proxy_worker(heartbeat, sock: socket.socket, record_queue, event_queue, event_subscribers, index: int):
+    """代理工作进程：只转发请求，完成的记录发送给写入进程"""
+    from events import queue_publisher, storage_listener
+    from models import request_storage
+    from proxy_server import main as proxy_main
+
+    request_storage.use_process_writer(record_queue)
+    # 事件可以丢弃，退出时不等待队列中剩余的事件发送完
+    event_queue.cancel_join_thread()
+    # Web进程中有页面订阅时才发送事件
+    request_storage.add_listener(storage_listener(queue_publisher(event_queue),
+                                                  lambda: event_subscribers.value > 0))
+    _run_until_terminated(heartbeat, proxy_main, sock, index)
+
+def storage_writer(heartbeat, record_queue, storage_stats):
+    """存储写入进程：从进程间队列接收记录并批量写入SQLite，随心跳发布写入统计"""
+    from models import request_storage
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)  # 等待supervisor发送结束标记
+    logger.info(f"Storage writer started (pid {os.getpid()})")
+    request_storage.share_stats(storage_stats)
+    published_at = 0.0
+    while True:
+        heartbeat.value = now = time.monotonic()
+        if now - published_at >= WORKER_HEARTBEAT_INTERVAL:
+            request_storage.publish_stats()
+            published_at = now
+        try:
+            record = record_queue.get(timeout=WORKER_HEARTBEAT_INTERVAL)
+        except queue.Empty:
+            continue
+        if record is None:
+            break
+        request_storage.save_record(record)
+    request_storage.close()
+    logger.info("Storage writer stopped")
+
+def web_worker(heartbeat, event_queue, event_subscribers, storage_stats):
+    """Web界面进程：只读访问数据库，转发代理进程发来的事件"""
+    from events import event_bus
+    from models import request_storage
+    from web_server import main as web_main
+
+    request_storage.use_read_only()
+    request_storage.share_stats(storage_stats)
+    event_bus.share_subscriber_count(event_subscribers)
+    _run_until_terminated(heartbeat, web_main, event_queue)
+
+class Supervisor:
+    """启动并监控所有子进程"""
+
+    RESTART_BACKOFF_MAX = 30.0  # 连续崩溃时的最长重启间隔(秒)
+    STABLE_AFTER = 10.0  # 运行超过该时间视为正常，重置重启间隔
+    SHUTDOWN_TIMEOUT = 70.0  # 等待代理进程处理完进行中请求的时间(秒)
+
+    def __init__(self, workers: int, with_web: bool = True,
+                 heartbeat_timeout: float = WORKER_HEARTBEAT_TIMEOUT):
+        self.workers = max(1, workers)
+        self.with_web = with_web
+        self.heartbeat_timeout = heartbeat_timeout
+        self.sock: Optional[socket.socket] = None
+        self.record_queue = _mp.Queue(STORAGE_QUEUE_SIZE)
+        self.event_queue = _mp.Queue(EVENTS_QUEUE_SIZE)
+        self.event_subscribers = _mp.RawValue('i', 0)  # Web进程中的页面订阅数
+        self.storage_stats = None  # 写入进程发布给Web进程的存储统计，见 models.SharedStorageStats
+        self.processes: Dict[str, multiprocessing.Process] = {}
+        self._heartbeats: Dict[str, Any] = {}
+        self._started_at: Dict[str, float] = {}
+        self._failures: Dict[str, int] = {}
+        self._restart_at: Dict[str, float] = {}
+        self._stopping = False
+
+    def _target(self, name: str):
+        """子进程名称对应的入口和参数（心跳之外）"""
+        if name == 'writer':
+            return storage_writer, (self.record_queue, self.storage_stats)
+        if name == 'web':
+            return web_worker, (self.event_queue, self.event_subscribers, self.storage_stats)
+        return proxy_worker, (self.sock, self.record_queue, self.event_queue, self.event_subscribers,
+                              int(name.split('-')[1]))
+
+    def _spawn(self, name: str):
+        """启动一个子进程"""
+        target, args = self._target(name)
+        # 共享内存中的心跳时间戳，启动阶段从当前时间开始计算超时
+        heartbeat = _mp.RawValue('d', time.monotonic())
+        self._heartbeats[name] = heartbeat
+        process = _mp.Process(target=target, args=(heartbeat, *args), name=name, daemon=False)
+        process.start()
+        self.processes[name] = process
+        self._started_at[name] = time.monotonic()
+        logger.info(f"Started {name} (pid {process.pid})")
+
+    def _handle_exit(self, name: str):
+        """子进程退出，按退避时间安排重启"""
+        process = self.processes.pop(name)
+        process.join()  # 回收进程以获取退出码
+        uptime = time.monotonic() - self._started_at[name]
+        failures = 0 if uptime >= self.STABLE_AFTER else self._failures.get(name, 0) + 1
+        self._failures[name] = failures
+        delay = min(self.RESTART_BACKOFF_MAX, 0.5 * 2 ** failures) if failures else 0
+        logger.error(f"{name} (pid {process.pid}) exited with code {process.exitcode} "
+                     f"after {uptime:.1f}s, restarting in {delay:.1f}s")
+        self._restart_at[name] = time.monotonic() + delay
+
+    def _check_heartbeats(self):
+        """结束心跳超时的子进程，随后按正常退出流程重启"""
+        if self.heartbeat_timeout <= 0:
+            return
+        now = time.monotonic()
+        for name, process in self.processes.items():
+            heartbeat = self._heartbeats[name]
+            if now - heartbeat.value > self.heartbeat_timeout and process.is_alive():
+                logger.error(f"{name} (pid {process.pid}) missed heartbeats for "
+                             f"{now - heartbeat.value:.1f}s, killing")
+                heartbeat.value = now  # 避免在进程退出前重复处理
+                process.kill()
+
+    def _request_stop(self, signum, frame):
+        """信号处理：开始协调退出"""
+        logger.info(f"Received signal {signum}, shutting down workers...")
+        self._stopping = True
+
+    def run(self):
+        """启动所有子进程并监控，直到收到退出信号"""
+        # 在fork之前完成数据库初始化和迁移，子进程不会同时执行迁移
+        import models
+
+        self.storage_stats = _mp.RawArray('d', len(models.SharedStorageStats.FIELDS))
+
+        self.sock = create_listen_socket()
+        signal.signal(signal.SIGINT, self._request_stop)
+        signal.signal(signal.SIGTERM, self._request_stop)
+
+        names = ['writer'] + [f'proxy-{i}' for i in range(self.workers)]
+        if self.with_web:
+            names.append('web')
+        for name in names:
+            self._spawn(name)
+
+        while not self._stopping:
+            sentinels = {process.sentinel: name for name, process in self.processes.items()}
+            ready = multiprocessing.connection.wait(list(sentinels), timeout=0.5)
+            if self._stopping:
+                break
+            for sentinel in ready:
+                self._handle_exit(sentinels[sentinel])
+            self._check_heartbeats()
+            now = time.monotonic()
+            for name, restart_at in list(self._restart_at.items()):
+                if now >= restart_at:
+                    del self._restart_at[name]
+                    self._spawn(name)
+
+        self.shutdown()
+
+    def _terminate(self, names, timeout: float):
+        """向子进程发送SIGTERM并等待退出，超时则强制结束"""
+        processes = [self.processes[name] for name in names if name in self.processes]
+        for process in processes:
+            process.terminate()
+        deadline = time.monotonic() + timeout
+        for process in processes:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning(f"{process.name} did not exit in time, killing")
+                process.kill()
+                process.join()
+
+    def shutdown(self):
+        """按顺序退出：先停代理进程，再让写入进程落盘剩余记录"""
+        proxies = [name for name in self.processes if name.startswith('proxy-')]
+        self._terminate(proxies + ['web'], self.SHUTDOWN_TIMEOUT)
+        writer = self.processes.get('writer')
+        if writer is not None:
+            self.record_queue.put(None)
+            writer.join(self.SHUTDOWN_TIMEOUT)
+            if writer.is_alive():
+                logger.warning("Storage writer did not exit in time, killing")
+                writer.kill()
+        if self.sock is not None:
+            self.sock.close()
+        logger.info("All workers stopped")